@@ -3,5 +3,6 @@ from . import job
 from . import matproj
 from . import db
 from . import base
+from . import monitor
 
-__all__ = []
\ No newline at end of file
+__all__ = []
@@ -2,9 +2,21 @@ from .base import (Input, Output,
                    Calculation, Job,
                    Workflow)
 
-from .hash import (dftman_hash, hash_dict)
+from .hash import (dftman_hash, hash_dict, set_hash_version,
+                   file_identity, CanonicalHasher, CachedHash)
+
+from .blob import (BlobStore, BlobRef, blobs_directory, set_blobs_directory,
+                   use_blob_store, get_blob_store)
+
+from .cache import (ResultCache, set_result_cache, get_result_cache,
+                    restore_from_cache, store_in_cache)
 
 __all__ = ['Input', 'Output',
            'Calculation', 'Job',
            'Workflow',
-           'dftman_hash', 'hash_dict']
\ No newline at end of file
+           'dftman_hash', 'hash_dict', 'set_hash_version', 'file_identity',
+           'CanonicalHasher', 'CachedHash',
+           'BlobStore', 'BlobRef', 'blobs_directory', 'set_blobs_directory',
+           'use_blob_store', 'get_blob_store',
+           'ResultCache', 'set_result_cache', 'get_result_cache',
+           'restore_from_cache', 'store_in_cache']
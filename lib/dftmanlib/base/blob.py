@@ -0,0 +1,279 @@
+import os
+import os.path
+import json
+import zlib
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+from monty.json import MontyEncoder, MontyDecoder
+
+from .hash import dftman_hash
+
+_BLOBS_DIRECTORY = None
+_ACTIVE = threading.local()
+
+
+def blobs_directory(db_path=None):
+    '''
+    Directory of the blobs of a database, blobs next to the database file
+    :param db_path: path of the database, defaults to the directory set
+        with set_blobs_directory or ./blobs
+    :type db_path: str
+    :rtype: str
+    '''
+    if db_path is None:
+        return _BLOBS_DIRECTORY or os.path.join(os.getcwd(), 'blobs')
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), 'blobs')
+
+
+def set_blobs_directory(directory):
+    '''
+    Set the directory of BlobStores created without one, e.g. the blobs
+        of the default database (see dftmanlib.db.set_default_db)
+    :param directory: directory, or None for ./blobs
+    :type directory: str
+    '''
+    global _BLOBS_DIRECTORY
+    _BLOBS_DIRECTORY = directory
+
+
+@contextmanager
+def use_blob_store(store):
+    '''
+    Move large values into a store while documents are serialized in this
+        block, and load the BlobRefs decoded in it from the store, e.g.
+        while a database storage writes or reads its documents.
+        Serializing outside of such a block writes no blobs.
+    :param store: blob store
+    :type store: BlobStore
+    '''
+    previous = getattr(_ACTIVE, 'store', None)
+    _ACTIVE.store = store
+    try:
+        yield store
+    finally:
+        _ACTIVE.store = previous
+
+
+def get_blob_store():
+    '''
+    Get the store set with use_blob_store in this thread
+    :rtype: BlobStore | None
+    '''
+    return getattr(_ACTIVE, 'store', None)
+
+
+class BlobStore(object):
+    '''
+    Content-addressed store for large values, e.g. band structures,
+        which should not be embedded in database documents.
+        Each value is MSON-encoded, compressed with zlib and written once
+        to a file named after the dftman_hash of its encoding, so
+        identical values are only stored once.
+    :param directory: directory holding the blobs, see blobs_directory
+    :type directory: str
+    :param compression: zlib compression level
+    :type compression: int
+    '''
+    def __init__(self, directory=None, compression=6):
+        self.directory = directory or blobs_directory()
+        self.compression = compression
+
+    def __repr__(self):
+        return 'BlobStore({})'.format(self.directory)
+
+    def __eq__(self, other):
+        return (isinstance(other, BlobStore)
+                and os.path.abspath(self.directory)
+                == os.path.abspath(other.directory))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(os.path.abspath(self.directory))
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def path(self, key, suffix='.json.z'):
+        '''
+        Path of the file holding a blob
+        :param key: key of the blob
+        :type key: str
+        :param suffix: '.json.z' for values, '.z' for bytes
+        :type suffix: str
+        :returns: path of the blob file
+        :rtype: str
+        '''
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def put(self, value):
+        '''
+        Store a value
+        :param value: JSON-serializable or MSONable value
+        :returns: key of the stored value
+        :rtype: str
+        '''
+        encoded = json.dumps(value, cls=MontyEncoder,
+                             sort_keys=True).encode('utf-8')
+        key = dftman_hash(encoded)
+        self._write(self.path(key), encoded)
+        return key
+
+    def put_bytes(self, bytes_):
+        '''
+        Store raw bytes, e.g. the contents of a file
+        :param bytes_: bytes to store
+        :type bytes_: bytes
+        :returns: key of the stored bytes
+        :rtype: str
+        '''
+        key = dftman_hash(bytes_)
+        self._write(self.path(key, '.z'), bytes_)
+        return key
+
+    def get_bytes(self, key):
+        '''
+        Load bytes stored with put_bytes
+        :param key: key of the bytes
+        :type key: str
+        :rtype: bytes
+        :raises FileNotFoundError: if there are no bytes with this key
+        '''
+        with open(self.path(key, '.z'), 'rb') as handle:
+            return zlib.decompress(handle.read())
+
+    def copy(self, key, store, suffix='.json.z'):
+        '''
+        Copy a blob into another store, where it has the same key
+        :param key: key of the blob
+        :type key: str
+        :param store: store to copy the blob into
+        :type store: BlobStore
+        :param suffix: see path
+        :type suffix: str
+        '''
+        destination = store.path(key, suffix)
+        if not os.path.exists(destination):
+            with open(self.path(key, suffix), 'rb') as handle:
+                compressed = handle.read()
+            store._write(destination, compressed, compressed=True)
+
+    def _write(self, path, bytes_, compressed=False):
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first so that readers never see
+        # a partially written blob
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as handle:
+            if not compressed:
+                bytes_ = zlib.compress(bytes_, self.compression)
+            handle.write(bytes_)
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        '''
+        Load a value
+        :param key: key of the value
+        :type key: str
+        :returns: the decoded value
+        :raises FileNotFoundError: if there is no blob with this key
+        '''
+        with open(self.path(key), 'rb') as handle:
+            encoded = zlib.decompress(handle.read())
+        return json.loads(encoded.decode('utf-8'), cls=MontyDecoder)
+
+
+class BlobRef(object):
+    '''
+    Reference to a value in a BlobStore, which is stored in documents
+        instead of the value itself and loads it on first access
+    :param key: key of the value in the store
+    :type key: str
+    :param store: store holding the value, defaults to the store set
+        with use_blob_store when the reference is decoded, or else a
+        BlobStore in blobs_directory()
+    :type store: BlobStore
+    '''
+    def __init__(self, key, store=None):
+        self.key = key
+        self.store = store
+        self._value = None
+        self._loaded = False
+
+    def __repr__(self):
+        return 'BlobRef({})'.format(self.key)
+
+    @classmethod
+    def from_value(cls, value, store=None):
+        '''
+        Put a value into a store and reference it
+        :param value: value to store
+        :param store: store to put the value into
+        :type store: BlobStore
+        :returns: reference to the value, which is already loaded
+        :rtype: BlobRef
+        '''
+        store = store or BlobStore()
+        ref = cls(store.put(value), store=store)
+        ref._value = value
+        ref._loaded = True
+        return ref
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load(self):
+        '''
+        Get the referenced value, reading it from the store only once
+        :returns: the referenced value
+        '''
+        if not self._loaded:
+            self._value = (self.store or BlobStore()).get(self.key)
+            self._loaded = True
+        return self._value
+
+    def stored_in(self, store):
+        '''
+        Reference to the value in another store, into which the blob is
+            copied if it is not there yet
+        :param store: store the reference should point into
+        :type store: BlobStore
+        :rtype: BlobRef
+        '''
+        source = self.store or BlobStore()
+        if source == store:
+            return self
+        if self.key not in store:
+            source.copy(self.key, store)
+        ref = self.__class__(self.key, store=store)
+        ref._value = self._value
+        ref._loaded = self._loaded
+        return ref
+
+    def as_dict(self):
+        return {
+            '@module': self.__class__.__module__,
+            '@class': self.__class__.__name__,
+            'key': self.key
+        }
+
+    @classmethod
+    def from_dict(cls, dict_):
+        return cls(key=dict_['key'], store=get_blob_store())
+
+    @staticmethod
+    def is_ref_dict(value):
+        '''
+        Check if a value is the as_dict of a BlobRef which was not
+            decoded, e.g. because it is nested in another document
+        '''
+        return (isinstance(value, dict)
+                and value.get('@class') == BlobRef.__name__
+                and 'key' in value)
@@ -0,0 +1,221 @@
+import os
+import os.path
+import json
+import time
+import tempfile
+import threading
+
+from monty.json import MontyEncoder, MontyDecoder
+
+from .blob import BlobStore, use_blob_store
+from .hash import file_identity
+
+CACHE_DIRECTORY = os.environ.get(
+    'DFTMAN_CACHE', os.path.join(os.path.expanduser('~'), '.dftman', 'cache'))
+
+_RESULT_CACHE = None
+
+
+def set_result_cache(cache):
+    '''
+    Enable (or disable) the result cache used when running jobs, e.g.
+        set_result_cache(ResultCache()) to share results between all
+        projects of a user
+    :param cache: cache, or None to disable caching
+    :type cache: ResultCache
+    '''
+    global _RESULT_CACHE
+    _RESULT_CACHE = cache
+
+
+def get_result_cache():
+    '''
+    Get the cache set with set_result_cache
+    :rtype: ResultCache | None
+    '''
+    return _RESULT_CACHE
+
+
+def restore_from_cache(job):
+    '''
+    Complete a job from the result cache, if caching is enabled and the
+        cache holds a result for its calculation
+    :param job: job about to be run
+    :returns: True if the job was completed from the cache
+    :rtype: bool
+    '''
+    cache = get_result_cache()
+    return cache is not None and cache.restore(job)
+
+
+def store_in_cache(job):
+    '''
+    Store the result of a job in the result cache, if caching is enabled
+        and the job succeeded
+    :param job: job with a parsed output
+    :returns: True if the result was stored
+    :rtype: bool
+    '''
+    cache = get_result_cache()
+    return cache is not None and cache.store(job)
+
+
+class ResultCache(object):
+    '''
+    Cache of calculation results shared between projects (i.e. databases),
+        keyed by the hash of the calculation. Each entry holds the parsed
+        output of a successful calculation and its key files (by default
+        its input and output files), whose contents are kept in a
+        BlobStore inside the cache directory.
+    Jobs are completed from the cache instead of being run when a cache is
+        enabled with set_result_cache, and successful results are stored
+        when they are parsed.
+    :param directory: cache directory, defaults to $DFTMAN_CACHE or
+        ~/.dftman/cache
+    :type directory: str
+    :param files: names of additional files in the job directory to
+        store with each result, e.g. 'pwscf.save/data-file-schema.xml'
+    :type files: list
+    '''
+    def __init__(self, directory=None, files=None):
+        self.directory = directory or CACHE_DIRECTORY
+        self.files = list(files or [])
+        self.blobs = BlobStore(os.path.join(self.directory, 'blobs'))
+        self.hits = 0
+        self.misses = 0
+        # Jobs are restored from the threads of run_batch
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'ResultCache({}, hits={}, misses={})'.format(
+            self.directory, self.hits, self.misses)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def path(self, key):
+        '''
+        Path of the entry for a calculation hash
+        :rtype: str
+        '''
+        return os.path.join(self.directory, 'results', key[:2],
+                            key + '.json')
+
+    def stats(self):
+        '''
+        Hit and miss counts of this cache object
+        :rtype: dict
+        '''
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {'hits': hits, 'misses': misses,
+                'hit_rate': hits / lookups if lookups else None}
+
+    def get(self, key):
+        '''
+        Look up the entry for a calculation hash
+        :param key: hash of the calculation
+        :type key: str
+        :returns: {'output': encoded output, 'files': {name: blob key},
+            'input_name': str, 'output_name': str, 'created': time}, or
+            None on a miss
+        :rtype: dict | None
+        '''
+        try:
+            with open(self.path(key), 'r') as handle:
+                entry = json.load(handle)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry
+
+    def store(self, job):
+        '''
+        Store the output and key files of a job which succeeded
+        :param job: job with a parsed output
+        :returns: True if the result was stored
+        :rtype: bool
+        '''
+        output = job.calculation.output
+        if output is None:
+            return False
+        succeeded = getattr(output, 'succeeded', (True, []))
+        if not succeeded[0]:
+            return False
+        key = job.calculation.hash
+        if key in self:
+            return True
+
+        files = {}
+        for name in [job.input_name, job.output_name] + self.files:
+            path = os.path.join(job.directory, name)
+            if os.path.exists(path):
+                with open(path, 'rb') as handle:
+                    files[name] = self.blobs.put_bytes(handle.read())
+        # Large output properties go into the blob store of the cache
+        with use_blob_store(self.blobs):
+            encoded = json.loads(json.dumps(output, cls=MontyEncoder))
+        entry = {'output': encoded, 'files': files,
+                 'input_name': job.input_name, 'output_name': job.output_name,
+                 'created': time.time()}
+
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as handle:
+            json.dump(entry, handle)
+        os.replace(tmp_path, path)
+        return True
+
+    def restore(self, job):
+        '''
+        Complete a job from the cache by writing its key files into its
+            directory and setting its output and status. The input and
+            output files are written under the names the job uses, which
+            may differ from those of the job the result came from (e.g.
+            dftman.stdout of a SubmitJob for the output of a PBSJob).
+        :param job: job about to be run
+        :returns: True on a hit
+        :rtype: bool
+        '''
+        entry = self.get(job.calculation.hash)
+        if entry is None:
+            return False
+
+        if not os.path.exists(job.directory):
+            os.makedirs(job.directory)
+        names = {entry.get('input_name'): job.input_name,
+                 entry.get('output_name'): job.output_name}
+        for name, blob_key in entry['files'].items():
+            path = os.path.join(job.directory, names.get(name, name))
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as handle:
+                handle.write(self.blobs.get_bytes(blob_key))
+        # Blobs are copied into the project's store when the job is stored
+        with use_blob_store(self.blobs):
+            output = MontyDecoder().process_decoded(entry['output'])
+        output_path = os.path.join(job.directory, job.output_name)
+        if hasattr(output, 'filename') and os.path.exists(output_path):
+            # Point the output (and its deferred properties, which are
+            # parsed from it) at the restored file instead of the file
+            # of the project the result came from
+            output.filename = output_path
+            if getattr(output, 'identity', None) is not None:
+                output.identity = file_identity(output_path)
+        calculation = job.calculation
+        calculation.output_name = job.output_name
+        calculation.directory = job.directory
+        calculation.output = output
+        job.status['status'] = 'Complete'
+        job.status['cached'] = True
+        job.submitted = True
+        job.submission_time = time.asctime(time.gmtime())
+        print('Restored job hash {} from the result cache'
+              .format(job.calculation.hash))
+        return True
@@ -1,7 +1,21 @@
 # TODO: rename hash to uuid
+import os
+import json
 import hashlib
 from collections import OrderedDict
 
+# Scheme used by hash_dict, see set_hash_version. The legacy scheme stays
+# the default, as the hashes name the jobs and directories of projects.
+HASH_VERSION = 1
+HASH_VERSIONS = (1, 2)
+
+# Chunks of bytes buffered before they are fed to blake2b
+_FLUSH_CHUNKS = 4096
+
+# Bytes at the start of a file which are hashed by file_identity
+FILE_PREFIX_SIZE = 65536
+
+
 def sort_recursive(var0):
     '''
     Sort a dictionary recursively into a nested
@@ -21,24 +35,263 @@ def sort_recursive(var0):
         return var0
     return sorted_
 
+def set_hash_version(version):
+    '''
+    Set the scheme used by hash_dict
+        1 (default): legacy scheme, which hashes the repr of
+           sort_recursive's OrderedDicts as printed before Python 3.12
+        2: canonical scheme, see CanonicalHasher. It is faster and does
+           not depend on the Python version, but gives different hashes:
+           only opt in for new projects, as calculations stored with the
+           legacy scheme are no longer found as duplicates (check_stored)
+           and their hash-named job and workflow directories change.
+    :param version: hash scheme version
+    :type version: int
+    :returns: None
+    '''
+    global HASH_VERSION
+    if version not in HASH_VERSIONS:
+        raise ValueError('Unknown hash version {}, use one of {}'
+                         .format(version, HASH_VERSIONS))
+    HASH_VERSION = version
+
+def dftman_hasher():
+    '''
+    Hash object for DFTman
+    :return: 12-byte blake2b hash object
+    '''
+    return hashlib.blake2b(digest_size=12, salt=b'htdft')
+
 def dftman_hash(bytes_):
     '''
     Hash function for DFTman
     :param bytes_: bytes to hash
     :return: 12-byte blake2b hex hash digest
     '''
-    blake2b_hash = hashlib.blake2b(digest_size=12, salt=b'htdft')
+    blake2b_hash = dftman_hasher()
     blake2b_hash.update(bytes_)
     return str(blake2b_hash.hexdigest())
 
-def hash_dict(dict_):
+def file_identity(path, prefix_size=FILE_PREFIX_SIZE):
+    '''
+    Identity of a file which changes when the file is changed or replaced:
+        its absolute path, size, modification time and the hash of its
+        first bytes
+    :param path: path to the file
+    :type path: str
+    :param prefix_size: number of bytes to hash
+    :type prefix_size: int
+    :return: {'path': str, 'size': int, 'mtime': int (ns),
+        'prefix_hash': str}
+    :rtype: dict
+    '''
+    stat = os.stat(path)
+    with open(path, 'rb') as handle:
+        prefix = handle.read(prefix_size)
+    return {'path': os.path.abspath(path), 'size': stat.st_size,
+            'mtime': stat.st_mtime_ns, 'prefix_hash': dftman_hash(prefix)}
+
+
+class CanonicalHasher(object):
+    '''
+    Streams a canonical serialization of a value into blake2b without
+        building intermediate copies of it. Dictionaries are serialized
+        with sorted keys (and without '@version' keys, which only record
+        library versions), lists and tuples alike, floats in their
+        shortest round-trip form with -0.0 folded into 0.0, numpy
+        scalars and arrays as the equivalent Python values and other
+        objects through their as_dict.
+    '''
+    def __init__(self):
+        self._hash = dftman_hasher()
+        self._chunks = []
+
+    def update(self, value):
+        '''
+        Add a value to the hash
+        :param value: JSON-like value or object with an as_dict method
+        :returns: self
+        '''
+        _canonical(value, self._chunks, self._flush)
+        return self
+
+    def hexdigest(self):
+        self._flush()
+        return str(self._hash.hexdigest())
+
+    def _flush(self):
+        self._hash.update(b''.join(self._chunks))
+        del self._chunks[:]
+
+
+def _canonical_bytes(value):
+    chunks = []
+    _canonical(value, chunks, lambda: None)
+    return b''.join(chunks)
+
+def _canonical_float(value):
+    value = float(value)
+    if value == 0.:
+        value = 0.  # -0.0
+    if value != value:
+        return b'dnan;'
+    return b'd%s;' % repr(value).encode('ascii')
+
+def _canonical(value, chunks, flush):
+    '''
+    Append the canonical serialization of a value to chunks of bytes,
+        calling flush every _FLUSH_CHUNKS chunks, see CanonicalHasher
+    '''
+    cls = value.__class__
+    if cls is float:
+        chunks.append(_canonical_float(value))
+    elif cls is str:
+        encoded = value.encode('utf-8')
+        chunks.append(b's%d:%s' % (len(encoded), encoded))
+    elif cls is list or cls is tuple:
+        chunks.append(b'[')
+        for item in value:
+            if item.__class__ is float:
+                chunks.append(_canonical_float(item))
+            else:
+                _canonical(item, chunks, flush)
+        chunks.append(b']')
+        if len(chunks) > _FLUSH_CHUNKS:
+            flush()
+    elif isinstance(value, dict):
+        keys = [key for key in value if key != '@version']
+        if all(key.__class__ is str for key in keys):
+            keys.sort()
+            separator = b'{'
+            for key in keys:
+                encoded = key.encode('utf-8')
+                chunks.append(b'%ss%d:%s:' % (separator, len(encoded),
+                                              encoded))
+                _canonical(value[key], chunks, flush)
+                separator = b','
+        else:
+            items = sorted((_canonical_bytes(key), key) for key in keys)
+            for i, (encoded, key) in enumerate(items):
+                chunks.append(b',' if i else b'{')
+                chunks.append(encoded)
+                chunks.append(b':')
+                _canonical(value[key], chunks, flush)
+        chunks.append(b'}' if keys else b'{}')
+    elif value is None:
+        chunks.append(b'n')
+    elif value is True:
+        chunks.append(b't')
+    elif value is False:
+        chunks.append(b'f')
+    elif isinstance(value, int):
+        chunks.append(b'i%d;' % value)
+    elif isinstance(value, float):
+        chunks.append(_canonical_float(value))
+    elif isinstance(value, str):
+        _canonical(str(value), chunks, flush)
+    elif isinstance(value, (list, tuple)):
+        _canonical(list(value), chunks, flush)
+    elif isinstance(value, (set, frozenset)):
+        chunks.append(b'[')
+        chunks.extend(sorted(_canonical_bytes(item) for item in value))
+        chunks.append(b']')
+    elif hasattr(value, 'tolist'):
+        # numpy arrays and scalars
+        _canonical(value.tolist(), chunks, flush)
+    elif hasattr(value, 'as_dict'):
+        _canonical(value.as_dict(), chunks, flush)
+    else:
+        raise TypeError('Cannot hash {} objects'
+                        .format(value.__class__.__name__))
+
+
+def _legacy_repr(value, chunks):
+    '''
+    Append the repr of sort_recursive(value) as printed by Python < 3.12
+        to chunks without building the OrderedDicts
+    '''
+    if isinstance(value, dict):
+        if not value:
+            chunks.append('OrderedDict()')
+            return
+        chunks.append('OrderedDict([')
+        for i, (key, item) in enumerate(sorted(value.items())):
+            if i:
+                chunks.append(', ')
+            chunks.append('(')
+            chunks.append(repr(key))
+            chunks.append(', ')
+            _legacy_repr(item, chunks)
+            chunks.append(')')
+        chunks.append('])')
+    elif isinstance(value, (list, set, tuple)):
+        chunks.append('(')
+        for i, item in enumerate(value):
+            if i:
+                chunks.append(', ')
+            _legacy_repr(item, chunks)
+        if len(value) == 1:
+            chunks.append(',')
+        chunks.append(')')
+    else:
+        chunks.append(repr(value))
+
+def hash_dict(dict_, version=None):
     '''
-    Hash a dictionary relatively determinstically
-        by sorting it recursively (using sort_recursive)
-        then hashing it using blake2b (using dftman_hash)
+    Hash a dictionary deterministically
+        Version 2 streams a canonical serialization into blake2b
+        (see CanonicalHasher), version 1 is the legacy scheme which
+        sorts the dictionary recursively (see sort_recursive) and hashes
+        its string representation with blake2b (using dftman_hash)
     :param dict_: dictionary to hash
-    :return: 12-byte blake2b hex hash digest from dftma_hash
+    :param version: hash scheme version, defaults to HASH_VERSION
+    :type version: int
+    :return: 12-byte blake2b hex hash digest from dftman_hash
+    '''
+    version = version or HASH_VERSION
+    if version == 1:
+        if isinstance(dict_, (dict, list, set, tuple)):
+            chunks = []
+            _legacy_repr(dict_, chunks)
+        else:
+            chunks = [str(dict_)]
+        return dftman_hash(''.join(chunks).encode())
+    elif version == 2:
+        return CanonicalHasher().update(dict_).hexdigest()
+    raise ValueError('Unknown hash version {}'.format(version))
+
+
+class CachedHash(object):
     '''
-    sorted_dict = sort_recursive(dict_)
-    hash_bytes = bytes(str(sorted_dict).encode())
-    return dftman_hash(hash_bytes)
\ No newline at end of file
+    Mixin which computes the hash property of an object once and caches
+        it until an attribute it depends on is set, the hash version is
+        changed or invalidate_hash is called.
+    Subclasses implement _compute_hash and may restrict _hash_attributes
+        to the attributes the hash depends on (all attributes if None).
+        Changes made in place, e.g. to a Structure or a dictionary of
+        input parameters, cannot be detected: call invalidate_hash
+        after them.
+    '''
+    _hash_attributes = None
+
+    def __setattr__(self, name, value):
+        if self._hash_attributes is None or name in self._hash_attributes:
+            object.__setattr__(self, '_hash', None)
+        super(CachedHash, self).__setattr__(name, value)
+
+    @property
+    def hash(self):
+        cached = getattr(self, '_hash', None)
+        if cached is None or cached[0] != HASH_VERSION:
+            cached = (HASH_VERSION, self._compute_hash())
+            object.__setattr__(self, '_hash', cached)
+        return cached[1]
+
+    def invalidate_hash(self):
+        '''
+        Forget the cached hash
+        '''
+        object.__setattr__(self, '_hash', None)
+
+    def _compute_hash(self):
+        raise NotImplementedError
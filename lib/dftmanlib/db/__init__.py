@@ -1,3 +1,10 @@
-from .db import (load_db, MSONStorage, MSONStorageProxy, MSONTable)
+from .db import (load_db, close_db, close_all_dbs, set_default_db,
+                 MSONStorage, MSONStorageProxy, MSONTable, LazyDocuments,
+                 ConflictError)
+from .log import MSONLogStorage
+from .sqlite import SQLiteStorage, migrate_tinydb
 
-__all__ = ['load_db', 'MSONStorage', 'MSONStorageProxy', 'MSONTable']
+__all__ = ['load_db', 'close_db', 'close_all_dbs', 'set_default_db',
+           'MSONStorage', 'MSONStorageProxy', 'MSONTable', 'LazyDocuments',
+           'ConflictError',
+           'MSONLogStorage', 'SQLiteStorage', 'migrate_tinydb']
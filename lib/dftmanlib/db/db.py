@@ -6,27 +6,60 @@ from ..pwscf.workflow import EOSWorkflow
 import os.path
 import codecs
 import json
+import threading
 import warnings
 
-from collections.abc import Mapping
+from collections.abc import Mapping, MutableMapping
+from contextlib import contextmanager, nullcontext
 
 from tinydb import TinyDB, Query, Storage, where
 from tinydb.database import Table, StorageProxy, _get_doc_id, _get_doc_ids
+from tinydb.utils import freeze
 
 from monty.json import MontyEncoder, MontyDecoder
 
+try:
+    import fcntl
+except ImportError:  # e.g. on Windows, only threads are locked out then
+    fcntl = None
+
 DB_PATH = 'db.tinydb'
+DB_STORAGE = None  # defaults to MSONStorage
+
+_DB_CACHE = {}  # realpath: TinyDB
+
+def set_default_db(path=None, storage=None):
+    '''
+    Set the database path and storage class used by load_db when
+        they are not given explicitly, e.g. by Jobs and Workflows
+    :param path: default database path
+    :type path: str
+    :param storage: default TinyDB storage class, e.g. MSONStorage
+        or dftmanlib.db.MSONLogStorage
+    :type storage: type
+    :returns: None
+    '''
+    global DB_PATH, DB_STORAGE
+    if path is not None:
+        DB_PATH = path
+        base.set_blobs_directory(base.blobs_directory(path))
+    if storage is not None:
+        DB_STORAGE = storage
 
-def init_db(path=DB_PATH,):
+def init_db(path=None, storage=None):
     '''
     Initialize a TinyDB database for DFTman
     :param path: path to initialize database at
     :type path: str
+    :param storage: TinyDB storage class
+    :type storage: type
     :returns: TinyDB database
     :rtype: TinyDB
     '''
+    path = path or DB_PATH
+    storage = storage or DB_STORAGE or MSONStorage
     if not os.path.exists(path):
-        db = TinyDB(path, storage=MSONStorage,
+        db = TinyDB(path, storage=storage,
                     storage_proxy_class=MSONStorageProxy,
                     table_class=MSONTable)
     else:
@@ -34,22 +67,63 @@ def init_db(path=DB_PATH,):
         db = TinyDB(path)
     return db
 
-def load_db(path=DB_PATH, init=True):
+def load_db(path=None, init=True, storage=None, cached=True):
     '''
     Load a TinyDB database for DFTman
+    By default, one database handle per path is shared by the whole
+        process, so repeated calls reuse the already decoded documents.
+        The handle is reopened if the file was deleted or replaced, and
+        its storage re-reads the file if another process modified it.
     :param path: path to initialize (or load) database from
     :type path: str
+    :param storage: TinyDB storage class
+    :type storage: type
+    :param cached: reuse the process-wide handle for path if True
+    :type cached: bool
     :returns: TinyDB database
     :rtype: TinyDB
     '''
+    path = path or DB_PATH
+    storage = storage or DB_STORAGE or MSONStorage
+    key = os.path.realpath(path)
+    if cached:
+        db = _DB_CACHE.get(key)
+        if db is not None:
+            if (db._opened and type(db.storage) is storage
+                    and not db.storage.stale()):
+                return db
+            close_db(path)
     if os.path.exists(path):
-        return TinyDB(path, storage=MSONStorage,
-                      storage_proxy_class=MSONStorageProxy,
-                      table_class=MSONTable)
+        db = TinyDB(path, storage=storage,
+                    storage_proxy_class=MSONStorageProxy,
+                    table_class=MSONTable)
     elif init:
-        return init_db(path)
+        db = init_db(path, storage)
     else:
         raise FileNotFoundError('{} does not exist.')
+    if cached:
+        _DB_CACHE[key] = db
+    return db
+
+def close_db(path=None):
+    '''
+    Close and forget the process-wide database handle for a path
+    :param path: path of the database
+    :type path: str
+    :returns: None
+    '''
+    path = path or DB_PATH
+    db = _DB_CACHE.pop(os.path.realpath(path), None)
+    if db is not None and db._opened:
+        db.close()
+
+def close_all_dbs():
+    '''
+    Close and forget all process-wide database handles
+    :returns: None
+    '''
+    for path in list(_DB_CACHE):
+        close_db(path)
 
 def touch(fname, create_dirs):
     '''
@@ -71,48 +145,430 @@ def touch(fname, create_dirs):
             os.utime(fname, None)
                 
                 
+def resolve_field(document, field):
+    '''
+    Resolve a dotted field path like 'metadata.strain' on a document.
+        Attributes are preferred over items so that e.g. Jobs do not
+        have to build their full as_dict() to resolve 'hash'
+    :param document: document to resolve the field on
+    :param field: dotted field path
+    :type field: str
+    :returns: the value of the field
+    :raises KeyError: if the field does not exist on the document
+    '''
+    value = document
+    for part in field.split('.'):
+        if not isinstance(value, dict) and hasattr(value, part):
+            value = getattr(value, part)
+        else:
+            try:
+                value = value[part]
+            except (IndexError, TypeError):
+                raise KeyError(field)
+    return value
+                
+                
 class AlreadyStoredError(Exception):
     pass
 
 
+class ConflictError(Exception):
+    '''
+    Raised by MSONTable.write_back if a document was changed by someone
+        else since it was read
+    '''
+    def __init__(self, doc_id, expected, current):
+        self.doc_id = doc_id
+        self.expected = expected
+        self.current = current
+        super(ConflictError, self).__init__(
+            'Document {} is at version {}, but version {} was read'
+            .format(doc_id, current, expected))
+
+
+class FileLock(object):
+    '''
+    Reentrant advisory lock (fcntl.flock) on a lock file, which excludes
+        other processes as well as other threads of this process
+    e.g.
+        with FileLock('db.tinydb.lock'):
+            ...
+    :param path: path to the lock file, created if it does not exist
+    :type path: str
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._handle = None
+        self._depth = 0
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            if not self._depth and fcntl is not None:
+                handle = open(self.path, 'a')
+                try:
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+                except BaseException:
+                    handle.close()
+                    raise
+                self._handle = handle
+        except BaseException:
+            self._lock.release()
+            raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if not self._depth and self._handle is not None:
+            fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+            self._handle.close()
+            self._handle = None
+        self._lock.release()
+
+
+class DocumentEncoder(MontyEncoder):
+    '''
+    MontyEncoder which also stores the version of the documents of a
+        table (see MSONTable.write_back) as '@doc_version'
+    '''
+    def default(self, o):
+        dict_ = super(DocumentEncoder, self).default(o)
+        version = getattr(o, 'doc_version', None)
+        if version is not None and isinstance(dict_, dict):
+            dict_['@doc_version'] = version
+        return dict_
+
+
+class MSONIndex(object):
+    '''
+    Secondary index from the values of one field to the doc_ids of
+        the documents in a table which have that value
+    :param field: dotted field path, e.g. 'hash' or 'metadata.strain'
+    :type field: str
+    '''
+    def __init__(self, field):
+        self.field = field
+        self._doc_ids = {}  # value: set of doc_ids
+        self._values = {}  # doc_id: value
+
+    def add(self, doc_id, document):
+        self.remove(doc_id)
+        try:
+            value = freeze(resolve_field(document, self.field))
+            self._doc_ids.setdefault(value, set()).add(doc_id)
+        except (KeyError, TypeError):
+            # Missing or unhashable values are not indexed
+            return
+        self._values[doc_id] = value
+
+    def remove(self, doc_id):
+        if doc_id not in self._values:
+            return
+        value = self._values.pop(doc_id)
+        doc_ids = self._doc_ids[value]
+        doc_ids.discard(doc_id)
+        if not doc_ids:
+            del self._doc_ids[value]
+
+    def lookup(self, value):
+        try:
+            return sorted(self._doc_ids.get(freeze(value), ()))
+        except TypeError:
+            return []
+
+
+class _Raw(object):
+    '''
+    Undecoded document held by LazyDocuments
+    '''
+    __slots__ = ('value', 'loaded')
+
+    def __init__(self, value):
+        self.value = value
+        self.loaded = isinstance(value, dict)
+
+    def load(self, loads):
+        if not self.loaded:
+            self.value = loads(self.value)
+            self.loaded = True
+        return self.value
+
+
+class LazyDocuments(MutableMapping):
+    '''
+    Documents of a table, keyed by doc_id, which are only turned into
+        objects by MontyDecoder when they are first accessed.
+        Queries and indexes can look at the plain JSON dict of a document
+        with peek instead, so searching thousands of jobs only decodes
+        (and builds the pymatgen objects of) the ones which match.
+    :param loads: function turning a raw document, e.g. a JSON string,
+        into a plain dict, or None if raw documents already are dicts
+    :type loads: callable
+    :param blobs: blob store of the database, from which the BlobRefs of
+        the documents are loaded
+    :type blobs: dftmanlib.base.BlobStore
+    '''
+
+    def __init__(self, loads=None, blobs=None):
+        self._documents = {}  # doc_id: _Raw or decoded document
+        self._loads = loads
+        self._blobs = blobs
+
+    @classmethod
+    def from_documents(cls, documents, loads=None, blobs=None):
+        '''
+        Wrap already decoded documents
+        :param documents: {doc_id: document}
+        :type documents: dict
+        '''
+        if isinstance(documents, LazyDocuments):
+            return documents
+        lazy = cls(loads=loads, blobs=blobs)
+        for doc_id, document in documents.items():
+            lazy[int(doc_id)] = document
+        return lazy
+
+    def set_raw(self, doc_id, raw):
+        '''
+        Store an undecoded document
+        :param doc_id: doc_id of the document
+        :type doc_id: int
+        :param raw: JSON dict of the document, or anything loads accepts
+        '''
+        self._documents[doc_id] = _Raw(raw)
+
+    def is_decoded(self, doc_id):
+        return not isinstance(self._documents[doc_id], _Raw)
+
+    def peek(self, doc_id):
+        '''
+        Get a document without decoding it
+        :param doc_id: doc_id of the document
+        :type doc_id: int
+        :returns: the JSON dict of the document, or the document itself
+            if it is already decoded
+        '''
+        document = self._documents[doc_id]
+        if isinstance(document, _Raw):
+            return document.load(self._loads)
+        return document
+
+    def load(self, doc_ids=None):
+        '''
+        Decode documents ahead of access
+        :param doc_ids: doc_ids to decode, all documents if None
+        :type doc_ids: list
+        '''
+        for doc_id in list(self if doc_ids is None else doc_ids):
+            self[doc_id]
+
+    def raw_items(self):
+        '''
+        Iterate over (doc_id, document) without decoding anything,
+            see peek
+        '''
+        for doc_id in self._documents:
+            yield doc_id, self.peek(doc_id)
+
+    def __getitem__(self, doc_id):
+        document = self._documents[doc_id]
+        if isinstance(document, _Raw):
+            raw = document.load(self._loads)
+            with base.use_blob_store(self._blobs):
+                document = MontyDecoder().process_decoded(raw)
+            try:
+                document.doc_id = doc_id
+                document.doc_version = raw.get('@doc_version', 0)
+            except AttributeError:
+                pass
+            self._documents[doc_id] = document
+        return document
+
+    def __setitem__(self, doc_id, document):
+        self._documents[doc_id] = document
+
+    def __delitem__(self, doc_id):
+        del self._documents[doc_id]
+
+    def __iter__(self):
+        return iter(self._documents)
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._documents
+
+
+def _peek(data):
+    '''
+    Get a function returning a document of table data by doc_id without
+        decoding it, see LazyDocuments.peek
+    '''
+    if isinstance(data, LazyDocuments):
+        return data.peek
+    return data.__getitem__
+
+
 class MSONStorage(Storage):
     """
     Store the data in a MSON file.
     """
 
-    def __init__(self, path, create_dirs=False, encoding=None, **kwargs):
+    def __init__(self, path, create_dirs=False, encoding=None, lazy=False,
+                 **kwargs):
         """
         Create a new instance.
         Also creates the storage file, if it doesn't exist.
         :param path: Where to store the MSON data.
         :type path: str
+        :param lazy: only decode documents when they are accessed,
+            see LazyDocuments
+        :type lazy: bool
+
+        Reads and writes are serialized between processes by a FileLock
+        on path + '.lock'.
         """
         touch(path, create_dirs=create_dirs)  # Create file if not exists
+        self.path = path
+        self.lazy = lazy
         self.kwargs = kwargs
+        self.blobs = base.BlobStore(base.blobs_directory(path))
         self._handle = codecs.open(path, 'r+', encoding=encoding)
+        self._lock = FileLock(path + '.lock')
+        # Decoded data and the (mtime, size) of the file it came from
+        self._cache = None
+        self._cache_signature = None
+        # Incremented every time the data is (re)loaded from the file
+        self.generation = 0
+        # Transaction nesting depth and whether writes are buffered
+        self._depth = 0
+        self._dirty = False
 
     def close(self):
         self._handle.close()
 
+    def stale(self):
+        """
+        Check if the file was deleted or replaced since it was opened
+
+        :returns: True if the handle no longer points to path
+        :rtype: bool
+        """
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return True
+        return inode != os.fstat(self._handle.fileno()).st_ino
+
+    def _signature(self):
+        stat = os.fstat(self._handle.fileno())
+        return (stat.st_mtime_ns, stat.st_size, self._write_count())
+
+    def _write_count(self):
+        # Number of writes so far, kept in the lock file because two
+        # writes can happen within the resolution of st_mtime
+        try:
+            with open(self._lock.path) as handle:
+                return int(handle.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def locked(self):
+        '''
+        Lock out other processes and threads from the file, e.g. around
+            read-modify-write cycles. Reentrant.
+        :returns: the lock as a context manager
+        :rtype: FileLock
+        '''
+        return self._lock
+
     def read(self):
-        # Get the file size
-        self._handle.seek(0, os.SEEK_END)
-        size = self._handle.tell()
+        with self._lock:
+            if self._dirty:
+                return self._cache
+            signature = self._signature()
+            if (self._cache is not None
+                    and signature == self._cache_signature):
+                return self._cache
 
-        if not size:
-            # File is empty
-            return None
-        else:
-            self._handle.seek(0)
-            return json.load(self._handle, cls=MontyDecoder)
+            # Get the file size
+            self._handle.seek(0, os.SEEK_END)
+            size = self._handle.tell()
+
+            if not size:
+                # File is empty
+                return None
+            else:
+                self._handle.seek(0)
+                self._cache = {}
+                for table, documents in json.load(self._handle).items():
+                    self._cache[table] = LazyDocuments(blobs=self.blobs)
+                    for doc_id, document in documents.items():
+                        self._cache[table].set_raw(int(doc_id), document)
+                    if not self.lazy:
+                        self._cache[table].load()
+                self._cache_signature = signature
+                self.generation += 1
+                return self._cache
 
     def write(self, data):
-        self._handle.seek(0)
-        serialized = json.dumps(data, cls=MontyEncoder, **self.kwargs)
-        self._handle.write(serialized)
-        self._handle.flush()
-        os.fsync(self._handle.fileno())
-        self._handle.truncate()
+        data = {table: LazyDocuments.from_documents(documents,
+                                                    blobs=self.blobs)
+                for table, documents in data.items()}
+        with self._lock:
+            if self._depth:
+                self._cache = data
+                self._dirty = True
+                return
+            self._handle.seek(0)
+            # Undecoded documents are written back as they were read
+            with base.use_blob_store(self.blobs):
+                serialized = json.dumps(
+                    {table: dict(documents.raw_items())
+                     for table, documents in data.items()},
+                    cls=DocumentEncoder, **self.kwargs)
+            self._handle.write(serialized)
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+            self._handle.truncate()
+            count = self._write_count() + 1
+            with open(self._lock.path, 'w') as handle:
+                handle.write(str(count))
+            self._cache = data
+            self._cache_signature = self._signature()
+
+    @contextmanager
+    def transaction(self, rollback=True):
+        """
+        Buffer all writes in memory and write them to the file at once,
+        with a single fsync, when the outermost transaction exits.
+        Nested transactions join the outermost one. Other processes are
+        locked out of the file for the whole transaction.
+
+        :param rollback: if True, buffered writes are discarded if an
+            exception is raised, otherwise they are still written
+        :type rollback: bool
+        """
+        with self._lock:
+            self._depth += 1
+            failed = False
+            try:
+                yield self
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                self._depth -= 1
+                if not self._depth and self._dirty:
+                    self._dirty = False
+                    if failed and rollback:
+                        # Reload from the file on the next read
+                        self._cache = None
+                    else:
+                        self.write(self._cache)
 
 
 class MSONStorageProxy(StorageProxy):
@@ -126,9 +582,294 @@ class MSONStorageProxy(StorageProxy):
         value.doc_id = doc_id
         return value
 
+    def read(self):
+        raw_data = self._storage.read() or {}
+        documents = raw_data.get(self._table_name)
+        if isinstance(documents, LazyDocuments):
+            # Hand out the storage's documents as they are, so that
+            # nothing gets decoded before it is accessed
+            return documents
+        return super(MSONStorageProxy, self).read()
+
+    def write(self, data):
+        if isinstance(data, LazyDocuments):
+            raw_data = self._storage.read() or {}
+            raw_data[self._table_name] = data
+            self._storage.write(raw_data)
+        else:
+            super(MSONStorageProxy, self).write(data)
+
+    def write_documents(self, data, doc_ids):
+        '''
+        Write only the documents with the given doc_ids, falling back
+        to writing the whole table if the storage has no partial writes
+        :param data: table data including the changed documents,
+            documents missing from data are deleted
+        :type data: dict
+        :param doc_ids: doc_ids of the changed documents
+        :type doc_ids: list
+        '''
+        write_documents = getattr(self._storage, 'write_documents', None)
+        if write_documents is None:
+            return self.write(data)
+        write_documents(self._table_name,
+                        {doc_id: data.get(doc_id) for doc_id in doc_ids})
+
+    @property
+    def generation(self):
+        '''
+        Counter of how often the storage reloaded its data from disk
+        '''
+        return getattr(self._storage, 'generation', None)
+
+    def select(self, cond):
+        '''
+        Let the underlying storage find the doc_ids matching a query,
+        see dftmanlib.db.SQLiteStorage.select
+        :returns: (doc_ids, exact) or None if the storage cannot do it
+        :rtype: tuple | None
+        '''
+        select = getattr(self._storage, 'select', None)
+        if select is None:
+            return None
+        return select(self._table_name, cond)
+
+    def transaction(self, rollback=True):
+        '''
+        Transaction of the underlying storage, see MSONStorage.transaction
+        '''
+        transaction = getattr(self._storage, 'transaction', None)
+        if transaction is None:
+            return nullcontext()
+        return transaction(rollback=rollback)
+
+    def locked(self):
+        '''
+        Lock of the underlying storage, see MSONStorage.locked
+        '''
+        locked = getattr(self._storage, 'locked', None)
+        if locked is None:
+            return nullcontext()
+        return locked()
+
     
 class MSONTable(Table):
 
+    def __init__(self, storage, name, cache_size=10):
+        self._generation = None
+        self._last_id = 0
+        # field: MSONIndex, or None until (re)built from the table data
+        self._indexes = {'hash': None}
+        super(MSONTable, self).__init__(storage, name, cache_size=cache_size)
+
+    @property
+    def indexes(self):
+        '''
+        Fields which are indexed in this table
+        '''
+        return list(self._indexes)
+
+    def create_index(self, field):
+        '''
+        Declare a secondary index on a field, which is kept up to date
+        by insert, write_back and remove and used by search for
+        equality queries on that field
+        :param field: dotted field path, e.g. 'metadata.strain' or
+            'status.status'
+        :type field: str
+        '''
+        self._indexes.setdefault(field, None)
+
+    def drop_index(self, field):
+        '''
+        Remove a secondary index
+        :param field: dotted field path of the index
+        :type field: str
+        '''
+        if field == 'hash':
+            raise ValueError('The hash index is needed by check_stored')
+        self._indexes.pop(field, None)
+
+    def batch(self, rollback=True):
+        '''
+        Context manager which buffers all inserts and write_backs in
+            memory and writes them with one write (and one fsync) on exit.
+            The transaction covers the whole database, not only this table,
+            so it is also available as db.transaction() on a TinyDB loaded
+            with load_db.
+        e.g.
+            with table.batch():
+                for job in jobs:
+                    table.insert(job)
+        :param rollback: if True, the buffered writes are discarded when
+            an exception is raised inside the block, otherwise they are
+            still written. Use rollback=False around operations with
+            side effects outside the database, like submitting jobs.
+        :type rollback: bool
+        '''
+        return self._storage.transaction(rollback=rollback)
+
+    transaction = batch
+
+    def _index(self, field):
+        data = self._read()
+        index = self._indexes[field]
+        if index is None:
+            index = MSONIndex(field)
+            peek = _peek(data)
+            for doc_id in data:
+                index.add(doc_id, peek(doc_id))
+            self._indexes[field] = index
+        return index
+
+    def _update_indexes(self, data, doc_ids):
+        for index in self._indexes.values():
+            if index is None:
+                continue
+            for doc_id in doc_ids:
+                if doc_id in data:
+                    index.add(doc_id, data[doc_id])
+                else:
+                    index.remove(doc_id)
+
+    def _invalidate_indexes(self):
+        for field in self._indexes:
+            self._indexes[field] = None
+
+    def search_index(self, field, value):
+        '''
+        Get all documents whose indexed field equals value
+        :param field: dotted field path of an index
+        :type field: str
+        :param value: value to look up
+        :returns: list of matching documents
+        :rtype: list
+        '''
+        data = self._read()
+        return [data[doc_id] for doc_id in self._index(field).lookup(value)]
+
+    def search(self, cond):
+        """
+        Search for all documents matching a 'where' cond.
+        Equality queries on an indexed field are answered from the index,
+        other queries are pushed down to the storage if it supports it.
+
+        :param cond: the condition to check against
+        :type cond: Query
+        :returns: list of matching documents
+        :rtype: list[Element]
+        """
+        hashval = getattr(cond, 'hashval', None)
+        if hashval and hashval[0] == '==':
+            field = '.'.join(hashval[1])
+            if field in self._indexes:
+                return self.search_index(field, hashval[2])
+        selected = self._storage.select(cond)
+        if selected is not None:
+            doc_ids, exact = selected
+            data = self._read()
+            documents = [data[doc_id] for doc_id in doc_ids
+                         if doc_id in data]
+            if not exact:
+                documents = [doc for doc in documents if cond(doc)]
+            return documents
+
+        data = self._read()
+        if cond in self._query_cache:
+            return self._query_cache.get(cond, [])[:]
+        documents = [data[doc_id] for doc_id in self._match(data, cond)]
+        self._query_cache[cond] = documents
+        return documents[:]
+
+    def all(self):
+        """
+        Get all documents stored in the table.
+
+        :returns: a list with all documents.
+        :rtype: list[Element]
+        """
+        return list(self._read().values())
+
+    def __iter__(self):
+        """
+        Iterate over all documents stored in the table.
+
+        :returns: an iterator over all documents.
+        :rtype: listiterator[Element]
+        """
+        for value in self._read().values():
+            yield value
+
+    def _match(self, data, cond):
+        '''
+        Find the doc_ids of the documents matching cond, evaluating it
+            on the undecoded documents if the storage is lazy
+        '''
+        peek = _peek(data)
+        return [doc_id for doc_id in list(data) if cond(peek(doc_id))]
+
+    def project(self, fields, cond=None):
+        '''
+        Get only some fields of the documents, e.g. the statuses of all
+            jobs, without decoding the documents of a lazy storage
+        :param fields: dotted field paths, e.g. ['status.status']
+        :type fields: list
+        :param cond: only include the documents matching this condition
+        :type cond: Query
+        :returns: {doc_id: {field: value}}, where missing fields are None
+        :rtype: dict
+        '''
+        data = self._read()
+        peek = _peek(data)
+        doc_ids = list(data) if cond is None else self._match(data, cond)
+        projected = {}
+        for doc_id in doc_ids:
+            document = peek(doc_id)
+            projected[doc_id] = {}
+            for field in fields:
+                try:
+                    projected[doc_id][field] = resolve_field(document, field)
+                except KeyError:
+                    projected[doc_id][field] = None
+        return projected
+
+    def _read(self):
+        """
+        Reading access to the DB.
+        If the storage reloaded its data from disk since the last read,
+        e.g. because another process wrote to it, the query cache and
+        the last doc_id are refreshed.
+
+        :returns: all values
+        :rtype: DataProxy
+        """
+        data = self._storage.read()
+        generation = self._storage.generation
+        if generation != self._generation:
+            self._generation = generation
+            self.clear_cache()
+            self._invalidate_indexes()
+            if data:
+                self._last_id = max(self._last_id, max(data))
+        return data
+
+    def _write_documents(self, data, doc_ids):
+        '''
+        Writing access to the DB for a known set of changed documents
+        :param data: table data including the changed documents
+        :type data: DataProxy | dict
+        :param doc_ids: doc_ids of the changed documents
+        :type doc_ids: list
+        '''
+        self.clear_cache()
+        self._storage.write_documents(data, doc_ids)
+        self._update_indexes(data, doc_ids)
+
+    def _write(self, values):
+        self.clear_cache()
+        self._storage.write(values)
+        self._invalidate_indexes()
+
     def check_stored(self, msonable):
         """
         Check if an msonable is already stored
@@ -137,11 +878,7 @@ class MSONTable(Table):
         :returns: doc_ids of matches
         :rtype: list
         """
-        query = Query()
-        hash_ = msonable.hash
-        matches = self.search(query.hash == hash_)
-        doc_ids = [match.doc_id for match in matches]
-        return doc_ids
+        return self._index('hash').lookup(msonable.hash)
     
         
     def insert(self, document, block_if_stored=True):
@@ -152,17 +889,20 @@ class MSONTable(Table):
         :returns: the inserted document's ID
         :rtype: int
         """
-        
-        if block_if_stored:
-            doc_ids = self.check_stored(document)
-            if doc_ids:
-                raise AlreadyStoredError('Already stored at doc_ids {}'
-                                         .format(doc_ids))
+        with self._storage.locked():
+            # Read first to pick up doc_ids taken by other processes
+            data = self._read()
 
-        doc_id = self._get_doc_id(document)
-        data = self._read()
-        data[doc_id] = document
-        self._write(data)
+            if block_if_stored:
+                doc_ids = self.check_stored(document)
+                if doc_ids:
+                    raise AlreadyStoredError('Already stored at doc_ids {}'
+                                             .format(doc_ids))
+
+            doc_id = self._get_doc_id(document)
+            document.doc_version = 1
+            data[doc_id] = document
+            self._write_documents(data, [doc_id])
 
         return doc_id
 
@@ -174,34 +914,61 @@ class MSONTable(Table):
         :returns: a list containing the inserted documents' IDs
         :rtype: list
         """
+        with self._storage.locked():
+            data = self._read()
+
+            if block_if_stored:
+                doc_ids = []
+                for doc in documents:
+                    doc_ids += self.check_stored(doc)
+                if doc_ids:
+                    raise AlreadyStoredError('Already stored at doc_ids {}'
+                                             .format(doc_ids))
 
-        if block_if_stored:
             doc_ids = []
             for doc in documents:
-                doc_ids += self.check_stored(soc)
-            if doc_ids:
-                raise AlreadyStoredError('Already stored at doc_ids {}'
-                                         .format(doc_ids))
-        
-        doc_ids = []
-        data = self._read()
-
-        for doc in documents:
-            doc_id = self._get_doc_id(doc)
-            doc_ids.append(doc_id)
+                doc_id = self._get_doc_id(doc)
+                doc_ids.append(doc_id)
 
-            data[doc_id] = doc
+                doc.doc_version = 1
+                data[doc_id] = doc
 
-        self._write(data)
+            self._write_documents(data, doc_ids)
 
         return doc_ids
-        
-    def write_back(self, documents, doc_ids=None, eids=None):
+
+    def version(self, doc_id):
+        '''
+        Get the version of a stored document, which is incremented every
+            time the document is written
+        :param doc_id: doc_id of the document
+        :type doc_id: int
+        :returns: the version, or None if the document does not exist
+        :rtype: int | None
+        '''
+        data = self._read()
+        if doc_id not in data:
+            return None
+        document = _peek(data)(doc_id)
+        if isinstance(document, dict):
+            return document.get('@doc_version', 0)
+        return getattr(document, 'doc_version', 0)
+
+    def write_back(self, documents, doc_ids=None, eids=None,
+                   on_conflict='raise'):
         """
         Write back documents by doc_id
+        Documents carry the version (doc_version) they had when they were
+        read. If the stored document has a different version, i.e. it was
+        written by someone else in the meantime, on_conflict decides what
+        happens.
         :param documents: a list of document to write back
         :param doc_ids: a list of document IDs which need to be written back
         :type doc_ids: list
+        :param on_conflict: 'raise' to raise a ConflictError, 'overwrite'
+            to write the document anyway, or a function
+            merge(document, stored_document) returning the document to write
+        :type on_conflict: str | callable
         :returns: a list of document IDs that have been written
         :rtype: list
         """
@@ -214,24 +981,102 @@ class MSONTable(Table):
         if doc_ids is None:
             doc_ids = [doc.doc_id for doc in documents]
 
-        # Since this function will write docs back like inserting, to ensure
-        # here only process existing or removed instead of inserting new,
-        # raise error if doc_id exceeded the last.
-        if len(doc_ids) > 0 and max(doc_ids) > self._last_id:
-            raise IndexError(
-                'ID exceeds table length, use existing or removed doc_id.')
+        with self._storage.locked():
+            data = self._read()
 
-        data = self._read()
+            # Since this function will write docs back like inserting, to
+            # ensure here only process existing or removed instead of
+            # inserting new, raise error if doc_id exceeded the last.
+            if len(doc_ids) > 0 and max(doc_ids) > self._last_id:
+                raise IndexError(
+                    'ID exceeds table length, use existing or removed doc_id.')
 
-        # Document specified by ID
-        documents.reverse()
-        for doc_id in doc_ids:
-            data[doc_id] = documents.pop()
-    
-        self._write(data)
+            # Check all documents before writing any of them
+            resolved = []
+            for doc_id, document in zip(doc_ids, documents):
+                expected = getattr(document, 'doc_version', None)
+                current = self.version(doc_id)
+                if expected is not None and current is not None \
+                        and expected != current:
+                    if on_conflict == 'raise':
+                        raise ConflictError(doc_id, expected, current)
+                    elif callable(on_conflict):
+                        document = on_conflict(document, data[doc_id])
+                    elif on_conflict != 'overwrite':
+                        raise ValueError('Unknown on_conflict {}'
+                                         .format(on_conflict))
+                resolved.append((doc_id, document, current))
+
+            # Document specified by ID
+            for doc_id, document, current in resolved:
+                document.doc_version = (current or 0) + 1
+                data[doc_id] = document
+
+            self._write_documents(data, doc_ids)
 
         return doc_ids
 
+    def modify(self, doc_ids, function):
+        '''
+        Apply a function to the current version of documents and write
+            them back, with other processes locked out in between, so the
+            changes cannot conflict with anyone else's, e.g.
+            table.modify([doc_id], lambda job: job.metadata.update(tag=1))
+        :param doc_ids: doc_ids of the documents to modify
+        :type doc_ids: list
+        :param function: function modifying a document in place, or
+            returning the document to write instead
+        :type function: callable
+        :returns: the written documents
+        :rtype: list
+        '''
+        with self._storage.locked():
+            data = self._read()
+            documents = []
+            for doc_id in doc_ids:
+                document = data[doc_id]
+                modified = function(document)
+                if modified is not None:
+                    modified.doc_version = getattr(document, 'doc_version',
+                                                   None)
+                    document = modified
+                documents.append(document)
+            self.write_back(list(documents), doc_ids=list(doc_ids))
+        return documents
+
+    def remove(self, cond=None, doc_ids=None, eids=None):
+        """
+        Remove all matching documents.
+
+        :param cond: the condition to check against
+        :type cond: Query
+        :param doc_ids: a list of document IDs
+        :type doc_ids: list
+        :returns: a list containing the removed document's ID
+        :rtype: list
+        """
+        doc_ids = _get_doc_ids(doc_ids, eids)
+
+        if cond is None and doc_ids is None:
+            raise RuntimeError('Use purge() to remove all documents')
+
+        with self._storage.locked():
+            data = self._read()
+            if doc_ids is None:
+                doc_ids = self._match(data, cond)
+            for doc_id in doc_ids:
+                del data[doc_id]
+
+            self._write_documents(data, doc_ids)
+
+        return doc_ids
+
+    def process_elements(self, func, cond=None, doc_ids=None, eids=None):
+        # Lock the read-modify-write of update() and friends
+        with self._storage.locked():
+            return super(MSONTable, self).process_elements(
+                func, cond=cond, doc_ids=doc_ids, eids=eids)
+
     def get_multiple(self, cond=None, doc_ids=None, eid=None):
         """
         Get many documents specified by a query or and ID.
@@ -249,6 +1094,6 @@ class MSONTable(Table):
             return documents
 
         # Documents specified by condition
-        all_documents = self.all()
-        documents = [doc for doc in all_documents if cond(doc)]
-        return documents
\ No newline at end of file
+        data = self._read()
+        documents = [data[doc_id] for doc_id in self._match(data, cond)]
+        return documents
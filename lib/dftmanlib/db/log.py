@@ -0,0 +1,393 @@
+import os
+import os.path
+import json
+import threading
+import warnings
+
+from contextlib import contextmanager
+
+from tinydb import Storage
+
+from .. import base
+
+from .db import touch, LazyDocuments, FileLock, DocumentEncoder
+
+LOG_COMPACT_THRESHOLD = 16 * 1024 ** 2  # bytes
+LOG_COMPACT_RATIO = 2.0
+
+
+class MSONLogStorage(Storage):
+    '''
+    TinyDB storage which keeps the database as an append-only log of
+        per-document change records instead of a single MSON document.
+        Writes only append the records of the documents which changed,
+        so updating one job costs I/O proportional to that job's
+        document rather than to the whole database.
+    Each line of the log is a JSON header [op, table, doc_id], where op
+        is one of 'create_table', 'drop_table', 'insert', 'update' or
+        'delete', followed by a tab and, for 'insert' and 'update', the
+        MSON-encoded document. The database state is rebuilt by replaying
+        the log when the storage is opened, and records appended by other
+        handles are replayed on the next read.
+    Once the log grows past compact_threshold bytes and is more than
+        compact_ratio times larger than the live documents, it is
+        rewritten in the background to one 'insert' record per document.
+    :param path: path to the log file
+    :type path: str
+    :param create_dirs: create parent directories of path if True
+    :type create_dirs: bool
+    :param encoding: encoding of the log file
+    :type encoding: str
+    :param fsync: fsync the log after every append if True
+    :type fsync: bool
+    :param compact_threshold: log size in bytes above which compaction
+        is considered
+    :type compact_threshold: int
+    :param compact_ratio: ratio of log size to live document size above
+        which the log is compacted
+    :type compact_ratio: float
+    :param lazy: only decode documents when they are accessed,
+        see LazyDocuments
+    :type lazy: bool
+    '''
+
+    def __init__(self, path, create_dirs=False, encoding=None, fsync=True,
+                 compact_threshold=LOG_COMPACT_THRESHOLD,
+                 compact_ratio=LOG_COMPACT_RATIO, lazy=False):
+        touch(path, create_dirs=create_dirs)  # Create file if not exists
+        self.path = path
+        self.blobs = base.BlobStore(base.blobs_directory(path))
+        self.encoding = encoding or 'utf-8'
+        self.fsync = fsync
+        self.lazy = lazy
+        self.compact_threshold = compact_threshold
+        self.compact_ratio = compact_ratio
+
+        # _file_lock excludes other processes from appending or
+        # compacting, _lock protects the in-memory state from other threads
+        self._file_lock = FileLock(path + '.lock')
+        self._lock = threading.RLock()
+        self._compactor = None
+        # Transaction nesting depth and records waiting to be appended
+        self._depth = 0
+        self._pending = []
+        # Incremented every time records written elsewhere are loaded
+        self.generation = 0
+        self._load()
+
+    def close(self):
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+
+    def stale(self):
+        '''
+        Check if the log file was deleted. Replaced or truncated logs are
+            reloaded transparently on the next read.
+        :returns: True if path no longer exists
+        :rtype: bool
+        '''
+        return not os.path.exists(self.path)
+
+    def locked(self):
+        '''
+        Lock out other processes and threads from appending to the log,
+            e.g. around read-modify-write cycles. Reentrant.
+        :returns: the lock as a context manager
+        :rtype: FileLock
+        '''
+        return self._file_lock
+
+    def read(self):
+        with self._lock:
+            self._refresh()
+            return self._data
+
+    def write(self, data):
+        '''
+        Write the full database state by appending records only for
+            the tables and documents which differ from the current state
+        :param data: {table_name: {doc_id: document}}
+        :type data: dict
+        '''
+        with self._file_lock, self._lock:
+            self._refresh()
+            records = []
+            for table in list(self._serialized):
+                if table not in data:
+                    records.append(('drop_table', table, None, None, None))
+            for table, documents in data.items():
+                records += self._diff(table, documents, deleted=True)
+            self._commit(records)
+
+    def write_documents(self, table, documents):
+        '''
+        Write only the given documents of a table
+        :param table: name of the table
+        :type table: str
+        :param documents: {doc_id: document}, where a document of None
+            deletes the doc_id from the table
+        :type documents: dict
+        '''
+        with self._file_lock, self._lock:
+            self._refresh()
+            self._commit(self._diff(table, documents, deleted=False))
+
+    @contextmanager
+    def transaction(self, rollback=True):
+        '''
+        Keep all records in memory and append them to the log at once,
+            with a single fsync, when the outermost transaction exits.
+            Nested transactions join the outermost one. Other processes
+            cannot append to the log during the transaction.
+        :param rollback: if True, the pending records are discarded and
+            the state is reloaded from the log if an exception is raised,
+            otherwise they are still appended
+        :type rollback: bool
+        '''
+        with self._file_lock, self._lock:
+            self._depth += 1
+            failed = False
+            try:
+                yield self
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                self._depth -= 1
+                if not self._depth:
+                    if failed and rollback:
+                        self._pending = []
+                        self._load()
+                    else:
+                        self._flush()
+
+    def compact(self):
+        '''
+        Rewrite the log as one 'insert' record per live document.
+            Records appended while the snapshot is being written are
+            carried over before the new log atomically replaces the old one.
+        '''
+        tmp_path = self.path + '.compact'
+        with self._lock:
+            self._refresh()
+            snapshot = b''.join(
+                self._format(op, table, doc_id, encoded)
+                for op, table, doc_id, encoded in self._snapshot())
+            offset = self._offset
+            inode = self._inode
+
+        with open(tmp_path, 'wb') as handle:
+            handle.write(snapshot)
+            handle.flush()
+            os.fsync(handle.fileno())
+
+        with self._file_lock, self._lock:
+            self._refresh()
+            if self._inode != inode:
+                # Someone else replaced the log in the meantime
+                os.remove(tmp_path)
+                return
+            with open(self.path, 'rb') as handle:
+                handle.seek(offset)
+                tail = handle.read(self._offset - offset)
+            with open(tmp_path, 'ab') as handle:
+                handle.write(tail)
+                handle.flush()
+                os.fsync(handle.fileno())
+            os.replace(tmp_path, self.path)
+            stat = os.stat(self.path)
+            self._inode = stat.st_ino
+            self._offset = stat.st_size
+
+    def _load(self):
+        '''
+        Rebuild the database state by replaying the whole log
+        '''
+        self._data = {}
+        self._serialized = {}
+        self._live_size = 0
+        self._offset = 0
+        self._inode = os.stat(self.path).st_ino
+        self.generation += 1
+        self._replay()
+
+    def _refresh(self):
+        '''
+        Replay records appended to the log by other handles, or reload
+            it entirely if it was replaced or truncated
+        '''
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            touch(self.path, create_dirs=True)
+            return self._load()
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self._load()
+        elif stat.st_size > self._offset:
+            self._replay()
+
+    def _replay(self):
+        '''
+        Apply all complete records after the current offset
+        '''
+        with open(self.path, 'rb') as handle:
+            handle.seek(self._offset)
+            chunk = handle.read()
+        end = chunk.rfind(b'\n') + 1
+        if not end:
+            return
+        self.generation += 1
+        pending = set()
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            header, _, encoded = line.decode(self.encoding).partition('\t')
+            try:
+                op, table, doc_id = json.loads(header)
+            except ValueError:
+                warnings.warn('Skipping corrupt record in {}'
+                              .format(self.path))
+                continue
+            if doc_id is not None:
+                doc_id = int(doc_id)
+            self._apply(op, table, doc_id, encoded or None, None)
+            if op in ('insert', 'update'):
+                pending.add((table, doc_id))
+        self._offset += end
+        if self.lazy:
+            return
+        # Only decode the final version of each changed document
+        for table, doc_id in pending:
+            documents = self._data.get(table, {})
+            if doc_id in documents:
+                documents.load([doc_id])
+
+    def _apply(self, op, table, doc_id, encoded, document):
+        '''
+        Apply one record to the in-memory state
+        '''
+        if op == 'create_table':
+            self._data.setdefault(table, LazyDocuments(json.loads, blobs=self.blobs))
+            self._serialized.setdefault(table, {})
+        elif op == 'drop_table':
+            self._data.pop(table, None)
+            for encoded in self._serialized.pop(table, {}).values():
+                self._live_size -= len(encoded)
+        elif op in ('insert', 'update'):
+            serialized = self._serialized.setdefault(table, {})
+            self._live_size += len(encoded) - len(serialized.get(doc_id, ''))
+            serialized[doc_id] = encoded
+            documents = self._data.setdefault(table, LazyDocuments(json.loads, blobs=self.blobs))
+            if document is None:
+                documents.set_raw(doc_id, encoded)
+            else:
+                documents[doc_id] = document
+        elif op == 'delete':
+            documents = self._data.get(table, {})
+            if doc_id in documents:
+                del documents[doc_id]
+            encoded = self._serialized.get(table, {}).pop(doc_id, None)
+            if encoded is not None:
+                self._live_size -= len(encoded)
+
+    def _diff(self, table, documents, deleted):
+        '''
+        Build the records needed to bring a table to the given documents
+        :param deleted: if True, doc_ids missing from documents are deleted
+        '''
+        records = []
+        serialized = self._serialized.get(table)
+        if serialized is None:
+            records.append(('create_table', table, None, None, None))
+            serialized = {}
+        lazy = isinstance(documents, LazyDocuments)
+        # Our own undecoded documents cannot have changed
+        own = documents is self._data.get(table)
+        if deleted:
+            doc_ids = {int(doc_id) for doc_id in documents}
+            for doc_id in serialized:
+                if doc_id not in doc_ids:
+                    records.append(('delete', table, doc_id, None, None))
+        for key in list(documents):
+            doc_id = int(key)
+            if lazy and not documents.is_decoded(key):
+                if own:
+                    continue
+                document = None
+                encoded = json.dumps(documents.peek(key))
+            else:
+                document = documents[key]
+                if document is None:
+                    if doc_id in serialized:
+                        records.append(('delete', table, doc_id, None, None))
+                    continue
+                with base.use_blob_store(self.blobs):
+                    encoded = json.dumps(document, cls=DocumentEncoder)
+            if serialized.get(doc_id) != encoded:
+                op = 'update' if doc_id in serialized else 'insert'
+                records.append((op, table, doc_id, encoded, document))
+        return records
+
+    def _snapshot(self):
+        for table, serialized in self._serialized.items():
+            yield ('create_table', table, None, None)
+            for doc_id, encoded in serialized.items():
+                yield ('insert', table, doc_id, encoded)
+
+    def _format(self, op, table, doc_id, encoded):
+        line = json.dumps([op, table,
+                           None if doc_id is None else str(doc_id)])
+        if encoded is not None:
+            line += '\t' + encoded
+        return (line + '\n').encode(self.encoding)
+
+    def _commit(self, records):
+        '''
+        Apply records to the in-memory state and append them to the log,
+            or keep them pending until the outermost transaction exits
+        '''
+        if not records:
+            return
+        for record in records:
+            self._apply(*record)
+        self._pending += [self._format(*record[:4]) for record in records]
+        if not self._depth:
+            self._flush()
+
+    def _flush(self):
+        '''
+        Append the pending records to the log
+        '''
+        lines = b''.join(self._pending)
+        self._pending = []
+        if not lines:
+            return
+        with open(self.path, 'a+b') as handle:
+            handle.seek(0, os.SEEK_END)
+            start = handle.tell()
+            if start:
+                # Never continue a torn record left by a crashed writer
+                handle.seek(start - 1)
+                if handle.read(1) != b'\n':
+                    lines = b'\n' + lines
+            handle.write(lines)
+            handle.flush()
+            if self.fsync:
+                os.fsync(handle.fileno())
+        if start == self._offset:
+            self._offset = start + len(lines)
+        else:
+            # Another handle appended in between, replay everything in order
+            self._replay()
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        if self._offset < self.compact_threshold:
+            return
+        if self._offset < self.compact_ratio * self._live_size:
+            return
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self.compact, daemon=True)
+        self._compactor.start()
@@ -0,0 +1,413 @@
+import os
+import os.path
+import json
+import zlib
+import sqlite3
+import argparse
+import threading
+
+from contextlib import contextmanager
+
+from tinydb import Storage
+
+from monty.json import MontyEncoder
+
+from .. import base
+from .db import (DB_PATH, MSONStorage, LazyDocuments, DocumentEncoder,
+                 resolve_field)
+
+SQLITE_DB_PATH = 'db.sqlite'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tables (
+    name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS documents (
+    tbl TEXT NOT NULL,
+    doc_id INTEGER NOT NULL,
+    hash TEXT,
+    class TEXT,
+    status TEXT,
+    meta TEXT,
+    payload BLOB NOT NULL,
+    PRIMARY KEY (tbl, doc_id)
+);
+CREATE INDEX IF NOT EXISTS documents_hash ON documents (tbl, hash);
+CREATE INDEX IF NOT EXISTS documents_class ON documents (tbl, class);
+CREATE INDEX IF NOT EXISTS documents_status ON documents (tbl, status);
+'''
+
+# Query paths which map onto indexed columns
+_COLUMNS = {
+    ('hash',): 'hash',
+    ('@class',): 'class',
+    ('status', 'status'): 'status',
+    ('doc_id',): 'doc_id',
+}
+# Top-level fields copied uncompressed into the meta column for JSON1
+_META_FIELDS = ['metadata', 'status']
+_OPERATORS = {'==': '=', '!=': '!=', '<': '<', '<=': '<=', '>': '>',
+              '>=': '>='}
+_SCALARS = (str, int, float, bool)
+
+
+def _field(document, field):
+    try:
+        return resolve_field(document, field)
+    except KeyError:
+        return None
+
+
+def _loads(payload):
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+def _json_path(path):
+    return "'$.{}'".format('.'.join('"{}"'.format(
+        part.replace('"', '""').replace("'", "''")) for part in path))
+
+
+def _translate(hashval):
+    '''
+    Translate the hashval of a TinyDB query into a SQL condition
+    Fields which are null are NULL in SQL as well as missing fields, but
+        TinyDB tells them apart: a null field exists and is != any
+        value, a missing field is neither == nor != anything. Whether a
+        field exists is looked up in the meta column (json_type is NULL
+        only for missing fields), so these queries are only exact for
+        fields in _META_FIELDS.
+    :param hashval: QueryImpl.hashval
+    :returns: (sql, params, exact) where exact is False if the SQL
+        condition is only a pre-filter, or None if the query cannot be
+        translated at all
+    :rtype: tuple | None
+    '''
+    op = hashval[0]
+    if op in _OPERATORS or op == 'exists':
+        path = tuple(hashval[1])
+        exists = None
+        if path and path[0] in _META_FIELDS:
+            exists = 'json_type(meta, {}) IS NOT NULL'.format(
+                _json_path(path))
+        if path in _COLUMNS:
+            column = _COLUMNS[path]
+        elif exists is not None:
+            column = 'json_extract(meta, {})'.format(_json_path(path))
+        else:
+            return None
+        if op == 'exists':
+            if exists is None:
+                return None
+            return exists, [], True
+        value = hashval[2]
+        if not isinstance(value, _SCALARS):
+            return None
+        if op == '!=':
+            if exists is None:
+                # Null and missing fields are told apart by cond
+                return '{0} != ? OR {0} IS NULL'.format(column), [value], \
+                    False
+            return ('{0} != ? OR ({0} IS NULL AND {1})'.format(column,
+                                                               exists),
+                    [value], True)
+        return '{} {} ?'.format(column, _OPERATORS[op]), [value], True
+    elif op in ('and', 'or'):
+        translated = [_translate(part) for part in hashval[1]]
+        if op == 'or' and None in translated:
+            return None
+        translated = [part for part in translated if part is not None]
+        if not translated:
+            return None
+        sql = ' {} '.format(op.upper()).join(
+            '({})'.format(part[0]) for part in translated)
+        params = [param for part in translated for param in part[1]]
+        exact = (len(translated) == len(hashval[1])
+                 and all(part[2] for part in translated))
+        return sql, params, exact
+    elif op == 'not':
+        translated = _translate(hashval[1])
+        if translated is None or not translated[2]:
+            return None
+        # Unlike NOT, also true where the condition is NULL, i.e. where
+        # TinyDB's condition is False because of null or missing fields
+        return '({}) IS NOT 1'.format(translated[0]), translated[1], True
+    return None
+
+
+class SQLiteStorage(Storage):
+    '''
+    TinyDB storage which keeps one row per document in a SQLite
+        database instead of one MSON document for the whole database.
+        Documents are stored as zlib-compressed MSON payloads next to
+        indexed hash, class and status columns and an uncompressed JSON
+        copy of their metadata and status which can be queried with the
+        SQLite JSON1 functions. Writes only touch the rows of the changed
+        documents and MSONTable.search pushes TinyDB queries on these
+        columns down to SQL where possible (see SQLiteStorage.select).
+    Existing MSON databases can be converted with migrate_tinydb.
+    :param path: path to the SQLite database
+    :type path: str
+    :param create_dirs: create parent directories of path if True
+    :type create_dirs: bool
+    :param compression: zlib compression level of the payloads
+    :type compression: int
+    :param lazy: only decompress and decode documents when they are
+        accessed, see LazyDocuments
+    :type lazy: bool
+    :param timeout: seconds to wait for other processes to finish writing
+    :type timeout: float
+    '''
+
+    def __init__(self, path, create_dirs=False, compression=6, lazy=False,
+                 timeout=60.):
+        if create_dirs:
+            base_dir = os.path.dirname(path)
+            if base_dir and not os.path.exists(base_dir):
+                os.makedirs(base_dir)
+        self.path = path
+        self.compression = compression
+        self.lazy = lazy
+        self.blobs = base.BlobStore(base.blobs_directory(path))
+
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, timeout=timeout,
+                                           isolation_level=None,
+                                           check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript(_SCHEMA)
+
+        self._data = None
+        self._serialized = None
+        self._data_version = None
+        # Incremented every time the data is (re)loaded from the database
+        self.generation = 0
+        # Transaction nesting depth
+        self._depth = 0
+
+    def close(self):
+        self._connection.close()
+
+    def stale(self):
+        '''
+        Check if the database file was deleted
+        :returns: True if path no longer exists
+        :rtype: bool
+        '''
+        return not os.path.exists(self.path)
+
+    def locked(self):
+        '''
+        Lock out other processes and threads from writing, e.g. around
+            read-modify-write cycles, by starting a transaction
+            (BEGIN IMMEDIATE). Reentrant.
+        :returns: the transaction as a context manager
+        '''
+        return self.transaction()
+
+    def read(self):
+        with self._lock:
+            data_version = self._connection.execute(
+                'PRAGMA data_version').fetchone()[0]
+            if self._data is None or data_version != self._data_version:
+                self._load()
+                self._data_version = data_version
+            return self._data
+
+    def write(self, data):
+        '''
+        Write the full database state by writing only the rows of the
+            tables and documents which differ from the current state
+        :param data: {table_name: {doc_id: document}}
+        :type data: dict
+        '''
+        with self._lock:
+            self.read()
+            with self.transaction():
+                for table in list(self._serialized):
+                    if table not in data:
+                        self._drop_table(table)
+                for table, documents in data.items():
+                    doc_ids = {int(doc_id) for doc_id in documents}
+                    serialized = self._serialized.get(table, {})
+                    removed = {doc_id: None for doc_id in serialized
+                               if doc_id not in doc_ids}
+                    self._write_documents(table, removed)
+                    self._write_documents(table, documents)
+
+    def write_documents(self, table, documents):
+        '''
+        Write only the given documents of a table
+        :param table: name of the table
+        :type table: str
+        :param documents: {doc_id: document}, where a document of None
+            deletes the doc_id from the table
+        :type documents: dict
+        '''
+        with self._lock:
+            self.read()
+            with self.transaction():
+                self._write_documents(table, documents)
+
+    def select(self, table, cond):
+        '''
+        Find the doc_ids of the documents matching a TinyDB query using
+            the indexed columns and JSON1 functions
+        :param table: name of the table
+        :type table: str
+        :param cond: TinyDB query
+        :type cond: Query
+        :returns: (doc_ids, exact), where exact is False if the matches
+            still have to be filtered with cond, or None if the query
+            cannot be translated to SQL
+        :rtype: tuple | None
+        '''
+        hashval = getattr(cond, 'hashval', None)
+        translated = _translate(hashval) if hashval else None
+        if translated is None:
+            return None
+        sql, params, exact = translated
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT doc_id FROM documents WHERE tbl = ? AND ({}) '
+                'ORDER BY doc_id'.format(sql), [table] + params)
+            return [row[0] for row in rows], exact
+
+    @contextmanager
+    def transaction(self, rollback=True):
+        '''
+        Run all writes in one SQLite transaction which is committed when
+            the outermost transaction exits. Nested transactions join the
+            outermost one.
+        :param rollback: if True, the transaction is rolled back if an
+            exception is raised, otherwise it is still committed
+        :type rollback: bool
+        '''
+        with self._lock:
+            if not self._depth:
+                self._connection.execute('BEGIN IMMEDIATE')
+            self._depth += 1
+            failed = False
+            try:
+                yield self
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                self._depth -= 1
+                if not self._depth:
+                    if failed and rollback:
+                        self._connection.execute('ROLLBACK')
+                        # Reload from the database on the next read
+                        self._data = None
+                    else:
+                        self._connection.execute('COMMIT')
+
+    def _load(self):
+        self._data = {}
+        self._serialized = {}
+        for (table,) in self._connection.execute('SELECT name FROM tables'):
+            self._data[table] = LazyDocuments(_loads, blobs=self.blobs)
+            self._serialized[table] = {}
+        rows = self._connection.execute(
+            'SELECT tbl, doc_id, payload FROM documents ORDER BY tbl, doc_id')
+        for table, doc_id, payload in rows:
+            self._serialized[table][doc_id] = payload
+            self._data[table].set_raw(doc_id, payload)
+        if not self.lazy:
+            for documents in self._data.values():
+                documents.load()
+        self.generation += 1
+
+    def _drop_table(self, table):
+        self._connection.execute('DELETE FROM documents WHERE tbl = ?',
+                                 (table,))
+        self._connection.execute('DELETE FROM tables WHERE name = ?',
+                                 (table,))
+        self._data.pop(table, None)
+        self._serialized.pop(table, None)
+
+    def _write_documents(self, table, documents):
+        if table not in self._serialized:
+            self._connection.execute(
+                'INSERT OR IGNORE INTO tables (name) VALUES (?)', (table,))
+            self._data[table] = LazyDocuments(_loads, blobs=self.blobs)
+            self._serialized[table] = {}
+        data = self._data[table]
+        serialized = self._serialized[table]
+        lazy = isinstance(documents, LazyDocuments)
+        # Our own undecoded documents cannot have changed
+        own = documents is data
+        for key in list(documents):
+            doc_id = int(key)
+            raw = lazy and not documents.is_decoded(key)
+            if raw:
+                if own:
+                    continue
+                document = documents.peek(key)
+                class_name = document.get('@class')
+                encoded = json.dumps(document)
+            else:
+                document = documents[key]
+                if document is None:
+                    if doc_id in serialized:
+                        self._connection.execute(
+                            'DELETE FROM documents '
+                            'WHERE tbl = ? AND doc_id = ?', (table, doc_id))
+                        del serialized[doc_id]
+                    if doc_id in data:
+                        del data[doc_id]
+                    continue
+                class_name = document.__class__.__name__
+                with base.use_blob_store(self.blobs):
+                    encoded = json.dumps(document, cls=DocumentEncoder)
+            payload = zlib.compress(encoded.encode('utf-8'), self.compression)
+            if raw:
+                data.set_raw(doc_id, payload)
+            else:
+                data[doc_id] = document
+            if serialized.get(doc_id) == payload:
+                continue
+            meta = json.dumps({field: _field(document, field)
+                               for field in _META_FIELDS}, cls=MontyEncoder)
+            status = _field(document, 'status.status')
+            self._connection.execute(
+                'INSERT OR REPLACE INTO documents '
+                '(tbl, doc_id, hash, class, status, meta, payload) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (table, doc_id, _field(document, 'hash'), class_name,
+                 status if isinstance(status, str) else None, meta,
+                 payload))
+            serialized[doc_id] = payload
+
+
+def migrate_tinydb(src=DB_PATH, dst=SQLITE_DB_PATH):
+    '''
+    Copy all tables and documents of an MSON (TinyDB) database into a
+        SQLite database
+    :param src: path to the existing db.tinydb database
+    :type src: str
+    :param dst: path to the SQLite database to write
+    :type dst: str
+    :returns: number of migrated documents per table
+    :rtype: dict
+    '''
+    source = MSONStorage(src)
+    data = source.read() or {}
+    source.close()
+
+    target = SQLiteStorage(dst)
+    with target.transaction():
+        target.write(data)
+    target.close()
+
+    return {table: len(documents) for table, documents in data.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Migrate a DFTman TinyDB database to SQLite')
+    parser.add_argument('src', nargs='?', default=DB_PATH)
+    parser.add_argument('dst', nargs='?', default=SQLITE_DB_PATH)
+    args = parser.parse_args()
+    for table, count in migrate_tinydb(args.src, args.dst).items():
+        print('Migrated {} documents of table {}'.format(count, table))
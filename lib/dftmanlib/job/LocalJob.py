@@ -15,9 +15,21 @@ from monty.json import MontyDecoder, MontyEncoder
 
 from ..db import load_db
 from .. import base
+from .LocalScheduler import get_default_scheduler
 
 LOCALJOBS_DIRECTORY = os.path.join(os.getcwd(), 'LocalJobs')
 
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Exists, but belongs to someone else
+        return True
+    return True
+
 class LocalJob(Mapping, base.Job):
     '''
     Class for running and storing jobs using the Torque
@@ -58,8 +70,10 @@ class LocalJob(Mapping, base.Job):
         
         self.submission_time = submission_time
         self.submitted = submitted
-        self.status = status
+        # Copy, so that jobs never share the default status
+        self.status = dict(status or {})
         self.pid = pid
+        self.process = None
         self.doc_id = doc_id
         
         if runname:
@@ -120,14 +134,28 @@ class LocalJob(Mapping, base.Job):
         return self.calculation.write_input(name=self.input_name,
                                             directory=self.directory)
             
-    def parse_output(self, update_to_db=False):
+    def parse_output(self, update_to_db=False, **kwargs):
         output = self.calculation.parse_output(name=self.output_name,
-                                               directory=self.directory)
+                                               directory=self.directory,
+                                               **kwargs)
+        base.store_in_cache(self)
         if update_to_db:
             self.update()
         return output
     
-    def run(self, block_if_run=False):
+    def run(self, block_if_run=False, scheduler=None):
+        '''
+        Run the job, or queue it on a LocalScheduler which starts it
+            when enough cores are free
+        :param block_if_run: don't run the job again if it was run
+        :type block_if_run: bool
+        :param scheduler: scheduler to queue the job on, defaults to the
+            one set with set_default_scheduler. Without a scheduler the
+            job is started immediately.
+        :type scheduler: LocalScheduler
+        :returns: doc_id of the job
+        :rtype: int
+        '''
         if not self.doc_id:
             self.insert()
         if not os.path.exists(self.directory):
@@ -135,30 +163,49 @@ class LocalJob(Mapping, base.Job):
         if block_if_run and self.submitted:
             print('Already run, not submitting')
             return
-        else:
-            self.write_input()
+        scheduler = scheduler or get_default_scheduler()
+        if base.restore_from_cache(self):
+            self.update()
+        elif scheduler is not None:
+            scheduler.submit(self)
             if self.wait:
-                with open(self.output_path, 'w') as output_handle:
-                    process = subprocess.run(self.run_command,
-                                             cwd=self.calculation.directory,
-                                             stdout=output_handle,
-                                             stderr=subprocess.PIPE)
-                    stderr = process.stderr.decode('utf-8')
-                    self.submitted = True
-                    self.status['status'] = 'Complete'
-            else:
-                with open(self.output_path, 'w') as output_handle:
-                    process = subprocess.Popen(self.run_command,
-                                               cwd=self.calculation.directory,
-                                               stdout=output_handle,
-                                               stderr=subprocess.PIPE)
-                self.process = process
-                self.pid = process.pid
-                self.status['status'] = 'Running'
+                scheduler.wait([self])
+        elif self.wait:
+            self.write_input()
+            with open(self.output_path, 'w') as output_handle:
+                process = subprocess.run(self.run_command,
+                                         cwd=self.calculation.directory,
+                                         stdout=output_handle,
+                                         stderr=subprocess.PIPE)
+                stderr = process.stderr.decode('utf-8')
                 self.submitted = True
+                self.status['status'] = 'Complete'
+        else:
+            self.start()
         # stdout = process.stdout.peek().decode('utf-8')
         # stderr = process.stderr.peek().decode('utf-8')
         return self.doc_id
+
+    def start(self):
+        '''
+        Write the input and start the job in the background. Its standard
+            error goes to stderr_path, as nothing reads a pipe while it runs.
+        :returns: the process running the job
+        :rtype: subprocess.Popen
+        '''
+        self.write_input()
+        with open(self.output_path, 'w') as output_handle, \
+                open(self.stderr_path, 'w') as error_handle:
+            process = subprocess.Popen(self.run_command,
+                                       cwd=self.calculation.directory,
+                                       stdout=output_handle,
+                                       stderr=error_handle)
+        self.process = process
+        self.pid = process.pid
+        self.status['status'] = 'Running'
+        self.submitted = True
+        self.submission_time = time.asctime(time.gmtime())
+        return process
     
     def check_status(self, update_in_db=False):
         if self.process:
@@ -169,10 +216,34 @@ class LocalJob(Mapping, base.Job):
                 self.status['status'] = 'Complete'
             else:
                 self.status['status'] = 'Error'
-            return self.status
-        else:
-            return self.status
+        elif self.pid and self.status.get('status') == 'Running':
+            # Started by another Python process (e.g. loaded from the
+            # database), so only whether it is still running is known
+            if not _pid_running(self.pid):
+                self.status['status'] = self._exited_status()
+        if update_in_db:
+            self.update()
+        return self.status
     
+    def _exited_status(self):
+        '''
+        Status of a job whose process exited without its exit code being
+            known, from its output: 'Complete' if the calculation ran to
+            its end, 'Error' if it did not and 'Unknown' if the output
+            cannot be parsed
+        :rtype: str
+        '''
+        try:
+            output = self.calculation.parse_output(name=self.output_name,
+                                                   directory=self.directory,
+                                                   properties=['job_done'])
+            job_done = output.data.get('job_done')
+        except Exception as error:
+            print('Could not parse the output of job {}: {}'.format(
+                self.doc_id, error))
+            return 'Unknown'
+        return 'Complete' if job_done else 'Error'
+
     def kill(self):
         self.process.kill()
         return process
@@ -205,6 +276,14 @@ class LocalJob(Mapping, base.Job):
     def output_name(self):
         return self.calculation.output_name
     
+    @property
+    def stderr_path(self):
+        '''
+        Standard error of a job started in the background, see start
+        :rtype: str
+        '''
+        return '{}.stderr'.format(os.path.splitext(self.output_path)[0])
+
     @property
     def output_path(self):
         return os.path.abspath(os.path.join(self.directory,
@@ -234,6 +313,7 @@ class LocalJob(Mapping, base.Job):
             'pid': self.pid,
             'submission_time': self.submission_time,
             'submitted': self.submitted,
+            'hash': self.hash,
             'doc_id': self.doc_id
         }
         return dict_
@@ -0,0 +1,227 @@
+import os
+import time
+import threading
+
+from collections import OrderedDict
+
+import pandas as pd
+
+from ..db import load_db
+
+_DEFAULT_SCHEDULER = None
+
+
+def set_default_scheduler(scheduler):
+    '''
+    Set the scheduler LocalJob.run queues jobs on, e.g. to run the
+        LocalJobs of workflows under a core budget
+    :param scheduler: scheduler, or None to start jobs immediately
+    :type scheduler: LocalScheduler
+    '''
+    global _DEFAULT_SCHEDULER
+    _DEFAULT_SCHEDULER = scheduler
+
+
+def get_default_scheduler():
+    '''
+    Get the scheduler set with set_default_scheduler
+    :rtype: LocalScheduler | None
+    '''
+    return _DEFAULT_SCHEDULER
+
+
+class LocalScheduler(object):
+    '''
+    Queue which runs LocalJobs on this machine under a core budget.
+        Jobs use np cores if they run with mpi and one core otherwise.
+        Queued jobs are started in order as cores free up, where smaller
+        jobs further back in the queue are started if the first one does
+        not fit yet.
+    e.g.
+        scheduler = LocalScheduler(ncores=16)
+        set_default_scheduler(scheduler)
+        workflow.run()  # queues the LocalJobs of the workflow
+        scheduler.wait()
+    :param ncores: number of cores to use, defaults to all cores
+    :type ncores: int
+    :param poll_interval: seconds between checks of the running jobs
+        when waiting or running in the background
+    :type poll_interval: float
+    :param update_in_db: write the statuses of started and finished jobs
+        to the database
+    :type update_in_db: bool
+    '''
+    def __init__(self, ncores=None, poll_interval=1., update_in_db=True):
+        self.ncores = ncores or os.cpu_count() or 1
+        self.poll_interval = poll_interval
+        self.update_in_db = update_in_db
+
+        # {id(job): job}, as jobs are Mappings which compare equal by
+        # value (and comparing them serializes them)
+        self.queued = OrderedDict()
+        self.running = OrderedDict()
+        self.finished = OrderedDict()
+
+        self._lock = threading.RLock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def __repr__(self):
+        return ('LocalScheduler(ncores={}, queued={}, running={}, '
+                'finished={})'.format(self.ncores, len(self.queued),
+                                      len(self.running), len(self.finished)))
+
+    @staticmethod
+    def cores(job):
+        '''
+        Number of cores a job uses
+        :rtype: int
+        '''
+        return job.np if job.mpi else 1
+
+    @property
+    def free_cores(self):
+        with self._lock:
+            return self.ncores - sum(self.cores(job)
+                                     for job in self.running.values())
+
+    def submit(self, job):
+        '''
+        Queue a job and start it if enough cores are free
+        :param job: job to run
+        :type job: LocalJob
+        '''
+        if self.cores(job) > self.ncores:
+            raise ValueError('Job needs {} cores, but the scheduler only has '
+                             '{}'.format(self.cores(job), self.ncores))
+        with self._lock:
+            job.status['status'] = 'Queued'
+            self.queued[id(job)] = job
+        self.schedule()
+
+    def cancel(self, job):
+        '''
+        Remove a job from the queue
+        :param job: queued job
+        :type job: LocalJob
+        :returns: True if the job was queued
+        :rtype: bool
+        '''
+        with self._lock:
+            if self.queued.pop(id(job), None) is None:
+                return False
+            job.status['status'] = None
+        self._update([job])
+        return True
+
+    def schedule(self):
+        '''
+        Check the running jobs and start queued jobs while there are
+            enough free cores
+        :returns: number of running jobs
+        :rtype: int
+        '''
+        changed = []
+        with self._lock:
+            for key, job in list(self.running.items()):
+                job.check_status()
+                if job.status.get('status') != 'Running':
+                    del self.running[key]
+                    self.finished[key] = job
+                    changed.append(job)
+            free_cores = self.free_cores
+            for key, job in list(self.queued.items()):
+                if not free_cores:
+                    break
+                if self.cores(job) <= free_cores:
+                    del self.queued[key]
+                    job.start()
+                    self.running[key] = job
+                    free_cores -= self.cores(job)
+                    changed.append(job)
+            running = len(self.running)
+        # Outside of the lock: writing takes the lock of the database,
+        # which e.g. workflows hold while they submit jobs
+        self._update(changed)
+        return running
+
+    def _update(self, jobs):
+        if not (self.update_in_db and jobs):
+            return
+        jobs = [job for job in jobs if job.doc_id]
+        if jobs:
+            table = load_db().table(jobs[0].__class__.__name__)
+            table.write_back(jobs, doc_ids=[job.doc_id for job in jobs])
+
+    def wait(self, jobs=None, timeout=None):
+        '''
+        Run queued jobs until the given jobs (all jobs if None) finished
+        :param jobs: jobs to wait for
+        :type jobs: list
+        :param timeout: seconds after which to stop waiting
+        :type timeout: float
+        :returns: True if the jobs finished, False after a timeout
+        :rtype: bool
+        '''
+        start = time.time()
+        while True:
+            self.schedule()
+            with self._lock:
+                if jobs is None:
+                    done = not (self.queued or self.running)
+                else:
+                    done = all(id(job) in self.finished for job in jobs)
+            if done:
+                return True
+            if timeout is not None and time.time() - start > timeout:
+                return False
+            time.sleep(self.poll_interval)
+
+    def status(self):
+        '''
+        Statuses of all jobs known to the scheduler
+        :returns: status data frame
+        :rtype: pandas.DataFrame
+        '''
+        with self._lock:
+            jobs = (list(self.queued.values()) + list(self.running.values())
+                    + list(self.finished.values()))
+            status_dicts = [{'Doc ID': job.doc_id,
+                             'Run Name': job.runname,
+                             'Status': job.status.get('status'),
+                             'Cores': self.cores(job),
+                             'PID': job.pid}
+                            for job in jobs]
+        df = pd.DataFrame(status_dicts)
+        if not df.empty:
+            df = df[['Doc ID', 'Run Name', 'Status', 'Cores', 'PID']]
+        return df
+
+    def start(self):
+        '''
+        Start queued jobs from a background thread as cores free up
+        :returns: self
+        '''
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stopping.clear()
+
+        def target():
+            while not self._stopping.is_set():
+                self.schedule()
+                self._stopping.wait(self.poll_interval)
+
+        self._thread = threading.Thread(target=target, daemon=True,
+                                        name='dftman-local-scheduler')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop the background thread. Running jobs keep running and queued
+            jobs stay queued.
+        '''
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
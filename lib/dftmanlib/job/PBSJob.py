@@ -15,8 +15,31 @@ from monty.json import MontyDecoder, MontyEncoder
 
 from ..db import load_db
 from .. import base
+from .job import qstat_statuses
 
 PBSJOBS_DIRECTORY = os.path.join(os.getcwd(), 'PBSJobs')
+# Files written into the directory of each job run by PBSJob.run_packed
+PACK_STARTED_MARKER = 'dftman.started'
+PACK_EXIT_MARKER = 'dftman.exitcode'
+# Splits $PBS_NODEFILE into the slots of PBSJob.run_packed: slot<k>.nodes
+# (its machinefile) and slot<k>.cpus (the node-local indices of its
+# cores). Slots never share a core and only span nodes if a job needs
+# more than one node.
+_PACK_SLOTS_AWK = '''\
+!($1 in node) { node[$1] = nodes++ }
+{
+    i = used[$1]++
+    if (np <= ppn) {
+        per = int(ppn / np)
+        if (int(i / np) >= per) next
+        slot = node[$1] * per + int(i / np)
+    } else {
+        slot = int(node[$1] / int((np + ppn - 1) / ppn))
+    }
+    print $1 > (dir "/slot" slot ".nodes")
+    cpus[slot] = ncpus[slot]++ ? cpus[slot] "," i : i
+}
+END { for (slot in cpus) print cpus[slot] > (dir "/slot" slot ".cpus") }'''
 
 class PBSJob(Mapping, base.Job):
     '''
@@ -61,7 +84,8 @@ class PBSJob(Mapping, base.Job):
                  runname=None, headertext='',
                  footertext='', parent_directory=None,
                  metadata=None,
-                 directory=None, pbs_id=None,
+                 directory=None, pbs_id=None, array_index=None,
+                 packed=False,
                  status={}, submission_time=None,
                  submitted=False, doc_id=None, hash=None):
         self.calculation = calculation
@@ -78,6 +102,8 @@ class PBSJob(Mapping, base.Job):
         self.metadata = metadata
         
         self.pbs_id = pbs_id
+        self.array_index = array_index
+        self.packed = packed
         self.submission_time = submission_time
         self.submitted = submitted
         self.doc_id = doc_id
@@ -183,14 +209,21 @@ class PBSJob(Mapping, base.Job):
         with open(self.script_path, 'w') as f:
             f.write(script)
             
-    def parse_output(self, update_to_db=False):
+    def parse_output(self, update_to_db=False, **kwargs):
         output = self.calculation.parse_output(name=self.output_name,
-                                               directory=self.directory)
+                                               directory=self.directory,
+                                               **kwargs)
+        base.store_in_cache(self)
         if update_to_db:
             self.update()
         return output
     
     def run(self, block_if_run=False):
+        table = load_db().table(self.__class__.__name__)
+        with table.batch(rollback=False):
+            return self._run(block_if_run)
+
+    def _run(self, block_if_run=False):
         if not self.doc_id:
             self.insert()
         if not os.path.exists(self.directory):
@@ -198,6 +231,9 @@ class PBSJob(Mapping, base.Job):
         if block_if_run and self.submitted:
             print('Already run, not submitting')
             return
+        elif base.restore_from_cache(self):
+            self.update()
+            return self.doc_id
         else:
             self.write_input()
             self.write_script()
@@ -219,51 +255,367 @@ class PBSJob(Mapping, base.Job):
                              'stdout: {}\nstderr: {}'.format(stdout, stderr))
         return self.doc_id
     
-    def check_status(self, update_in_db=False):
-        if not self.pbs_id:
-            raise ValueError('Job must have a PBS ID')
-        
-        status_codes = {'C': 'Complete',
-                        'E': 'Exiting',
-                        'H': 'Held',
-                        'Q': 'Queued',
-                        'R': 'Running',
-                        'T': 'Moving',
-                        'W': 'Waiting'
-                     }
+    @classmethod
+    def _pending(cls, jobs, block_if_run):
+        '''
+        Insert jobs without a doc_id and return the ones to submit
+        '''
+        for job in jobs:
+            if not job.doc_id:
+                job.insert()
+        return [job for job in jobs if not (block_if_run and job.submitted)]
+
+    @classmethod
+    def _restore_cached(cls, table, jobs):
+        '''
+        Complete jobs from the result cache and store them
+        :returns: the jobs which still have to be run
+        :rtype: list
+        '''
+        cached, pending = [], []
+        for job in jobs:
+            (cached if base.restore_from_cache(job) else pending).append(job)
+        if cached:
+            table.write_back(cached, doc_ids=[job.doc_id for job in cached])
+        return pending
 
-        qstat = subprocess.Popen(['qstat', '-u', getpass.getuser(),
-                                  str(self.pbs_id)],
-                                 cwd=self.calculation.directory,
+    @staticmethod
+    def _qsub(script_path):
+        '''
+        Submit a script
+        :returns: PBS id of the submitted job
+        :rtype: int
+        '''
+        process = subprocess.run(['qsub', script_path],
+                                 cwd=os.path.dirname(script_path),
                                  stdout=subprocess.PIPE,
                                  stderr=subprocess.PIPE)
+        stdout = process.stdout.decode('utf-8')
+        stderr = process.stderr.decode('utf-8')
+        id_match = re.match(r'\s*(\d+)', stdout)
+        if process.returncode or not id_match:
+            raise ValueError('Could not find id. Didn\'t submit?\n'\
+                             'stdout: {}\nstderr: {}'.format(stdout, stderr))
+        return int(id_match.group(1))
 
-        qstat_stdout = qstat.stdout.read().decode('utf-8')
-        qstat_line = qstat_stdout.strip().split('\n')[-1]
-        try:
-            pbs_id, username, queue, runname, session_id,\
-            nnodes, np, reqd_memory, walltime, status, elapsed_time = qstat_line.split()
-            self.status = {'username': username,
-                           'queue': queue,
-                           'runname': runname,
-                           'session_id': session_id,
-                           'nnodes': nnodes,
-                           'np': np,
-                           'reqd_memory': reqd_memory,
-                           'walltime': walltime,
-                           'status': status_codes[status],
-                           'elapsed_time': elapsed_time,
-                           'submission_time': self.submission_time,
-                           'doc_id': self.doc_id,
-                           'hash': self.hash
-                          }
-        except:
+    @staticmethod
+    def _common_directory(jobs, directory):
+        if not directory:
+            directory = os.path.commonpath(
+                [os.path.abspath(job.directory) for job in jobs])
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        return directory
+
+    @classmethod
+    def run_array(cls, jobs, block_if_run=False, directory=None,
+                  runname=None):
+        '''
+        Submit a set of jobs as one Torque job array with a single qsub.
+            The array script selects the directory and command of each job
+            with PBS_ARRAYID and uses the resources (walltime, nodes,
+            queue, header and footer text) of the first job, which all
+            jobs have to share. Each job keeps its own database record
+            with the pbs_id of the array and its array_index.
+        :param jobs: jobs to submit
+        :type jobs: list
+        :param block_if_run: don't submit jobs which were already submitted
+        :type block_if_run: bool
+        :param directory: directory for the array script, defaults to the
+            common parent directory of the jobs
+        :type directory: str
+        :param runname: name of the array job, defaults to the run name of
+            the first job
+        :type runname: str
+        :returns: doc_ids of the jobs
+        :rtype: list
+        '''
+        jobs = list(jobs)
+        table = load_db().table(cls.__name__)
+        with table.batch(rollback=False):
+            pending = cls._restore_cached(table,
+                                          cls._pending(jobs, block_if_run))
+            if not pending:
+                print('Already run, not submitting')
+                return [job.doc_id for job in jobs]
+
+            first = pending[0]
+            resources = ('walltime', 'nnodes', 'ppn', 'queue',
+                         'headertext', 'footertext')
+            for job in pending:
+                for resource in resources:
+                    if getattr(job, resource) != getattr(first, resource):
+                        raise ValueError('All jobs of an array must have '
+                                         'the same {}'.format(resource))
+
+            directory = cls._common_directory(pending, directory)
+            script_path = os.path.join(directory, 'pbs_array_runscript.sh')
+
+            cases = []
+            for index, job in enumerate(pending):
+                job.write_input()
+                cases.append('{index:d})\n'
+                             '    cd "{directory:s}"\n'
+                             '    {run_command:s}\n'
+                             '    ;;'.format(index=index,
+                                             directory=job.directory,
+                                             run_command=job.run_command))
+            script = '#!/bin/bash\n'\
+                     '#PBS -l walltime={walltime:s}\n'\
+                     '#PBS -l nodes={nnodes:d}:ppn={ppn:d}\n'\
+                     '#PBS -q {queue:s}\n'\
+                     '#PBS -N {runname:s}\n'\
+                     '#PBS -t 0-{last:d}\n'\
+                     '{headertext:s}\n'\
+                     'case "$PBS_ARRAYID" in\n'\
+                     '{cases:s}\n'\
+                     'esac\n'\
+                     '{footertext:s}\n'.format(
+                         walltime=first.walltime,
+                         nnodes=first.nnodes,
+                         ppn=first.ppn,
+                         queue=first.queue,
+                         runname=runname or first.runname,
+                         last=len(pending) - 1,
+                         headertext=first.headertext,
+                         cases='\n'.join(cases),
+                         footertext=first.footertext).strip()
+            with open(script_path, 'w') as f:
+                f.write(script)
+
+            pbs_id = cls._qsub(script_path)
+            submission_time = time.asctime(time.gmtime())
+            for index, job in enumerate(pending):
+                job.pbs_id = pbs_id
+                job.array_index = index
+                job.status = {'status': 'Submitted', 'pbs_id': pbs_id,
+                              'array_index': index}
+                job.submitted = True
+                job.submission_time = submission_time
+            table.write_back(pending, doc_ids=[job.doc_id for job in pending])
+        return [job.doc_id for job in jobs]
+
+    @classmethod
+    def run_packed(cls, jobs, nnodes=1, ppn=16, walltime='01:00:00',
+                   queue=None, parallel=True, block_if_run=False,
+                   directory=None, runname=None, headertext=None,
+                   footertext=None, slot_args='-machinefile {machinefile:s}'):
+        '''
+        Run a set of small jobs inside one PBS allocation with a single
+            qsub. The driver script splits the cores of the allocation
+            ($PBS_NODEFILE) into slots of the largest np of the jobs,
+            which don't share cores and only span several nodes if a job
+            needs more cores than a node has. The jobs are dealt out to
+            the slots and each slot runs its jobs one after another, all
+            slots at the same time (only one slot if not parallel). The
+            mpirun of a job gets slot_args, which by default pins it to
+            the nodes of its slot with a machinefile. Each job writes the
+            markers
+            PACK_STARTED_MARKER and PACK_EXIT_MARKER (with its exit code)
+            into its directory, from which check_status derives the
+            status of the individual jobs. The jobs keep their own
+            database records with the pbs_id of the allocation.
+        :param jobs: jobs to run
+        :type jobs: list
+        :param nnodes: number of nodes of the allocation
+        :type nnodes: int
+        :param ppn: number of processors per node of the allocation
+        :type ppn: int
+        :param walltime: walltime of the allocation in hh:mm:ss format
+        :type walltime: str
+        :param queue: queue to submit to, defaults to the first job's
+        :type queue: str
+        :param parallel: run jobs concurrently if True, otherwise
+            one after another
+        :type parallel: bool
+        :param block_if_run: don't submit jobs which were already submitted
+        :type block_if_run: bool
+        :param directory: directory for the driver script, defaults to the
+            common parent directory of the jobs
+        :type directory: str
+        :param runname: name of the allocation, defaults to the run name of
+            the first job
+        :type runname: str
+        :param headertext: text above the jobs in the driver script,
+            defaults to the first job's
+        :type headertext: str
+        :param footertext: text below the jobs in the driver script,
+            defaults to the first job's
+        :type footertext: str
+        :param slot_args: mpirun arguments which place a job on its slot,
+            formatted with machinefile (path of the slot's machinefile)
+            and cpus (the node-local indices of the slot's cores, e.g.
+            '4,5,6,7'). Binding to the cores depends on the MPI
+            implementation, e.g. for OpenMPI
+            '-machinefile {machinefile:s} --cpu-set {cpus:s} --bind-to core'
+        :type slot_args: str
+        :returns: doc_ids of the jobs
+        :rtype: list
+        '''
+        jobs = list(jobs)
+        table = load_db().table(cls.__name__)
+        with table.batch(rollback=False):
+            pending = cls._restore_cached(table,
+                                          cls._pending(jobs, block_if_run))
+            if not pending:
+                print('Already run, not submitting')
+                return [job.doc_id for job in jobs]
+
+            first = pending[0]
+            cores = nnodes * ppn
+            max_np = max(job.np for job in pending)
+            if max_np > cores:
+                raise ValueError('A job needs {} cores, but the allocation '
+                                 'only has {}'.format(max_np, cores))
+            if max_np <= ppn:
+                slots = nnodes * (ppn // max_np)
+            else:
+                slots = nnodes // -(-max_np // ppn)
+            if not parallel:
+                slots = 1
+
+            directory = cls._common_directory(pending, directory)
+            script_path = os.path.join(directory, 'pbs_packed_runscript.sh')
+
+            slot_jobs = [pending[slot::slots] for slot in range(slots)]
+            commands = []
+            for slot, jobs_ in enumerate(slot_jobs):
+                if not jobs_:
+                    continue
+                mpi_args = slot_args.format(
+                    machinefile='"$slots/slot{:d}.nodes"'.format(slot),
+                    cpus='$(cat "$slots/slot{:d}.cpus")'.format(slot))
+                runs = []
+                for job in jobs_:
+                    job.write_input()
+                    for marker in (PACK_STARTED_MARKER, PACK_EXIT_MARKER):
+                        marker_path = os.path.join(job.directory, marker)
+                        if os.path.exists(marker_path):
+                            os.remove(marker_path)
+                    runs.append('    (\n'
+                                '        cd "{directory:s}" || exit 1\n'
+                                '        touch {started:s}\n'
+                                '        {run_command:s}\n'
+                                '        echo $? > {exit:s}\n'
+                                '    )'.format(
+                                    directory=job.directory,
+                                    started=PACK_STARTED_MARKER,
+                                    run_command=job._run_command(mpi_args),
+                                    exit=PACK_EXIT_MARKER))
+                commands.append('(\n{}\n) &'.format('\n'.join(runs)))
+            # Plain background jobs and wait, which any bash supports
+            script = '#!/bin/bash\n'\
+                     '#PBS -l walltime={walltime:s}\n'\
+                     '#PBS -l nodes={nnodes:d}:ppn={ppn:d}\n'\
+                     '#PBS -q {queue:s}\n'\
+                     '#PBS -N {runname:s}\n'\
+                     '{headertext:s}\n'\
+                     'slots="{directory:s}/pbs_packed_slots.$PBS_JOBID"\n'\
+                     'mkdir -p "$slots"\n'\
+                     "awk -v np={max_np:d} -v ppn={ppn:d} -v dir=\"$slots\" '\n"\
+                     "{awk:s}' \"$PBS_NODEFILE\"\n"\
+                     '{commands:s}\n'\
+                     'wait\n'\
+                     '{footertext:s}\n'.format(
+                         walltime=walltime,
+                         nnodes=nnodes,
+                         ppn=ppn,
+                         queue=queue or first.queue,
+                         runname=runname or first.runname,
+                         headertext=(first.headertext if headertext is None
+                                     else headertext),
+                         directory=directory,
+                         max_np=max_np,
+                         awk=_PACK_SLOTS_AWK,
+                         commands='\n'.join(commands),
+                         footertext=(first.footertext if footertext is None
+                                     else footertext)).strip()
+            with open(script_path, 'w') as f:
+                f.write(script)
+
+            pbs_id = cls._qsub(script_path)
+            submission_time = time.asctime(time.gmtime())
+            for job in pending:
+                job.pbs_id = pbs_id
+                job.array_index = None
+                job.packed = True
+                job.status = {'status': 'Submitted', 'pbs_id': pbs_id}
+                job.submitted = True
+                job.submission_time = submission_time
+            table.write_back(pending, doc_ids=[job.doc_id for job in pending])
+        return [job.doc_id for job in jobs]
+
+    def _check_markers(self):
+        '''
+        Derive the status of a job run by run_packed from its markers and
+            the status of its allocation
+        '''
+        exit_path = os.path.join(self.directory, PACK_EXIT_MARKER)
+        started_path = os.path.join(self.directory, PACK_STARTED_MARKER)
+        allocation_status = self.status.get('status')
+        if os.path.exists(exit_path):
+            with open(exit_path, 'r') as f:
+                exit_code = f.read().strip()
+            self.status['exit_code'] = exit_code
+            if exit_code == '0':
+                self.status['status'] = 'Complete'
+            else:
+                self.status['status'] = 'Error'
+        elif allocation_status in ('Complete', 'Exiting'):
+            # The allocation ended before the job finished, e.g. because
+            # it ran out of walltime
+            self.status['status'] = 'Error'
+        elif os.path.exists(started_path):
+            self.status['status'] = 'Running'
+        elif allocation_status == 'Running':
+            # Waiting for a free slot in the allocation
+            self.status['status'] = 'Queued'
+
+    def check_status(self, update_in_db=False, statuses=None):
+        '''
+        Check the status of the job in the queue
+        :param update_in_db: Whether to update the job in the database
+        :type update_in_db: bool
+        :param statuses: statuses from qstat_statuses, e.g. shared by a
+            set of jobs (see pbsjob_statuses). qstat is run for this job
+            if None.
+        :type statuses: dict
+        :returns: pretty status dictionary
+        :rtype: dict
+        '''
+        if self.status.get('cached'):
+            # Completed from the result cache without running
+            return {'PBS ID': None,
+                    'Run Name': self.runname,
+                    'Status': self.status.get('status'),
+                    'Elapsed Time': None,
+                    'Walltime': self.walltime,
+                    'Queue': None,
+                    'Doc ID': self.doc_id}
+        if not self.pbs_id:
+            raise ValueError('Job must have a PBS ID')
+
+        if statuses is None:
+            statuses = qstat_statuses([self.qstat_id],
+                                      cwd=self.calculation.directory,
+                                      arrays=self.array_index is not None)
+        status = statuses.get(self.qstat_id)
+        if status:
+            self.status = dict(status)
+            self.status.pop('pbs_id')
+            self.status.update({'submission_time': self.submission_time,
+                                'doc_id': self.doc_id,
+                                'hash': self.hash})
+        else:
+            # Jobs disappear from qstat some time after they finish
             self.status['status'] = 'Complete'
+        if self.packed:
+            self._check_markers()
         
         if update_in_db:
             self.update()
         
-        pretty_status = {'PBS ID': self.pbs_id,
+        pretty_status = {'PBS ID': self.qstat_id,
                          'Run Name': self.status.get('runname'),
                          'Status': self.status.get('status'),
                          'Elapsed Time': self.status.get('elapsed_time'),
@@ -273,7 +625,7 @@ class PBSJob(Mapping, base.Job):
         return pretty_status
     
     def kill(self):
-        process = subprocess.run(['qdel', str(self.pbs_id)],
+        process = subprocess.run(['qdel', str(self.qstat_id)],
                                  stdout=subprocess.PIPE,
                                  stderr=subprocess.PIPE)
         return process
@@ -282,12 +634,32 @@ class PBSJob(Mapping, base.Job):
     def hash(self):
         return self.calculation.hash
     
+    @property
+    def qstat_id(self):
+        '''
+        Job id used by qstat and qdel, which is '<pbs_id>[<array_index>]'
+            for jobs submitted as part of a job array (see run_array)
+        '''
+        if self.array_index is not None:
+            return '{}[{}]'.format(self.pbs_id, self.array_index)
+        return int(self.pbs_id)
+    
     @property
     def run_command(self):
+        return self._run_command()
+
+    def _run_command(self, mpi_args=''):
+        '''
+        Command running the job with mpirun
+        :param mpi_args: additional arguments of mpirun, e.g. a machinefile
+        :type mpi_args: str
+        '''
         command = self.command.format(input_path=self.input_path,
                                       output_path=self.output_path,
                                       additional_inputs=\
                                       self.calculation.additional_inputs)
+        if mpi_args:
+            command = '{} {}'.format(mpi_args, command)
         return 'mpirun -np {np:d} {command:s}'.format(np=self.np,
             command=command)
     
@@ -345,9 +717,12 @@ class PBSJob(Mapping, base.Job):
             'metadata': self.metadata,
             'directory': self.directory,
             'pbs_id': self.pbs_id,
+            'array_index': self.array_index,
+            'packed': self.packed,
             'status': self.status,
             'submission_time': self.submission_time,
             'submitted': self.submitted,
+            'hash': self.hash,
             'doc_id': self.doc_id
         }
         return dict_
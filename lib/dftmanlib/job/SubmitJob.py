@@ -9,18 +9,42 @@ import os.path
 import pprint
 import shutil
 import json
+import threading
 
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
 from monty.json import MontyEncoder, MontyDecoder
 
 from ..db import load_db, MSONStorage
 from .. import base
+from .job import submit_statuses
 
 from tinydb import Query
 
 SUBMITJOBS_DIRECTORY = os.path.join(os.getcwd(), 'SubmitJobs')
 
+
+class _RateLimiter(object):
+    '''
+    Spaces calls to wait from any number of threads at least 1/rate
+        seconds apart
+    '''
+    def __init__(self, rate=None):
+        self.interval = 1. / rate if rate else 0.
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+
 class SubmitJob(Mapping, base.Job):
     '''
     Representation of a submit job on nanoHUB
@@ -137,23 +161,25 @@ class SubmitJob(Mapping, base.Job):
             os.makedirs(self.directory)
         self.calculation.write_input(name='dftman.in', directory=self.directory)
 
-        process = subprocess.Popen(shlex.split(self.command), cwd=self.directory, stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-        process.wait()
-        
-        if process.returncode == 0:
-            self.submitted = True
-        else:
-            raise subprocess.CalledProcessError
-        
-        stdout = process.stdout.peek().decode('utf-8')
-        stderr = process.stderr.peek().decode('utf-8')
+        # communicate (through run) reads both pipes to the end while
+        # waiting, so the submission can neither block on a full pipe nor
+        # lose output
+        process = subprocess.run(shlex.split(self.command), cwd=self.directory,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout = process.stdout.decode('utf-8')
+        stderr = process.stderr.decode('utf-8')
         
         with open(os.path.join(self.directory, 'scheduler_stdout.txt'), 'w') as f:
             f.write(stdout)
         with open(os.path.join(self.directory, 'scheduler_stderr.txt'), 'w') as f:
             f.write(stderr)
 
+        if process.returncode == 0:
+            self.submitted = True
+        else:
+            raise subprocess.CalledProcessError(process.returncode, process.args,
+                                                output=stdout, stderr=stderr)
+
         id_re = re.compile(r'Check run status with the command: submit --status (\d+)')
         id_match = re.search(id_re, stdout)
         
@@ -176,10 +202,75 @@ class SubmitJob(Mapping, base.Job):
         if block_if_submitted and self.submitted:
             print('Already run, not running.')
             return
-        self.doc_id = self.insert(block_if_stored)
-        self._submit(report)
-        self.doc_id = self.update()
+        table = load_db().table(self.__class__.__name__)
+        with table.batch(rollback=False):
+            if not self.doc_id:
+                # Jobs may be stored before they are run, e.g. by chained
+                # workflows
+                self.doc_id = self.insert(block_if_stored)
+            if not base.restore_from_cache(self):
+                self._submit(report)
+            self.doc_id = self.update()
         return self.doc_id
+
+    @classmethod
+    def run_batch(cls, jobs, workers=8, rate=None, report=True,
+                  block_if_submitted=False, block_if_stored=False):
+        '''
+        Submit a set of jobs concurrently and store all of them with a
+            single database write
+        :param jobs: jobs to submit
+        :type jobs: list
+        :param workers: maximum number of concurrent submissions
+        :type workers: int
+        :param rate: maximum number of submissions started per second,
+            unlimited if None
+        :type rate: float
+        :param report: passed on to _submit
+        :type report: bool
+        :param block_if_submitted: don't submit jobs which were already
+            submitted
+        :type block_if_submitted: bool
+        :param block_if_stored: passed on to insert
+        :type block_if_stored: bool
+        :returns: doc_ids of the jobs
+        :rtype: list
+        :raises: the first submission error, after the jobs which were
+            submitted successfully have been stored
+        '''
+        jobs = list(jobs)
+        table = load_db().table(cls.__name__)
+        limiter = _RateLimiter(rate)
+
+        def submit(job):
+            limiter.wait()
+            job._submit(report)
+
+        with table.batch(rollback=False):
+            pending = [job for job in jobs
+                       if not (block_if_submitted and job.submitted)]
+            for job in pending:
+                if not job.doc_id:
+                    job.insert(block_if_stored)
+            to_submit = [job for job in pending
+                         if not base.restore_from_cache(job)]
+            errors = []
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(submit, job) for job in to_submit]
+                for job, future in zip(to_submit, futures):
+                    error = future.exception()
+                    if error is not None:
+                        print('Could not submit job hash {}: {}'
+                              .format(job.hash, error))
+                        errors.append(error)
+            if pending:
+                table.write_back(pending,
+                                 doc_ids=[job.doc_id for job in pending])
+        print('Submitted {} of {} jobs'.format(len(to_submit) - len(errors),
+                                               len(to_submit)))
+        if errors:
+            raise errors[0]
+        return [job.doc_id for job in jobs]
         
     def attach(self):
         process = subprocess.Popen(['submit', '--attach', str(self.submit_id)],
@@ -194,8 +285,21 @@ class SubmitJob(Mapping, base.Job):
             shutil.rmtree(self.directory)
         self.doc_id = self.update()
     
-    def check_status(self, update_in_db=False):
-        if not self.submit_id:
+    def check_status(self, update_in_db=False, statuses=None, attach=True):
+        '''
+        Check the status of the job
+        :param update_in_db: Whether to update the job in the database
+        :type update_in_db: bool
+        :param statuses: statuses from submit_statuses, e.g. shared by a
+            set of jobs (see submitjob_statuses). submit --status is run
+            for this job if None.
+        :type statuses: dict
+        :param attach: Whether to run submit --attach if the job is complete
+        :type attach: bool
+        :returns: pretty status dictionary
+        :rtype: dict
+        '''
+        if not (self.submit_id or self.status.get('cached')):
             raise ValueError('Job must have a Submit ID')
         if self.status['status'] == 'Complete':
             pretty_status = {'Submit ID': self.submit_id,
@@ -205,27 +309,19 @@ class SubmitJob(Mapping, base.Job):
                              'Doc ID': self.doc_id}
             return pretty_status
         
-        stdout = subprocess.check_output(['submit', '--status', str(self.submit_id)]).decode('utf-8')
-        if stdout and str(self.submit_id) in stdout:
-            stdout_lines = stdout.strip().split('\n')
-            if len(stdout_lines) > 1:
-                info_line = stdout_lines[-1]
-                runname, id_, instance, status, location = info_line.split()
-                id_, instance = int(id_), int(instance)
-                if id_ == self.submit_id:
-                    self.status = {
-                        'submit_id': id_,
-                        'instance': instance,
-                        'status': status,
-                        'location': location,
-                        'submission_time': self.submission_time,
-                        'doc_id': self.doc_id,
-                        'hash': self.hash
-                    }
+        if statuses is None:
+            statuses = submit_statuses([self.submit_id])
+        status = statuses.get(self.submit_id)
+        if status:
+            self.status = dict(status)
+            self.status.update({'submission_time': self.submission_time,
+                                'doc_id': self.doc_id,
+                                'hash': self.hash})
                     
         if os.path.exists(self.output_path):
             self.status['status'] = 'Complete'
-            self.attach()
+            if attach:
+                self.attach()
             
         if update_in_db:
             self.doc_id = self.update()
@@ -242,6 +338,7 @@ class SubmitJob(Mapping, base.Job):
     
     def parse_output(self, **kwargs):
         output = self.calculation.parse_output(name=self.output_name, directory=self.directory, **kwargs)
+        base.store_in_cache(self)
         self.update()
         return output
         
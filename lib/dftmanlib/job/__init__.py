@@ -1,13 +1,19 @@
 from .SubmitJob import SubmitJob
 from .PBSJob import PBSJob
 from .LocalJob import LocalJob
+from .LocalScheduler import (LocalScheduler, set_default_scheduler,
+                             get_default_scheduler)
 
-from .job import (submitjob_statuses, submit_status, pbsjob_statuses, pbs_status)
+from .job import (submitjob_statuses, submit_status, submit_statuses,
+                  pbsjob_statuses, pbs_status, qstat_statuses,
+                  walltime_to_seconds)
 
 __all__ = [
-    'submitjob_statuses', 'submit_status',
+    'submitjob_statuses', 'submit_status', 'submit_statuses',
     'SubmitJob',
-    'pbsjob_statuses', 'pbs_status',
+    'pbsjob_statuses', 'pbs_status', 'qstat_statuses',
     'PBSJob',
-    'LocalJob'
+    'LocalJob',
+    'walltime_to_seconds',
+    'LocalScheduler', 'set_default_scheduler', 'get_default_scheduler'
 ]
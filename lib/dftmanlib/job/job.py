@@ -2,25 +2,123 @@ from ..db import load_db
 
 import subprocess
 import os
+import re
 import getpass
 import pandas as pd
 
+def walltime_to_seconds(walltime):
+    '''
+    Convert a [[dd:]hh:]mm:ss walltime into seconds
+    :param walltime: walltime, e.g. '01:00:00'
+    :type walltime: str
+    :returns: seconds, or None if the walltime is unknown (e.g. '--')
+    :rtype: float | None
+    '''
+    try:
+        parts = [float(part) for part in str(walltime).split(':')]
+    except ValueError:
+        return None
+    seconds = 0.
+    for factor, part in zip((1, 60, 3600, 86400), reversed(parts)):
+        seconds += factor * part
+    return seconds
+
+
+PBS_STATUS_CODES = {'C': 'Complete',
+                    'E': 'Exiting',
+                    'H': 'Held',
+                    'Q': 'Queued',
+                    'R': 'Running',
+                    'T': 'Moving',
+                    'W': 'Waiting'
+                   }
+
+
+def parse_qstat(text):
+    '''
+    Parse the output of qstat -u into status dictionaries
+    :param text: output of qstat -u
+    :type text: str
+    :returns: {pbs_id: status dictionary}, where the pbs_id of job array
+        elements (listed by qstat -t) is '<pbs_id>[<array index>]'
+    :rtype: dict
+    '''
+    statuses = {}
+    for line in text.strip().split('\n'):
+        fields = line.split()
+        # Skip the header and any line which is not a job
+        if len(fields) != 11:
+            continue
+        id_match = re.match(r'(\d+)(\[\d*\])?$', fields[0].split('.')[0])
+        if not id_match:
+            continue
+        pbs_id, username, queue, runname, session_id,\
+        nnodes, np, reqd_memory, walltime, status, elapsed_time = fields
+        if id_match.group(2):
+            pbs_id = id_match.group(0)
+        else:
+            pbs_id = int(id_match.group(1))
+        statuses[pbs_id] = {
+           'pbs_id': pbs_id,
+           'username': username,
+           'queue': queue,
+           'runname': runname,
+           'session_id': session_id,
+           'nnodes': nnodes,
+           'np': np,
+           'reqd_memory': reqd_memory,
+           'walltime': walltime,
+           'status': PBS_STATUS_CODES.get(status, status),
+           'elapsed_time': elapsed_time
+        }
+    return statuses
+
+
+def qstat_statuses(pbs_ids=None, cwd=None, arrays=False):
+    '''
+    Run qstat once for the user's jobs and parse its output
+    :param pbs_ids: only query these PBS ids, all of the user's jobs if None
+    :type pbs_ids: list
+    :param cwd: directory to run qstat in
+    :type cwd: str
+    :param arrays: list the elements of job arrays (qstat -t)
+    :type arrays: bool
+    :returns: {pbs_id: status dictionary}, see parse_qstat
+    :rtype: dict
+    '''
+    command = ['qstat', '-u', getpass.getuser()]
+    if arrays:
+        command.append('-t')
+    if pbs_ids:
+        command += [str(pbs_id) for pbs_id in pbs_ids]
+    process = subprocess.run(command, cwd=cwd,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+    return parse_qstat(process.stdout.decode('utf-8'))
+
+
 def pbsjob_statuses(jobs, update_in_db=False):
     '''
-    Check the statuses of a set of PBSJobs
+    Check the statuses of a set of PBSJobs with a single qstat call
     :param jobs: Jobs to check status of
     :type jobs: PBSJob
+    :param update_in_db: Whether to update the jobs in the database,
+        which is done with a single write
+    :type update_in_db: bool
     :returns: status data frame
     :rtype: pandas.DataFrame
     '''
+    jobs = list(jobs)
+    statuses = qstat_statuses(arrays=any(job.array_index is not None
+                                         for job in jobs))
     status_dicts = []
     for job in jobs:
-        status_dicts.append(job.check_status())
+        status_dicts.append(job.check_status(statuses=statuses))
     df = pd.DataFrame(status_dicts)
     if not df.empty:
         df = df.set_index('PBS ID')
         df = df[['Run Name', 'Status', 'Elapsed Time', 'Walltime', 'Queue', 'Doc ID']]
-    if update_in_db:
+    if update_in_db and jobs:
         db = load_db()
         table = db.table('PBSJob')
         table.write_back(jobs, doc_ids=[job.doc_id for job in jobs])
@@ -33,69 +131,85 @@ def pbs_status():
     :returns: status data frame
     :rtype: pandas.DataFrame
     '''
-    status_codes = {'C': 'Complete',
-                'E': 'Exiting',
-                'H': 'Held',
-                'Q': 'Queued',
-                'R': 'Running',
-                'T': 'Moving',
-                'W': 'Waiting'
-             }
-    
-    process = subprocess.Popen(['qstat', '-u', getpass.getuser()],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    status_text = process.stdout.read().decode('utf-8').strip()
-    status_lines = status_text.split('\n')
-    
-    if len(status_lines) > 4:
-        status_dicts = []
-        for line in status_lines[4:]:
-            pbs_id, username, queue, runname, session_id,\
-            nnodes, np, reqd_memory, walltime, status, elapsed_time = line.split()
-            status = {
-               'pbs_id': pbs_id.split('.')[0],
-               'username': username,
-               'queue': queue,
-               'runname': runname,
-               'session_id': session_id,
-               'nnodes': nnodes,
-               'np': np,
-               'reqd_memory': reqd_memory,
-               'walltime': walltime,
-               'status': status_codes[status],
-               'elapsed_time': elapsed_time
-            }
-            status_dicts.append(status)
-        status_df = pd.DataFrame(status_dicts).set_index('pbs_id')
+    statuses = qstat_statuses()
+    if statuses:
+        status_df = pd.DataFrame(list(statuses.values())).set_index('pbs_id')
         status_df = status_df[['runname', 'status', 'elapsed_time', 'walltime', 'queue']]
     else:
         status_df = pd.DataFrame([])
     return status_df
         
     
-def submitjob_statuses(jobs, update_in_db=False):
+def submitjob_statuses(jobs, update_in_db=False, attach=False):
     '''
-    Check the statuses of a set of SubmitJobs
+    Check the statuses of a set of SubmitJobs with a single
+        submit --status call
     :param jobs: Jobs to check status of
     :type jobs: SubmitJob
-    :param update_to_db: Whether to update job in database
-    :type update_to_db: bool
+    :param update_in_db: Whether to update the jobs in the database,
+        which is done with a single write
+    :type update_in_db: bool
+    :param attach: Whether to run submit --attach for completed jobs
+    :type attach: bool
     :returns: status data frame
     :rtype: pandas.DataFrame
     '''
+    jobs = list(jobs)
+    statuses = submit_statuses()
     status_dicts = []
     for job in jobs:
-        status_dicts.append(job.check_status())
+        status_dicts.append(job.check_status(statuses=statuses,
+                                             attach=attach))
     df = pd.DataFrame(status_dicts)
     if not df.empty:
         df = df.set_index('Submit ID')
         df = df[['Status', 'Instance', 'Location', 'Doc ID']]
-    if update_in_db:
+    if update_in_db and jobs:
         db = load_db()
         table = db.table('SubmitJob')
         table.write_back(jobs, doc_ids=[job.doc_id for job in jobs])
     return df
+
+
+def parse_submit_status(text):
+    '''
+    Parse the output of submit --status into status dictionaries
+    :param text: output of submit --status
+    :type text: str
+    :returns: {submit_id: status dictionary}
+    :rtype: dict
+    '''
+    statuses = {}
+    for line in text.strip().split('\n')[1:]:
+        fields = line.split()
+        if len(fields) != 5 or not fields[1].isdigit():
+            continue
+        runname, submit_id, instance, status, location = fields
+        submit_id = int(submit_id)
+        statuses[submit_id] = {
+            'submit_id': submit_id,
+            'instance': int(instance),
+            'status': status,
+            'location': location
+        }
+    return statuses
+
+
+def submit_statuses(submit_ids=None):
+    '''
+    Run submit --status once and parse its output
+    :param submit_ids: only query these Submit ids, all of the user's
+        runs if None
+    :type submit_ids: list
+    :returns: {submit_id: status dictionary}, see parse_submit_status
+    :rtype: dict
+    '''
+    command = ['submit', '--status']
+    if submit_ids:
+        command += [str(submit_id) for submit_id in submit_ids]
+    process = subprocess.run(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, check=True)
+    return parse_submit_status(process.stdout.decode('utf-8'))
     
     
 def submit_status():
@@ -104,31 +218,15 @@ def submit_status():
     :returns: status data frame
     :rtype: pandas.DataFrame
     '''
-    process = subprocess.Popen(['submit', '--status'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.wait()
-    stdout = process.stdout.peek().decode('utf-8')
-    stderr = process.stderr.peek().decode('utf-8')
-
-    if process.returncode == 0:
-        status_text = stdout.strip()
-    else:
-        raise subprocess.CalledProcessError
-    
-    nruns = len(status_text) - 1 if len(status_text) else 0
-    if nruns:
-        status_dicts = []
-        statuses = status_text.strip().split('\n')[1:]
-        for status in statuses:
-            status = status.strip().split()
-            status_dict = {
-                'Submit ID': int(status[1]),
-                'Instance': int(status[2]),
-                'Status': status[3],
-                'Location': status[4]
-            }
-            status_dicts.append(status_dict)
+    statuses = submit_statuses()
+    if statuses:
+        status_dicts = [{'Submit ID': status['submit_id'],
+                         'Instance': status['instance'],
+                         'Status': status['status'],
+                         'Location': status['location']}
+                        for status in statuses.values()]
         status_df = pd.DataFrame(status_dicts).set_index('Submit ID')
         status_df = status_df[['Status', 'Instance', 'Location']]
     else:
         status_df = pd.DataFrame([])
-    return status_df
\ No newline at end of file
+    return status_df
@@ -0,0 +1,477 @@
+'''
+Background monitor which keeps the statuses of submitted jobs up to date
+
+The monitor polls the schedulers in bulk (one submit --status and one qstat
+    call per round, see submit_statuses and qstat_statuses), backs off
+    for jobs whose status does not change, optionally parses the outputs
+    of finished jobs (and follows the outputs of running ones, resuming
+    from the previous parse) and writes all changes to the database in batches.
+    Code waiting for jobs can register callbacks, await JobMonitor.wait
+    inside the monitor's event loop or block on JobMonitor.future from
+    any thread.
+
+e.g. in a notebook
+    monitor = JobMonitor(parse=True)
+    monitor.start()
+    monitor.future(job).result()
+or from the shell
+    python -m dftmanlib.monitor --parse
+'''
+import time
+import os.path
+import calendar
+import asyncio
+import logging
+import argparse
+import threading
+
+from .db import load_db
+from .base import store_in_cache
+from .job.job import submit_statuses, qstat_statuses, walltime_to_seconds
+
+JOB_TABLES = ('SubmitJob', 'PBSJob', 'LocalJob')
+# 'Unknown': the process of a LocalJob exited, but how is not known
+FINISHED_STATUSES = ('Complete', 'Error', 'Killed', 'Unknown')
+
+logger = logging.getLogger(__name__)
+
+
+def _elapsed(job):
+    '''
+    Time a job has been running according to its scheduler, or since its
+        submission otherwise
+    :returns: seconds, or None if unknown
+    :rtype: float | None
+    '''
+    elapsed = walltime_to_seconds((job.status or {}).get('elapsed_time'))
+    if elapsed is None and job.submission_time:
+        try:
+            submitted = calendar.timegm(time.strptime(job.submission_time))
+        except ValueError:
+            return None
+        elapsed = time.time() - submitted
+    return elapsed
+
+
+def finished(job):
+    '''
+    Check if a job has finished, successfully or not
+    :rtype: bool
+    '''
+    return (job.status or {}).get('status') in FINISHED_STATUSES
+
+
+def _poll_submitjobs(jobs):
+    statuses = submit_statuses()
+    for job in jobs:
+        job.check_status(statuses=statuses, attach=False)
+
+
+def _poll_pbsjobs(jobs):
+    statuses = qstat_statuses(arrays=any(job.array_index is not None
+                                         for job in jobs))
+    for job in jobs:
+        job.check_status(statuses=statuses)
+
+
+def _poll_localjobs(jobs):
+    for job in jobs:
+        job.check_status()
+
+
+# Functions refreshing the statuses of a list of jobs of one class in bulk
+POLLERS = {
+    'SubmitJob': _poll_submitjobs,
+    'PBSJob': _poll_pbsjobs,
+    'LocalJob': _poll_localjobs,
+}
+
+
+def _merge(document, stored):
+    '''
+    Resolve a write conflict by applying the monitor's changes, i.e. the
+        status and the parsed output, to the stored document
+    '''
+    stored.status = document.status
+    if document.calculation.output is not None:
+        stored.calculation.output = document.calculation.output
+    return stored
+
+
+class JobMonitor(object):
+    '''
+    Monitor which polls the statuses of submitted jobs
+    :param jobs: jobs to monitor. If None, the unfinished submitted jobs
+        in the database are monitored, including ones submitted later.
+    :type jobs: list
+    :param path: path to the database, see load_db
+    :type path: str
+    :param parse: parse the outputs of finished jobs
+    :type parse: bool
+    :param progress: also parse the outputs of running jobs whenever they
+        are polled, e.g. to follow the energies of long relaxations.
+        Only the output appended since the last poll is read.
+    :type progress: bool
+    :param min_interval: minimum seconds between two polls of a job
+    :type min_interval: float
+    :param max_interval: maximum seconds between two polls of a job
+    :type max_interval: float
+    :param backoff: factor by which the interval grows every time the
+        status of a job did not change
+    :type backoff: float
+    :param write_interval: seconds for which changes are collected before
+        they are written to the database
+    :type write_interval: float
+    :param callbacks: functions called with each job when it finishes
+    :type callbacks: list
+    '''
+    def __init__(self, jobs=None, path=None, parse=False, progress=False,
+                 min_interval=30., max_interval=900., backoff=2.,
+                 write_interval=60., callbacks=None):
+        self.path = path
+        self.parse = parse
+        self.progress = progress
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.write_interval = write_interval
+        self.callbacks = list(callbacks or [])
+        self.discover = jobs is None
+
+        self.jobs = {}  # (class name, doc_id): job
+        self._schedule = {}  # (class name, doc_id): (next poll, unchanged)
+        self._waiters = {}  # (class name, doc_id): [asyncio.Future]
+        self._dirty = {}  # (class name, doc_id): job
+        self._last_write = time.time()
+        # Guards the dictionaries above, which are used by the event loop
+        # and by poll in the executor
+        self._lock = threading.RLock()
+
+        self.loop = None
+        self._thread = None
+        self._stopping = None
+
+        for job in jobs or []:
+            self.watch(job)
+
+    @staticmethod
+    def _key(job):
+        return (job.__class__.__name__, job.doc_id)
+
+    def watch(self, job):
+        '''
+        Start monitoring a job
+        :param job: SubmitJob, PBSJob or LocalJob
+        '''
+        key = self._key(job)
+        with self._lock:
+            if key not in self.jobs:
+                self.jobs[key] = job
+                self._schedule[key] = (0., 0)
+
+    def add_callback(self, callback):
+        '''
+        Call a function with each job when it finishes
+        :param callback: function(job)
+        :type callback: callable
+        '''
+        self.callbacks.append(callback)
+
+    def discover_jobs(self):
+        '''
+        Watch all unfinished submitted jobs in the database. Only the
+            status fields of the documents are looked at (see
+            MSONTable.project) and only the jobs which are not watched
+            yet are decoded.
+        '''
+        db = load_db(self.path)
+        for name in JOB_TABLES:
+            if name not in db.tables():
+                continue
+            table = db.table(name)
+            fields = table.project(['submitted', 'status.status'])
+            with self._lock:
+                watched = {doc_id for (name_, doc_id) in self.jobs
+                           if name_ == name}
+            for doc_id, values in fields.items():
+                if (values['submitted'] and doc_id not in watched
+                        and values['status.status']
+                        not in FINISHED_STATUSES):
+                    self.watch(table.get(doc_id=doc_id))
+
+    def interval(self, job, unchanged):
+        '''
+        Seconds until a job is polled again. The interval grows by backoff
+            every time the status of the job did not change, but is
+            shortened as the job approaches its walltime, when it is most
+            likely to finish.
+        :param job: the job
+        :param unchanged: number of polls the status did not change
+        :type unchanged: int
+        :rtype: float
+        '''
+        interval = min(self.min_interval * self.backoff ** unchanged,
+                       self.max_interval)
+        walltime = walltime_to_seconds(getattr(job, 'walltime', None))
+        if walltime and (job.status or {}).get('status') == 'Running':
+            elapsed = _elapsed(job)
+            if elapsed is not None:
+                interval = min(interval, max((walltime - elapsed) / 2,
+                                             self.min_interval))
+        return interval
+
+    def poll(self, now=None):
+        '''
+        Refresh the statuses of all jobs which are due, with one bulk
+            scheduler call per job class, and parse the outputs of the
+            jobs which finished if parse is True and of the running jobs
+            if progress is True
+        :param now: current time.time()
+        :type now: float
+        :returns: the jobs which finished
+        :rtype: list
+        '''
+        now = now or time.time()
+        due = {}
+        with self._lock:
+            for key, job in self.jobs.items():
+                if self._schedule[key][0] <= now:
+                    due.setdefault(key[0], []).append((key, job))
+
+        done = []
+        for name, items in due.items():
+            before = [dict(job.status or {}) for key, job in items]
+            try:
+                POLLERS[name]([job for key, job in items])
+            except Exception:
+                logger.exception('Could not poll %s statuses', name)
+                # Retry the whole class later
+                with self._lock:
+                    for key, job in items:
+                        next_poll, unchanged = self._schedule[key]
+                        self._schedule[key] = (
+                            now + self.interval(job, unchanged + 1),
+                            unchanged + 1)
+                continue
+            for (key, job), status in zip(items, before):
+                changed = (job.status or {}) != status
+                if finished(job):
+                    if self.parse:
+                        self._parse(job, incremental=self.progress)
+                    done.append(job)
+                elif (self.progress
+                      and (job.status or {}).get('status') == 'Running'
+                      and os.path.exists(os.path.join(job.directory,
+                                                      job.output_name))):
+                    # Not a status change, written with the next batch
+                    if self._parse(job, incremental=True):
+                        with self._lock:
+                            self._dirty[key] = job
+                unchanged = 0 if changed else self._schedule[key][1] + 1
+                with self._lock:
+                    if changed or finished(job):
+                        self._dirty[key] = job
+                    if finished(job):
+                        del self.jobs[key]
+                        del self._schedule[key]
+                    else:
+                        self._schedule[key] = (
+                            now + self.interval(job, unchanged), unchanged)
+        return done
+
+    def _parse(self, job, incremental=False):
+        try:
+            job.calculation.parse_output(name=job.output_name,
+                                         directory=job.directory,
+                                         incremental=incremental)
+            store_in_cache(job)
+        except Exception:
+            logger.exception('Could not parse the output of %s %s',
+                             job.__class__.__name__, job.doc_id)
+            return False
+        return True
+
+    def flush(self):
+        '''
+        Write all changed jobs to the database, with one write per
+            job class
+        '''
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        by_table = {}
+        for (name, doc_id), job in dirty.items():
+            by_table.setdefault(name, []).append(job)
+        try:
+            db = load_db(self.path)
+            with db.transaction():
+                for name, jobs in by_table.items():
+                    db.table(name).write_back(
+                        jobs, doc_ids=[job.doc_id for job in jobs],
+                        on_conflict=_merge)
+        except Exception:
+            # Keep the changes for the next write
+            with self._lock:
+                dirty.update(self._dirty)
+                self._dirty = dirty
+            raise
+        self._last_write = time.time()
+
+    def _finish(self, jobs):
+        for job in jobs:
+            for callback in self.callbacks:
+                try:
+                    callback(job)
+                except Exception:
+                    logger.exception('Callback %r failed', callback)
+            for waiter in self._waiters.pop(self._key(job), []):
+                if not waiter.done():
+                    waiter.set_result(job)
+
+    async def wait(self, job):
+        '''
+        Wait for a job to finish. Must be awaited in the monitor's
+            event loop, see future otherwise.
+        :returns: the finished job
+        '''
+        key = self._key(job)
+        with self._lock:
+            watched = key in self.jobs
+        if not watched:
+            if finished(job):
+                return job
+            self.watch(job)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, []).append(waiter)
+        return await waiter
+
+    def future(self, job):
+        '''
+        Wait for a job to finish from another thread or event loop, e.g.
+            monitor.future(job).result() or
+            await asyncio.wrap_future(monitor.future(job))
+        Requires a monitor running in the background, see start.
+        :returns: future resolving to the finished job
+        :rtype: concurrent.futures.Future
+        '''
+        if self.loop is None:
+            raise RuntimeError('The monitor is not running, call start()')
+        return asyncio.run_coroutine_threadsafe(self.wait(job), self.loop)
+
+    async def run(self, once=False, forever=None):
+        '''
+        Poll until stop is called, or until all jobs finished if jobs
+            were given (or once is True)
+        :param once: poll only once
+        :type once: bool
+        :param forever: keep running when all jobs finished, e.g. to
+            wait for more jobs, defaults to True if jobs are discovered
+            from the database
+        :type forever: bool
+        '''
+        if forever is None:
+            forever = self.discover
+        self.loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        try:
+            while not self._stopping.is_set():
+                if self.discover:
+                    await self.loop.run_in_executor(None, self.discover_jobs)
+                done = await self.loop.run_in_executor(None, self.poll)
+                if (done or once or not self.jobs
+                        or time.time() - self._last_write
+                        >= self.write_interval):
+                    try:
+                        await self.loop.run_in_executor(None, self.flush)
+                    except Exception:
+                        logger.exception('Could not write job statuses')
+                self._finish(done)
+                if once or not (self.jobs or forever):
+                    break
+                now = time.time()
+                with self._lock:
+                    next_poll = min([next_poll for next_poll, unchanged
+                                     in self._schedule.values()]
+                                    or [now + self.min_interval])
+                delay = min(max(next_poll - now, 1.), self.write_interval)
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.loop.run_in_executor(None, self.flush)
+            self.loop = None
+
+    def start(self):
+        '''
+        Run the monitor in a background thread
+        :returns: self
+        '''
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        started = threading.Event()
+
+        def target():
+            async def main():
+                task = asyncio.ensure_future(self.run(forever=True))
+                # Wait for run to set up the loop and the stop event
+                await asyncio.sleep(0)
+                started.set()
+                await task
+            asyncio.run(main())
+
+        self._thread = threading.Thread(target=target, daemon=True,
+                                        name='dftman-monitor')
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self, timeout=None):
+        '''
+        Stop the monitor after writing the pending changes
+        :param timeout: seconds to wait for the background thread
+        :type timeout: float
+        '''
+        loop = self.loop
+        if loop is not None and self._stopping is not None:
+            loop.call_soon_threadsafe(self._stopping.set)
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Monitor the unfinished jobs in a DFTman database')
+    parser.add_argument('--db', default=None,
+                        help='path to the database')
+    parser.add_argument('--parse', action='store_true',
+                        help='parse the outputs of finished jobs')
+    parser.add_argument('--progress', action='store_true',
+                        help='parse the outputs of running jobs')
+    parser.add_argument('--min-interval', type=float, default=30.)
+    parser.add_argument('--max-interval', type=float, default=900.)
+    parser.add_argument('--write-interval', type=float, default=60.)
+    parser.add_argument('--once', action='store_true',
+                        help='poll once and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    monitor = JobMonitor(path=args.db, parse=args.parse,
+                         progress=args.progress,
+                         min_interval=args.min_interval,
+                         max_interval=args.max_interval,
+                         write_interval=args.write_interval,
+                         callbacks=[lambda job: logger.info(
+                             '%s %s finished: %s', job.__class__.__name__,
+                             job.doc_id, job.status.get('status'))])
+    try:
+        asyncio.run(monitor.run(once=args.once))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 from . import qes
+from .. import base
 import warnings
 import pprint
 import numpy as np
@@ -36,17 +37,44 @@ class PWXML(object):
         generateDS.py parser (often generates a lot of warnings about vector representations
         which are annoying)
     '''
+    # Attributes set by _parse
+    _PARSED = ('_output', '_input', '_units', '_cputime', '_general_info',
+               '_parallel_info', '_status', '_step')
+
     def __init__(self, xml_string, xml_path=None, encoding='utf-8', silence=True, show_warnings=False):
-        self.xml_string = xml_string
         self.xml_path = xml_path
         self.encoding=encoding
+        self.silence = silence
+        self.show_warnings = show_warnings
+        if isinstance(xml_string, base.BlobRef):
+            # Loaded and parsed on first access, see __getattr__
+            self._xml_string = None
+            self._xml_ref = xml_string
+        else:
+            self._xml_string = xml_string
+            self._xml_ref = None  # BlobRef of xml_string once stored
+            self._parse()
+
+    def __getattr__(self, name):
+        if name in self._PARSED:
+            self._parse()
+            return self.__dict__[name]
+        raise AttributeError("'{}' object has no attribute '{}'"
+                             .format(self.__class__.__name__, name))
 
-        if show_warnings:
-            espresso = qes.parseString(inString=bytes(xml_string, self.encoding), silence=silence)  # espressoType
+    @property
+    def xml_string(self):
+        if self._xml_string is None:
+            self._xml_string = self._xml_ref.load()
+        return self._xml_string
+
+    def _parse(self):
+        if self.show_warnings:
+            espresso = qes.parseString(inString=bytes(self.xml_string, self.encoding), silence=self.silence)  # espressoType
         else:
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                espresso = qes.parseString(inString=bytes(xml_string, self.encoding), silence=silence)  # espressoType
+                espresso = qes.parseString(inString=bytes(self.xml_string, self.encoding), silence=self.silence)  # espressoType
 
         self._output = espresso.output  # outputType
         self._input = espresso.input  # inputType
@@ -677,7 +705,12 @@ class PWXML(object):
     
     @classmethod
     def from_dict(cls, pwxml_dict, silence=True, show_warnings=False):
-        return cls(xml_string=pwxml_dict['xml_string'],
+        xml_string = pwxml_dict['xml_string']
+        if base.BlobRef.is_ref_dict(xml_string):
+            # Resolved now, against the store of the database being read,
+            # but only loaded on first access
+            xml_string = base.BlobRef.from_dict(xml_string)
+        return cls(xml_string=xml_string,
                    xml_path=pwxml_dict['xml_path'],
                    encoding=pwxml_dict['encoding'],
                    silence=silence, show_warnings=show_warnings)
@@ -690,7 +723,20 @@ class PWXML(object):
                    silence=silence, show_warnings=show_warnings)
 
     def as_dict(self):
-        pwxml_dict = {'xml_string': self.xml_string,
+        # The XML file is kept in the blob store instead of the document
+        # when stored, see dftmanlib.base.use_blob_store
+        store = base.get_blob_store()
+        if store is not None:
+            if self._xml_ref is None:
+                self._xml_ref = base.BlobRef.from_value(self.xml_string,
+                                                        store=store)
+            else:
+                self._xml_ref = self._xml_ref.stored_in(store)
+        if self._xml_ref is not None:
+            xml_string = self._xml_ref.as_dict()
+        else:
+            xml_string = self.xml_string
+        pwxml_dict = {'xml_string': xml_string,
                       'xml_path': self.xml_path,
                       'encoding': self.encoding,
                       'output': self.output,
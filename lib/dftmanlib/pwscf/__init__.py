@@ -1,11 +1,16 @@
 from .pwscf import (PWInput, PWOutput, PWCalculation)
 from .helpers import (pseudo_helper, pwinput_helper,
                       pwcalculation_helper, pseudo_table)
+from .restart import (restart_job, restart_jobs)
+from .parse import parse_outputs
 from . import pwoutput
+from . import pwparser
 from . import workflow
 
 __all__ = [
     'PWInput', 'PWOutput', 'PWCalculation',
     'pseudo_helper', 'pwinput_helper', 'pwcalculation_helper',
-    'pseudo_table'
+    'pseudo_table',
+    'restart_job', 'restart_jobs',
+    'parse_outputs'
 ] 
\ No newline at end of file
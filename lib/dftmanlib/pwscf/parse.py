@@ -0,0 +1,147 @@
+import os
+import os.path
+from concurrent.futures import ProcessPoolExecutor
+
+from .. import base
+from . import pwoutput
+from . import pwparser
+from .pwscf import PWOutput
+
+
+def _portable(patterns):
+    '''
+    Patterns which can be sent to worker processes: the keys of the
+        default patterns (whose postprocessing functions may be lambdas)
+        and the other patterns themselves
+    '''
+    return {key: key if value is pwoutput.patterns.get(key) else value
+            for key, value in patterns.items()}
+
+
+def _parse_file(task):
+    '''
+    Parse one output file in a worker process
+    :param task: (path, portable patterns, engine)
+    :returns: ({key: [values]}, file identity, None), or
+        (None, None, error message)
+    :rtype: tuple
+    '''
+    path, patterns, engine = task
+    patterns = {key: pwoutput.patterns[value] if isinstance(value, str)
+                else value for key, value in patterns.items()}
+    try:
+        identity = base.file_identity(path)
+        if engine == 'regex':
+            return pwparser.parse_regex(path, patterns), identity, None
+        return pwparser.parse_stdout(path, patterns), identity, None
+    except Exception as error:
+        return None, None, '{}: {}'.format(error.__class__.__name__, error)
+
+
+def parse_outputs(jobs, workers=None, chunksize=None, engine='regex',
+                  patterns=pwoutput.patterns, properties=None,
+                  update_to_db=True, report=True, force=False):
+    '''
+    Parse the outputs of many pw.x jobs with a pool of worker processes
+        and store all of them with a single database write, e.g.
+        parse_outputs(complete_jobs, properties=['final_energy'])
+    The workers only get the output file paths and send back the parsed
+        data (lists of numbers and strings), from which the PWOutputs are
+        built here. Outputs which did not change since they were last
+        parsed are not parsed again, see PWOutput.cached.
+    :param jobs: jobs whose outputs to parse
+    :type jobs: list
+    :param workers: number of worker processes, defaults to the number of
+        CPUs. The outputs are parsed in this process if 1.
+    :type workers: int
+    :param chunksize: number of outputs sent to a worker at once, defaults
+        to a quarter of the outputs per worker
+    :type chunksize: int
+    :param engine: 'regex' or 'lines', see PWOutput.parse_output
+    :type engine: str
+    :param patterns: patterns, see dftmanlib.pwscf.pwoutput. Patterns
+        which are not default patterns have to be picklable.
+    :type patterns: dict
+    :param properties: only parse what these properties need, the other
+        patterns are parsed on first access (see PWOutput.parse_output)
+    :type properties: list
+    :param update_to_db: write the jobs to the database
+    :type update_to_db: bool
+    :param report: print the number of parsed outputs
+    :type report: bool
+    :param force: parse the outputs even if they did not change
+    :type force: bool
+    :returns: outputs in the order of the jobs, None for the outputs
+        which could not be parsed
+    :rtype: list
+    '''
+    if engine not in ('regex', 'lines'):
+        raise ValueError('Unknown parser engine {}'.format(engine))
+    jobs = list(jobs)
+    workers = workers or os.cpu_count() or 1
+    selected = patterns
+    if properties is not None:
+        properties = list(properties)
+        if base.get_result_cache() is not None:
+            # Needed to store the results in the cache
+            properties.append('succeeded')
+        selected = pwoutput.select(properties, patterns)
+
+    paths = [os.path.join(job.directory, job.output_name) for job in jobs]
+    outputs = [None if force else
+               PWOutput.cached(path, patterns, job.calculation.output)
+               for job, path in zip(jobs, paths)]
+    todo = [i for i, output in enumerate(outputs) if output is None]
+    tasks = [(paths[i], _portable(selected), engine) for i in todo]
+    if workers == 1 or len(tasks) < 2:
+        results = [_parse_file(task) for task in tasks]
+    else:
+        if chunksize is None:
+            chunksize = max(1, len(tasks) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_parse_file, tasks,
+                                        chunksize=chunksize))
+
+    for job, output in zip(jobs, outputs):
+        if output is not None:
+            job.calculation.output = output
+    parsed = []
+    deferred = [key for key in patterns if key not in selected]
+    for i, (data, identity, error) in zip(todo, results):
+        job = jobs[i]
+        if error is not None:
+            print('Could not parse {}: {}'.format(paths[i], error))
+            continue
+        output = PWOutput(filename=paths[i], data=data, patterns=patterns,
+                          deferred=deferred, engine=engine,
+                          identity=identity)
+        output.save_parsed()
+        calculation = job.calculation
+        calculation.output_name = job.output_name
+        calculation.directory = job.directory
+        calculation.output = output
+        calculation.output_type = 'stdout'
+        outputs[i] = output
+        parsed.append(job)
+
+    if parsed and (update_to_db or base.get_result_cache() is not None):
+        # Imported here, dftmanlib.db imports this package
+        from ..db import load_db
+        db = load_db()
+        with db.transaction(rollback=False):
+            for job in parsed:
+                base.store_in_cache(job)
+            if update_to_db:
+                by_table = {}
+                for job in parsed:
+                    if job.doc_id:
+                        by_table.setdefault(job.__class__.__name__,
+                                            []).append(job)
+                for name, table_jobs in by_table.items():
+                    db.table(name).write_back(
+                        table_jobs,
+                        doc_ids=[job.doc_id for job in table_jobs])
+    if report:
+        print('Parsed {} of {} outputs, {} were unchanged'.format(
+            len(parsed), len(jobs), len(jobs) - len(todo)))
+    return outputs
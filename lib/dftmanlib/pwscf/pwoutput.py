@@ -1,6 +1,13 @@
 import re
 import numpy as np
 
+def _time_post(match):
+    # e.g. '1h23m', '2m 3.45s' or '12.34s'
+    seconds = 0.
+    for value, unit in re.findall(r'([\d\.]+)\s*([hms])', match):
+        seconds += float(value) * {'h': 3600., 'm': 60., 's': 1.}[unit]
+    return seconds
+
 def _stress_post(match):
     lines = match.strip().split('\n')
     matrix = np.array([[float(stress)
@@ -146,10 +153,15 @@ patterns = {
         'postprocess': float,
     },
     'conv_iters': {
-        'pattern': r'convergence has been achieved in\s+([\d+]) iterations',
+        'pattern': r'convergence has been achieved in\s+(\d+) iterations',
         'flags': [],
         'postprocess': int,
     },
+    'scf_accuracy': {
+        'pattern': r'estimated scf accuracy\s+<\s+([\d\.\-E]+)\s+Ry',
+        'flags': [],
+        'postprocess': float,
+    },
     'cell_parameters': {
         'pattern': r'CELL\_PARAMETERS\s+\(angstrom\)\s+([\s\d\.\-]+)^$',
         'flags': [re.MULTILINE],
@@ -175,6 +187,11 @@ patterns = {
         'flags': [re.MULTILINE],
         'postprocess': lambda x: str(x).strip(),
     },
+    'wall_time': {
+        'pattern': r'PWSCF\s+:.+CPU\s+(.+)\s+WALL',
+        'flags': [],
+        'postprocess': _time_post,
+    },
     'lattice_type': {
         'pattern': r'bravais\-lattice index\s+=\s+(\d+)',
         'flags': [],
@@ -399,3 +416,57 @@ fast_patterns = patterns.copy()
 del fast_patterns['bands_data']
 del fast_patterns['kpoints_cart']
 del fast_patterns['kpoints_frac']
+
+# Pattern keys (or other properties) which the properties of PWOutput
+# are computed from, see select
+requires = {
+    'structures': ['lattice_parameter', 'a1', 'a2', 'a3',
+                   'initial_atomic_positions_frac',
+                   'cell_parameters', 'atomic_positions'],
+    'initial_structure': ['structures'],
+    'final_structure': ['structures'],
+    'initial_volume': ['unit_cell_volume'],
+    'final_volume': ['unit_cell_volume'],
+    'final_stress': ['stress'],
+    'final_total_stress': ['total_stress'],
+    'final_force': ['force'],
+    'final_total_force': ['total_force'],
+    'scf_iterations': ['conv_iters'],
+    'succeeded': ['cpu_time_exceeded', 'max_steps_reached',
+                  'wentzcovitch_max_reached',
+                  'not_electronically_converged',
+                  'eigenvalues_not_converged', 'general_error', 'job_done'],
+    'restartable': ['cpu_time_exceeded', 'max_steps_reached'],
+}
+
+def required(names):
+    '''
+    Pattern keys needed to compute properties of PWOutput
+    :param names: PWOutput properties (e.g. 'final_structure') or pattern
+        keys (e.g. 'final_energy')
+    :type names: list
+    :returns: pattern keys
+    :rtype: list
+    '''
+    keys = []
+    names = list(names)
+    while names:
+        name = names.pop(0)
+        if name in requires:
+            names.extend(requires[name])
+        elif name not in keys:
+            keys.append(name)
+    return keys
+
+def select(names, patterns=patterns):
+    '''
+    Patterns needed to compute properties of PWOutput, e.g.
+        select(['final_energy', 'succeeded'])
+    :param names: PWOutput properties or pattern keys
+    :type names: list
+    :param patterns: patterns to select from
+    :type patterns: dict
+    :returns: {key: pattern}
+    :rtype: dict
+    '''
+    return {key: patterns[key] for key in required(names) if key in patterns}
@@ -0,0 +1,666 @@
+import os
+import re
+import sys
+import copy
+import time
+import argparse
+
+from collections import defaultdict
+
+from monty.io import zopen
+
+from . import pwoutput
+
+# Literal which is part of every line matched by the pattern of a key,
+# lines without it are not matched against the pattern
+TRIGGERS = {
+    'energy': 'total energy',
+    'final_energy': 'total energy',
+    'enthalpy': 'enthalpy new',
+    'final_enthalpy': 'Final enthalpy',
+    'density': 'g/cm^3',
+    'warning': 'Warning:',
+    'total_magnetization': 'total magnetization',
+    'absolute_magnetization': 'absolute magnetization',
+    'total_stress': 'stress',
+    'total_force': 'Total force',
+    'fermi_energy': 'the Fermi energy is',
+    'conv_iters': 'convergence has been achieved in',
+    'scf_accuracy': 'estimated scf accuracy',
+    'version': 'Program PWSCF v',
+    'date': 'Program PWSCF v',
+    'time': 'Program PWSCF v',
+    'wall_time': 'WALL',
+    'lattice_type': 'bravais-lattice index',
+    'lattice_parameter': 'lattice parameter (alat)',
+    'unit_cell_volume': 'unit-cell volume',
+    'nat': 'number of atoms/cell',
+    'ntype': 'number of atomic types',
+    'nelectrons': 'number of electrons',
+    'nks_states': 'number of Kohn-Sham states=',
+    'ecutwfc': 'kinetic-energy cutoff',
+    'echutrho': 'charge density cutoff',
+    'conv_thr': 'convergence threshold',
+    'mixing_beta': 'mixing beta',
+    'niter': 'number of iterations used',
+    'exc': 'Exchange-correlation',
+    'celldm1': 'celldm(',
+    'celldm2': 'celldm(',
+    'celldm3': 'celldm(',
+    'celldm4': 'celldm(',
+    'celldm5': 'celldm(',
+    'celldm6': 'celldm(',
+    'a1': 'a(',
+    'a2': 'a(',
+    'a3': 'a(',
+    'b1': 'b(',
+    'b2': 'b(',
+    'b3': 'b(',
+    'nsymop': 'Sym. Ops.',
+    'nkpts': 'number of k points=',
+    'smearing': 'number of k points=',
+    'degauss': 'number of k points=',
+    'vdw_correction': 'Carrying out vdW-DF run',
+    'job_done': 'JOB DONE.',
+    'not_electronically_converged': 'SCF convergence NOT achieved',
+    'cpu_time_exceeded': 'Maximum CPU time exceeded',
+    'max_steps_reached': 'The maximum number of ionic/electronic',
+    'wentzcovitch_max_reached': 'Wentzcovitch Damped Dynamics',
+    'eigenvalues_not_converged': 'eigenvalues not converged',
+    'deprecated_feature_used': 'DEPRECATED',
+    'scf_correction_too_large': 'SCF correction compared to forces',
+}
+
+# Triggers which can be found on lines starting with a number, all other
+# triggers are only looked for on lines starting with something else
+NUMERIC_TRIGGERS = {'Sym. Ops.'}
+_NUMERIC_START = set('0123456789-+.')
+# Lines of numbers only, e.g. of the bands, can't contain a trigger or the
+# terminator of a _Span and are skipped while only _Spans are active
+_NUMBERS_ONLY = re.compile(rb'[ \t\d\.\-\+]*\r?\n?')
+
+_ERROR_BOX = '%' * 78
+
+
+class _Rows(object):
+    '''
+    Section of the rows following a header while they consist of the
+        characters of a pattern, e.g. the stress tensor or the final
+        coordinates of a relaxation
+    :param until_empty: the match ends at the last empty line of the rows,
+        otherwise it ends with the rows
+    '''
+    # Whether the section only looks for text, see _NUMBERS_ONLY
+    textual = False
+
+    def __init__(self, key, head, row, until_empty):
+        self.key = key
+        self.lines = [head]
+        self.row = row
+        self.until_empty = until_empty
+
+    def feed(self, parser, line, offset):
+        if self.row.fullmatch(line):
+            self.lines.append(line)
+            return False
+        self.close(parser)
+        return True
+
+    def close(self, parser, eof=False):
+        lines = self.lines
+        if self.until_empty:
+            # The first line is the rest of the header line
+            ends = [i for i, line in enumerate(lines)
+                    if i and line == '\n']
+            if eof and lines[-1].endswith('\n'):
+                ends.append(len(lines))
+            if not ends:
+                return
+            lines = lines[:ends[-1]]
+        text = ''.join(lines)
+        if text.strip():
+            parser.emit(self.key, text)
+
+
+class _Span(object):
+    '''
+    Section from a start position up to the next terminator, e.g. the
+        bands up to the Fermi energy. Only the file offset of the start
+        is kept, the text is read back when the terminator is found.
+    '''
+    textual = True
+
+    def __init__(self, key, head, start, terminator, literal=None):
+        self.key = key
+        self.head = head
+        self.start = start
+        self.terminator = terminator
+        self.literal = literal
+
+    def feed(self, parser, line, offset):
+        if self.literal is not None and self.literal not in line:
+            return False
+        match = self.terminator.search(line)
+        if not match:
+            return False
+        text = self.head + parser.read(self.start, offset) \
+            + line[:match.start()]
+        parser.emit(self.key, text)
+        return True
+
+    def close(self, parser, eof=False):
+        # No terminator, no match
+        pass
+
+
+class _Header(object):
+    '''
+    Multi-line header of a section, e.g. 'Cartesian axes', empty lines
+        and the 'site n. atom positions' line, which starts the section on
+        the next line
+    :param skip_blank: allow blank lines before the header line
+    '''
+    textual = False
+
+    def __init__(self, key, header, section, skip_blank=True):
+        self.key = key
+        self.header = header
+        self.section = section
+        self.skip_blank = skip_blank
+
+    def feed(self, parser, line, offset):
+        if self.skip_blank and not line.strip():
+            return False
+        if self.header.match(line):
+            parser.start(self.section(parser.end))
+        return True
+
+    def close(self, parser, eof=False):
+        pass
+
+
+class _Force(object):
+    '''
+    Forces block, of which the pattern matches the first atom only
+    '''
+    textual = False
+    atom = re.compile(r'\s*atom\s+([\d]+)\s+type\s+([\d]+)\s+force\s+=\s+'
+                      r'([\s\d\.\-]+)')
+
+    def __init__(self, key):
+        self.key = key
+        self.empty = False
+
+    def feed(self, parser, line, offset):
+        if not self.empty:
+            # The header has to be followed by an empty line
+            self.empty = line == '\n'
+            return not self.empty
+        if not line.strip():
+            return False
+        match = self.atom.match(line)
+        if match:
+            parser.emit(self.key, match.groups(), text=False)
+        return True
+
+    def close(self, parser, eof=False):
+        pass
+
+
+class _KpointsFrac(object):
+    '''
+    Crystal coordinates of the k-points: from the first k-point, to the
+        next 'cryst. coord.' and from there up to the 'Dense grid' line
+    '''
+    textual = True
+    cryst = re.compile(r'cryst\.\s+coord\.')
+    dense = re.compile(r'Dense\s+grid')
+
+    def __init__(self, key):
+        self.key = key
+        self.span = None
+
+    def feed(self, parser, line, offset):
+        if self.span is not None:
+            return self.span.feed(parser, line, offset)
+        match = self.cryst.search(line)
+        if match:
+            self.span = _Span(self.key, line[match.end():],
+                              parser.end, self.dense,
+                              literal='Dense')
+        return False
+
+    def close(self, parser, eof=False):
+        pass
+
+
+class PWStdoutParser(object):
+    '''
+    Parser for pw.x standard output, which walks the file once, line by
+        line, instead of searching the whole text for every pattern as
+        PWOutput.read_patterns does. It gives the same data.
+    Single-line patterns are only matched against lines which contain a
+        literal part of them (see TRIGGERS). Multi-line patterns (stress,
+        forces, bands, k-points, coordinates and error messages) are
+        parsed by section state machines, which are started by the line
+        of their header and fed the following lines until their section
+        ends. Patterns which are not known to the parser are matched
+        against every line if they are single-line patterns and against
+        the whole text otherwise.
+    The parser keeps its position in the file and the state of its
+        sections as a checkpoint, so update() only reads what was appended
+        to a growing output since the last call, e.g.
+        parser = PWStdoutParser()
+        data = parser.parse('dftman.stdout')
+        ...
+        data = parser.update()
+    :param patterns: patterns, see dftmanlib.pwscf.pwoutput
+    :type patterns: dict
+    '''
+    def __init__(self, patterns=pwoutput.patterns):
+        self.patterns = patterns
+        self._triggers = defaultdict(list)
+        self._every_line = []
+        self._text_patterns = {}
+        for key, value in patterns.items():
+            default = pwoutput.patterns.get(key)
+            known = (default is not None
+                     and value['pattern'] == default['pattern']
+                     and value['flags'] == default['flags'])
+            if known and key in TRIGGERS:
+                self._triggers[TRIGGERS[key]].append(self._rule(key, value))
+            elif known and key in self._section_starts:
+                trigger, start = self._section_starts[key]
+                self._triggers[trigger].append(self._starter(key, start))
+            elif (re.DOTALL & sum(value['flags'])
+                  or '\\n' in value['pattern']):
+                self._text_patterns[key] = value
+            else:
+                self._every_line.append(self._rule(key, value))
+        self._triggers = dict(self._triggers)
+        # All triggers of a line are found with one search, the lookahead
+        # also finds overlapping ones
+        self._trigger_re = self._compile_triggers(self._triggers)
+        self._numeric_trigger_re = self._compile_triggers(
+            [trigger for trigger in self._triggers
+             if trigger in NUMERIC_TRIGGERS])
+
+    @staticmethod
+    def _compile_triggers(triggers):
+        if not triggers:
+            return None
+        # Longest first, so no trigger hides one it is a prefix of
+        triggers = sorted(triggers, key=len, reverse=True)
+        return re.compile('(?=({}))'.format(
+            '|'.join(re.escape(trigger) for trigger in triggers)))
+
+    def _rule(self, key, value):
+        pattern = re.compile(value['pattern'], *value['flags'])
+        postprocess = value['postprocess']
+
+        def rule(line, offset):
+            for match in pattern.findall(line):
+                self.data[key].append(postprocess(match))
+        return rule
+
+    def _starter(self, key, start):
+        def rule(line, offset):
+            # Like findall, don't start a match of a key on a line which
+            # is part of the previous one
+            if key not in self._ended and key not in self._sections:
+                start(self, key, line, offset)
+        return rule
+
+    # Starters of the sections of multi-line patterns
+    def _start_stress(self, key, line, offset):
+        match = self._stress_header.search(line)
+        if match:
+            self.start(_Rows(key, line[match.end():], self._stress_row,
+                             until_empty=False))
+
+    def _start_rows(self, key, line, offset):
+        header, row = self._rows_headers[key]
+        match = header.search(line)
+        if match and row.fullmatch(line[match.end():]):
+            self.start(_Rows(key, line[match.end():], row, until_empty=True))
+
+    def _start_force(self, key, line, offset):
+        if line.rstrip('\n').endswith(
+                'Forces acting on atoms (cartesian axes, Ry/au):'):
+            self.start(_Force(key))
+
+    def _start_bands(self, key, line, offset):
+        if line.endswith('End of self-consistent calculation\n'):
+            # The pattern needs an empty line after the header
+            self.start(_Header(key, re.compile(r'\n'), lambda start: _Span(
+                key, '', start, re.compile('the Fermi energy is'),
+                literal='the Fermi energy is'), skip_blank=False))
+
+    def _start_positions(self, key, line, offset):
+        axes, header, terminator = self._positions_headers[key]
+        index = line.find(axes)
+        if index >= 0 and not line[index + len(axes):].strip():
+            self.start(_Header(key, header, lambda start: _Span(
+                key, '', start, terminator, literal=terminator.pattern)))
+
+    def _start_kpoints_cart(self, key, line, offset):
+        marker = 'cart. coord. in units 2pi/alat'
+        index = line.find(marker)
+        self.start(_Span(key, line[index + len(marker):],
+                         self.end,
+                         re.compile(r'cryst\. coord\.'),
+                         literal='cryst. coord.'))
+
+    def _start_kpoints_frac(self, key, line, offset):
+        self.start(_KpointsFrac(key))
+
+    def _start_error(self, key, line, offset):
+        index = line.find(_ERROR_BOX) + len(_ERROR_BOX)
+        head = line[index:]
+        end = head.find(_ERROR_BOX)
+        if end >= 0:
+            self.emit(key, head[:end])
+        else:
+            self.start(_Span(key, head, self.end,
+                             re.compile(_ERROR_BOX), literal=_ERROR_BOX))
+
+    _section_starts = {
+        'stress': ('stress', _start_stress),
+        'cell_parameters': ('CELL_PARAMETERS', _start_rows),
+        'atomic_positions': ('ATOMIC_POSITIONS', _start_rows),
+        'force': ('Forces acting on atoms', _start_force),
+        'bands_data': ('End of self-consistent calculation', _start_bands),
+        'initial_atomic_positions_cart': ('Cartesian axes',
+                                          _start_positions),
+        'initial_atomic_positions_frac': ('Crystallographic axes',
+                                          _start_positions),
+        'kpoints_cart': ('cart. coord. in units 2pi/alat',
+                         _start_kpoints_cart),
+        'kpoints_frac': ('k( ', _start_kpoints_frac),
+        'general_error': (_ERROR_BOX, _start_error),
+    }
+    _stress_header = re.compile(r'total\s+stress\s+\(Ry\/bohr\*\*3\)\s+'
+                                r'\(kbar\)\s+P=\s+[\d\.\-]+(?=\n)')
+    _stress_row = re.compile(r'[\s\d\.\-]*')
+    _rows_headers = {
+        'cell_parameters': (re.compile(r'CELL\_PARAMETERS\s+\(angstrom\)'),
+                            re.compile(r'[\s\d\.\-]*')),
+        'atomic_positions': (re.compile(r'ATOMIC_POSITIONS\s+\(crystal\)'),
+                             re.compile(r'[\w\s\d\.\-\n]*')),
+    }
+    _positions_headers = {
+        'initial_atomic_positions_cart': (
+            'Cartesian axes',
+            re.compile(r'\s*site n\.\s+atom\s+positions \(alat units\)\n'),
+            re.compile('Crystallographic')),
+        'initial_atomic_positions_frac': (
+            'Crystallographic axes',
+            re.compile(r'\s*site n\.\s+atom\s+positions '
+                       r'\(cryst\. coord\.\)\n'),
+            re.compile('number')),
+    }
+
+    def start(self, section):
+        self._sections[section.key] = section
+        self._changed = True
+
+    def emit(self, key, match, text=True):
+        if text:
+            match = match.replace('\r\n', '\n')
+        self.data[key].append(self.patterns[key]['postprocess'](match))
+
+    def read(self, start, end):
+        '''
+        Read back a part of the file
+        :param start: start offset in bytes
+        :param end: end offset in bytes
+        :rtype: str
+        '''
+        if self._reader is None:
+            self._reader = zopen(self.filename, 'rb')
+        self._reader.seek(start)
+        return self._reader.read(end - start).decode('utf-8', 'replace')
+
+    def feed(self, line, offset):
+        '''
+        Parse one line
+        :param line: line including its newline
+        :type line: str
+        :param offset: offset of the line in the file in bytes, the
+            offset of the next line is kept in self.end
+        :type offset: int
+        '''
+        if self._ended:
+            self._ended.clear()
+        sections = self._sections
+        if sections:
+            for key, section in tuple(sections.items()):
+                # A section may hand over to another one of its key
+                if (section.feed(self, line, offset)
+                        and sections.get(key) is section):
+                    del sections[key]
+                    self._ended.add(key)
+                    self._changed = True
+        stripped = line.lstrip()
+        if stripped:
+            if stripped[0] in _NUMERIC_START:
+                trigger_re = self._numeric_trigger_re
+            else:
+                trigger_re = self._trigger_re
+            if trigger_re is not None:
+                found = trigger_re.findall(line)
+                if found:
+                    for trigger in (set(found) if len(found) > 1 else found):
+                        for rule in self._triggers[trigger]:
+                            rule(line, offset)
+        for rule in self._every_line:
+            rule(line, offset)
+        if self._changed:
+            self._changed = False
+            self._textual = all(section.textual
+                                for section in self._sections.values())
+
+    def reset(self, filename):
+        '''
+        Drop the checkpoint and start over with a file
+        :param filename: path to the output file, which may be compressed
+        :type filename: str
+        '''
+        self.filename = filename
+        self.data = {key: [] for key in self.patterns}
+        self.offset = 0
+        self._tail = b''
+        self._inode = None
+        self._sections = {}
+        self._ended = set()
+        self._textual = True
+        self._changed = False
+        self._reader = None
+
+    def parse(self, filename):
+        '''
+        Parse a pw.x output file
+        :param filename: path to the output file, which may be compressed
+        :type filename: str
+        :returns: {key: [values]} for all keys of the patterns
+        :rtype: dict
+        '''
+        self.reset(filename)
+        return self.update(final=True)
+
+    def _resumable(self, handle):
+        '''
+        Check that the file still starts with what was parsed, i.e. that
+            it only grew since the checkpoint and was not replaced (e.g.
+            by a restart) or truncated
+        '''
+        if not self.offset:
+            return True
+        stat = os.stat(self.filename)
+        if stat.st_ino != self._inode or stat.st_size < self.offset:
+            return False
+        handle.seek(self.offset - len(self._tail))
+        return handle.read(len(self._tail)) == self._tail
+
+    def update(self, final=False):
+        '''
+        Parse the lines which were appended to the file since the
+            checkpoint, i.e. since the last call of parse or update. A last
+            line which is still being written (no newline yet) is left for
+            the next update. The parser starts over if the file was
+            replaced or truncated.
+        :param final: the file is complete, parse its last line even
+            without a newline
+        :type final: bool
+        :returns: {key: [values]} for all keys of the patterns, the same as
+            parse would give for the complete lines of the file
+        :rtype: dict
+        '''
+        numbers_only = _NUMBERS_ONLY.fullmatch
+        skip = not self._every_line
+        partial = b''
+        try:
+            with zopen(self.filename, 'rb') as handle:
+                if not self._resumable(handle):
+                    self.reset(self.filename)
+                self._inode = os.stat(self.filename).st_ino
+                handle.seek(self.offset)
+                offset = self.offset
+                for raw in handle:
+                    if not raw.endswith(b'\n'):
+                        partial = raw if final else b''
+                        break
+                    self._tail = raw
+                    if skip and self._textual and numbers_only(raw):
+                        offset += len(raw)
+                        self.offset = offset
+                        continue
+                    line = raw.decode('utf-8', 'replace')
+                    if line.endswith('\r\n'):
+                        line = line[:-2] + '\n'
+                    self.end = offset + len(raw)
+                    self.feed(line, offset)
+                    offset = self.offset = self.end
+            return self._finish(partial)
+        finally:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    def _finish(self, partial=b''):
+        '''
+        Data for the file as it is: the checkpoint plus a last line without
+            newline and the sections which end with the file. These are
+            parsed on copies, which keeps the checkpoint.
+        '''
+        checkpoint = (self.data, self._sections, self._ended, self._textual,
+                      self._changed)
+        self.data = {key: list(values) for key, values in self.data.items()}
+        self._sections = copy.deepcopy(self._sections)
+        self._ended = set(self._ended)
+        try:
+            if partial:
+                self.end = self.offset + len(partial)
+                self.feed(partial.decode('utf-8', 'replace'), self.offset)
+            for section in self._sections.values():
+                section.close(self, eof=True)
+            if self._text_patterns:
+                with zopen(self.filename, 'rt') as handle:
+                    out = handle.read()
+                for key, value in self._text_patterns.items():
+                    pattern = re.compile(value['pattern'], *value['flags'])
+                    self.data[key] = [value['postprocess'](match)
+                                      for match in pattern.findall(out)]
+            return self.data
+        finally:
+            (self.data, self._sections, self._ended, self._textual,
+             self._changed) = checkpoint
+
+
+def parse_stdout(filename, patterns=pwoutput.patterns):
+    '''
+    Parse a pw.x output file in a single pass, see PWStdoutParser
+    :param filename: path to the output file
+    :type filename: str
+    :param patterns: patterns, see dftmanlib.pwscf.pwoutput
+    :type patterns: dict
+    :returns: {key: [values]}
+    :rtype: dict
+    '''
+    return PWStdoutParser(patterns).parse(filename)
+
+
+def parse_regex(filename, patterns=pwoutput.patterns):
+    '''
+    Parse a pw.x output file by searching its text for every pattern, as
+        PWOutput.read_patterns does
+    :returns: {key: [values]}
+    :rtype: dict
+    '''
+    with zopen(filename, 'rt') as file_:
+        out = file_.read()
+    data = {}
+    for key, value in patterns.items():
+        pattern = re.compile(value['pattern'], *value['flags'])
+        data[key] = [value['postprocess'](match)
+                     for match in pattern.findall(out)]
+    return data
+
+
+def benchmark(filename, patterns=pwoutput.patterns, repeat=3):
+    '''
+    Time the regex and the single-pass engine side by side on an output
+        file and check that they give the same data
+    :param filename: path to a pw.x output file
+    :type filename: str
+    :param patterns: patterns, see dftmanlib.pwscf.pwoutput
+    :type patterns: dict
+    :param repeat: number of runs of each engine, the fastest one counts
+    :type repeat: int
+    :returns: {'regex': seconds, 'lines': seconds, 'speedup': float,
+        'mismatches': [keys with different data]}
+    :rtype: dict
+    '''
+    times = {}
+    results = {}
+    for engine, parse in [('regex', parse_regex), ('lines', parse_stdout)]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results[engine] = parse(filename, patterns)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times[engine] = best
+    mismatches = [key for key in patterns
+                  if repr(results['regex'][key]) != repr(results['lines'][key])]
+    result = {'regex': times['regex'], 'lines': times['lines'],
+              'speedup': times['regex'] / times['lines'],
+              'mismatches': mismatches}
+    print('regex: {:.3f} s, lines: {:.3f} s, speedup: {:.1f}x'.format(
+        result['regex'], result['lines'], result['speedup']))
+    if mismatches:
+        print('Different data for: {}'.format(', '.join(mismatches)))
+    return result
+
+
+def main(argv=None):
+    '''
+    Command line benchmark of the parsers, e.g.
+        python -m dftmanlib.pwscf.pwparser pwscf.out
+    '''
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pw.x output parsers')
+    parser.add_argument('filenames', nargs='+', help='pw.x output files')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each parser')
+    args = parser.parse_args(argv)
+    mismatched = False
+    for filename in args.filenames:
+        print(filename)
+        result = benchmark(filename, repeat=args.repeat)
+        mismatched = mismatched or bool(result['mismatches'])
+    return 1 if mismatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
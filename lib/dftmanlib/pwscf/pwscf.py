@@ -6,6 +6,7 @@ import pprint
 import json
 import pathlib
 import copy
+import tempfile
 
 import re
 
@@ -21,19 +22,30 @@ from monty.json import (MontyEncoder, MontyDecoder)
 from monty.io import zopen
 
 from . import pwoutput
+from . import pwparser
 from .. import base
 
 A_PER_BOHR = 0.52917720859
 A3_PER_BOHR3 = A_PER_BOHR ** 3
 EV_PER_RY = 13.6056917253
 
+# Output properties which are moved to the blob store when stored, see
+# PWOutputData.as_dict
+BLOB_PROPERTIES = ['bands_data', 'kpoints_cart', 'kpoints_frac']
 
-class PWInput(PymatgenPWInput):
+# Suffix of the file next to an output file in which its parsed PWOutput
+# is kept, see PWOutput.save_parsed
+PARSED_SUFFIX = '.parsed.json'
+
+
+class PWInput(base.CachedHash, PymatgenPWInput):
     '''
     Subclass of pymatgen's PWInput which adds:
         * PWInput.as_dict() for storing a PWInput object as a dictionary
         * PWInput.from_dict(pwinput_dict) for restoring a PWInput object
               from a dictionary
+        * PWInput.hash, which is cached until an attribute is set or
+              invalidate_hash is called (see dftmanlib.base.CachedHash)
     See pymatgen.io.pwscf.PWInput for additional information
     :param structure:
     :type structure: pymatgen.core.Structure
@@ -66,8 +78,7 @@ class PWInput(PymatgenPWInput):
     def __repr__(self):
         return pprint.pformat(self.as_dict())
     
-    @property
-    def hash(self):
+    def _compute_hash(self):
         return base.hash_dict(self.as_dict())
     
     def write_input(self, filename):
@@ -98,6 +109,127 @@ class PWInput(PymatgenPWInput):
         return cls(**decoded)
 
 
+class PWOutputData(defaultdict):
+    '''
+    Output data of a PWOutput. Properties which were moved to the blob
+        store by as_dict are only loaded when they are accessed, and so
+        are deferred properties, which are parsed on first access (see
+        defer).
+    :param data: {property: value}, where values may be BlobRefs
+    :type data: dict
+    '''
+    def __init__(self, data=None):
+        self.deferred = set()
+        self._loader = None
+        super(PWOutputData, self).__init__(list, data or {})
+        for key, value in list(self.raw_items()):
+            if base.BlobRef.is_ref_dict(value):
+                # Now, to load it from the store of the database being read
+                super(PWOutputData, self).__setitem__(
+                    key, base.BlobRef.from_dict(value))
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self.raw_items()),))
+
+    def __contains__(self, key):
+        return (key in self.deferred
+                or super(PWOutputData, self).__contains__(key))
+
+    def __setitem__(self, key, value):
+        self.deferred.discard(key)
+        super(PWOutputData, self).__setitem__(key, value)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def defer(self, keys, loader):
+        '''
+        Parse properties on first access instead of now
+        :param keys: properties, whose current values are dropped
+        :type keys: list
+        :param loader: function(keys) returning {key: value} for a list
+            of deferred properties
+        :type loader: callable
+        '''
+        for key in keys:
+            self.pop(key, None)
+        self.deferred.update(keys)
+        self._loader = loader
+
+    def load(self, keys):
+        '''
+        Parse those of the properties which are deferred, in one go
+        :param keys: properties
+        :type keys: list
+        '''
+        keys = [key for key in keys if key in self.deferred]
+        if keys:
+            self.update(self._loader(keys))
+
+    def __getitem__(self, key):
+        if key in self.deferred:
+            self.load([key])
+        value = super(PWOutputData, self).__getitem__(key)
+        if base.BlobRef.is_ref_dict(value):
+            value = base.BlobRef.from_dict(value)
+            super(PWOutputData, self).__setitem__(key, value)
+        if isinstance(value, base.BlobRef):
+            return value.load()
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def raw_items(self):
+        '''
+        Items without loading the values which are in the blob store
+        '''
+        return super(PWOutputData, self).items()
+
+    def as_dict(self, blob_properties=BLOB_PROPERTIES, store=None):
+        '''
+        Serialize the data. Large properties are moved to the blob store
+            if one is given or set with dftmanlib.base.use_blob_store,
+            which database storages do while writing documents. Otherwise
+            they are serialized in place if they were not stored yet, so
+            that e.g. comparing or printing outputs writes no files.
+            Each property is only stored once, later calls reuse its
+            BlobRef. Changes made to a value after it was stored are
+            therefore not serialized, assign a new value instead.
+        :param blob_properties: properties to move to the blob store
+        :type blob_properties: list
+        :param store: blob store, see dftmanlib.base.BlobStore
+        :type store: dftmanlib.base.BlobStore
+        :returns: dictionary with BlobRef dictionaries in place of the
+            stored properties
+        :rtype: dict
+        '''
+        store = store or base.get_blob_store()
+        dict_ = {}
+        for key, value in list(self.raw_items()):
+            if base.BlobRef.is_ref_dict(value):
+                value = base.BlobRef.from_dict(value)
+            if store is not None and key in blob_properties and value:
+                if isinstance(value, base.BlobRef):
+                    value = value.stored_in(store)
+                else:
+                    value = base.BlobRef.from_value(value, store=store)
+                super(PWOutputData, self).__setitem__(key, value)
+            if isinstance(value, base.BlobRef):
+                value = value.as_dict()
+            dict_[key] = value
+        return dict_
+
+
 class PWOutput(base.Output):
     '''
     Object for parsing, representing, and storing the output
@@ -116,18 +248,32 @@ class PWOutput(base.Output):
                           },
          ...}
     :type patterns: dict
+    :param deferred: properties which were not parsed yet and are parsed
+        from the file on first access, see parse_output
+    :type deferred: list
+    :param engine: parser engine for deferred properties, see parse_output
+    :type engine: str
+    :param identity: identity of the file the data was parsed from, see
+        dftmanlib.base.file_identity
+    :type identity: dict
     '''
     def __init__(self, filename='dftman.stdout', data=defaultdict(list),
-                 patterns=pwoutput.patterns):
+                 patterns=pwoutput.patterns, deferred=None, engine='regex',
+                 identity=None):
         self.filename = filename
-        self.data = data
+        self.data = PWOutputData(data)
         self.patterns = patterns
+        self.identity = identity
+        self._parser = None
+        self._engine = engine
+        if deferred:
+            self.data.defer(deferred, self._load)
 #         if filename:
 #             self.read_patterns(patterns)
         
     def __repr__(self):
-        excluded_properties = ['kpoints_cart', 'kpoints_frac', 'bands_data']
-        dict_ = {key: value for key, value in self.data.items()
+        excluded_properties = BLOB_PROPERTIES
+        dict_ = {key: self.data[key] for key in self.data
                  if key not in excluded_properties}
         for key in excluded_properties:
             dict_[key] = 'EXCLUDED FROM PRINTING'
@@ -160,9 +306,82 @@ class PWOutput(base.Output):
             all_matches[key] = matches
         self.data.update(all_matches)
     
-    def parse_output(self, filename, patterns=pwoutput.patterns):
+    def read_lines(self, patterns, incremental=False):
+        '''
+        Single-pass alternative to read_patterns which walks the file line
+            by line, see dftmanlib.pwscf.pwparser.PWStdoutParser. It sets
+            the same data and is faster on large outputs, where some of
+            the multi-line patterns backtrack heavily.
+        :param incremental: keep the parser as a checkpoint and only read
+            what was appended to the file since the last incremental
+            read, e.g. to follow a running calculation
+        :type incremental: bool
+        '''
+        parser = self._parser
+        if (incremental and parser is not None
+                and parser.filename == self.filename
+                and parser.patterns == patterns):
+            data = parser.update()
+        else:
+            parser = pwparser.PWStdoutParser(patterns)
+            data = parser.parse(self.filename)
+        self._parser = parser if incremental else None
+        self.data.update(data)
+
+    def _load(self, keys):
+        '''
+        Parse deferred properties from the output file
+        '''
+        patterns = {key: self.patterns.get(key, pwoutput.patterns.get(key))
+                    for key in keys}
+        patterns = {key: value for key, value in patterns.items()
+                    if value is not None}
+        if self._engine == 'regex':
+            return pwparser.parse_regex(self.filename, patterns)
+        return pwparser.parse_stdout(self.filename, patterns)
+
+    def _require(self, name):
+        # Parse all deferred properties a property needs in one go
+        self.data.load(pwoutput.required([name]))
+
+    def parse_output(self, filename, patterns=pwoutput.patterns,
+                     engine='regex', incremental=False, properties=None,
+                     lazy=False):
+        '''
+        Parse a pw.x output file
+        :param filename: path to the output file
+        :type filename: str
+        :param engine: 'regex' (read_patterns) or 'lines' (read_lines)
+        :type engine: str
+        :param incremental: only parse what was appended since the last
+            incremental parse, see read_lines. Implies engine='lines'.
+        :type incremental: bool
+        :param properties: only parse what these properties need, e.g.
+            ['final_energy', 'succeeded'] (see pwoutput.requires), and
+            defer the other patterns until they are accessed
+        :type properties: list
+        :param lazy: defer all patterns until they are accessed
+        :type lazy: bool
+        '''
         self.filename = filename
-        self.read_patterns(patterns=patterns)
+        self.patterns = patterns
+        self.identity = base.file_identity(filename)
+        self._engine = 'lines' if incremental else engine
+        if engine not in ('regex', 'lines'):
+            raise ValueError('Unknown parser engine {}'.format(engine))
+        if lazy or properties is not None:
+            selected = pwoutput.select(properties or [], patterns)
+            self.data.defer([key for key in patterns if key not in selected],
+                            self._load)
+            patterns = selected
+            if not patterns:
+                return self.data
+        if incremental:
+            self.read_lines(patterns=patterns, incremental=True)
+        elif engine == 'regex':
+            self.read_patterns(patterns=patterns)
+        else:
+            self.read_lines(patterns=patterns)
         return self.data
     
     def get_first(self, property_):
@@ -179,6 +398,7 @@ class PWOutput(base.Output):
     
     @property
     def structures(self):
+        self._require('structures')
         structures = []
         
         # scf step structures
@@ -258,6 +478,23 @@ class PWOutput(base.Output):
     @property
     def fermi_energy(self):
         return self.get_last('fermi_energy')
+
+    @property
+    def scf_iterations(self):
+        '''
+        Total number of SCF iterations over all ionic steps
+        :rtype: int
+        '''
+        conv_iters = self.data.get('conv_iters')
+        return sum(conv_iters) if conv_iters else None
+
+    @property
+    def wall_time(self):
+        '''
+        Wall time of the run in seconds
+        :rtype: float
+        '''
+        return self.get_last('wall_time')
         
     @property
     def final_volume(self):
@@ -269,10 +506,11 @@ class PWOutput(base.Output):
     
     @property
     def succeeded(self):
+        self._require('succeeded')
         succeeded = True
         failure_reason = []
         # should only occur once
-        if self.data.get('cpu_time_exceeeded'):
+        if self.data.get('cpu_time_exceeded'):
             succeeded = False
             failure_reason.append('CPU time was exceeded')
         if self.data.get('max_steps_reached'):
@@ -295,6 +533,18 @@ class PWOutput(base.Output):
             failure_reason.append('Job not done')
         
         return succeeded, failure_reason
+
+    @property
+    def restartable(self):
+        '''
+        Whether the run stopped early but can be continued from its
+            restart files, i.e. it ran out of CPU time (max_seconds) or
+            reached the maximum number of steps
+        :rtype: bool
+        '''
+        self._require('restartable')
+        return bool(self.data.get('cpu_time_exceeded')
+                    or self.data.get('max_steps_reached'))
         
     @property
     def output(self):
@@ -305,9 +555,90 @@ class PWOutput(base.Output):
             '@module': self.__class__.__module__,
             '@class': self.__class__.__name__,
             'filename': self.filename,
-            'data': self.data,  # this is a significant area for performance improvement
+            # Large properties are kept in the blob store when stored
+            'data': self.data.as_dict(),
+            'deferred': sorted(self.data.deferred),
+            'identity': self.identity,
         }
         return dict_
+
+    def _covers(self, patterns):
+        # Whether the data was parsed (or is deferred) with these patterns
+        return all(self.patterns.get(key) == value
+                   for key, value in patterns.items())
+
+    @classmethod
+    def cached(cls, filename, patterns=pwoutput.patterns, output=None):
+        '''
+        PWOutput parsed earlier from a file which did not change since:
+            output if it was parsed from the file, or the one saved next
+            to the file by save_parsed
+        :param filename: path to the output file
+        :type filename: str
+        :param patterns: patterns the output has to be parsed with
+        :type patterns: dict
+        :param output: output in memory, e.g. the one stored in the database
+        :type output: PWOutput
+        :returns: PWOutput, or None if the file changed or was not parsed
+        :rtype: PWOutput | None
+        '''
+        try:
+            identity = base.file_identity(filename)
+        except OSError:
+            return None
+        if (isinstance(output, cls) and output.identity == identity
+                and output._covers(patterns)):
+            return output
+        # Only outputs parsed with the default patterns are saved
+        if not all(value is pwoutput.patterns.get(key)
+                   for key, value in patterns.items()):
+            return None
+        try:
+            with open(filename + PARSED_SUFFIX, 'r') as handle:
+                entry = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        if (entry.get('identity') != identity
+                or not set(patterns) <= set(entry.get('keys', []))):
+            return None
+        return cls.from_dict(entry['output'])
+
+    def save_parsed(self):
+        '''
+        Keep the data next to the output file (filename + PARSED_SUFFIX)
+            for cached. Large properties are not kept, they are parsed
+            again from the file when they are accessed.
+        :returns: True if the data was saved
+        :rtype: bool
+        '''
+        if self.identity is None or not all(
+                value is pwoutput.patterns.get(key)
+                for key, value in self.patterns.items()):
+            return False
+        data = {key: value for key, value in self.data.raw_items()
+                if key not in BLOB_PROPERTIES}
+        deferred = self.data.deferred.union(
+            key for key in BLOB_PROPERTIES if key in self.patterns)
+        output = {
+            'filename': self.filename,
+            'data': json.loads(json.dumps(data, cls=MontyEncoder)),
+            'deferred': sorted(deferred),
+            'engine': self._engine,
+            'identity': self.identity,
+        }
+        entry = {'identity': self.identity, 'keys': sorted(self.patterns),
+                 'output': output}
+        path = self.filename + PARSED_SUFFIX
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(path) or '.')
+            with os.fdopen(fd, 'w') as handle:
+                json.dump(entry, handle)
+            os.replace(tmp_path, path)
+        except OSError:
+            # e.g. a read-only directory, the file is parsed again
+            return False
+        return True
     
     @classmethod
     def from_dict(cls, dict_):
@@ -421,7 +752,9 @@ class PWCalculation(base.Calculation):
 
     def parse_output(self, name=None, directory=None,
                      output_type='stdout',
-                     patterns=pwoutput.patterns):
+                     patterns=pwoutput.patterns, engine='regex',
+                     incremental=False, properties=None, lazy=False,
+                     force=False):
         '''
         Parse the calculation's output file by creating
             the appropriate output object and using it to
@@ -430,6 +763,14 @@ class PWCalculation(base.Calculation):
         :param directory: run directory path as a string
         :param output_type: type of output to parse
             'stdout' is supported for pw.x
+        :param engine: parser engine for 'stdout', see PWOutput.parse_output
+        :param incremental: resume from the previous incremental parse of
+            the same file, which only reads the newly appended output
+        :param properties: only parse what these properties need now and
+            the rest on first access, see PWOutput.parse_output
+        :param lazy: parse every property on first access
+        :param force: parse the file even if it did not change since it
+            was last parsed, see PWOutput.cached
         :return: PWOutput or PWXML object
         '''
         if name:
@@ -439,10 +780,23 @@ class PWCalculation(base.Calculation):
         output_path = os.path.join(self.directory,
                                    self.output_name)
         if output_type == 'stdout':
-            output = PWOutput(filename=output_path,
-                              patterns=patterns)
-            output.parse_output(filename=output_path,
-                                patterns=patterns)
+            output = self.output
+            cached = None
+            if not (force or incremental):
+                cached = PWOutput.cached(output_path, patterns, output)
+            if cached is not None:
+                self.output = cached
+                self.output_type = output_type
+                return self.output
+            if not (incremental and isinstance(output, PWOutput)
+                    and output.filename == output_path):
+                output = PWOutput(filename=output_path,
+                                  patterns=patterns)
+            output.parse_output(filename=output_path, patterns=patterns,
+                                engine=engine, incremental=incremental,
+                                properties=properties, lazy=lazy)
+            if not incremental:
+                output.save_parsed()
             self.output = output
             self.output_type = output_type
 
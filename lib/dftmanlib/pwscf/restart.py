@@ -0,0 +1,129 @@
+import os
+import os.path
+
+from .pwscf import PWInput, PWCalculation
+
+# Fraction of the walltime given to pw.x as max_seconds, which leaves it
+# time to write its restart files before the scheduler kills the job
+MAX_SECONDS_FRACTION = 0.9
+
+# Job fields which describe a submission rather than the job and are
+# reset for a restart
+_RUN_STATE = ['calculation', 'directory', 'metadata', 'status', 'doc_id',
+              'hash', 'submitted', 'submission_time', 'submit_id', 'pbs_id',
+              'array_index', 'packed', 'pid']
+
+
+def _output(job):
+    if job.calculation.output is None:
+        # Only what is used (restartable) is parsed
+        job.calculation.parse_output(name=job.output_name,
+                                     directory=job.directory, lazy=True)
+    return job.calculation.output
+
+
+def restart_job(job, max_seconds_fraction=MAX_SECONDS_FRACTION,
+                force=False, run=True):
+    '''
+    Continue a pw.x run which stopped early, e.g. because it ran out of
+        walltime, from its restart files.
+    The job is cloned with restart_mode='restart' and max_seconds set to
+        max_seconds_fraction of its walltime (if it has one) in the same
+        directory, so pw.x finds the outdir of the previous attempt, whose
+        output file is kept with the attempt number appended. The clone
+        is submitted with the backend (job class) of the original job.
+        Attempts are chained through their metadata: the restart stores
+        'restart_of' (doc_id of the previous attempt) and 'attempt', and
+        the previous attempt stores 'restarted_as'.
+    :param job: job whose run stopped early
+    :type job: SubmitJob | PBSJob | LocalJob
+    :param max_seconds_fraction: fraction of the walltime given to pw.x as
+        max_seconds
+    :type max_seconds_fraction: float
+    :param force: restart even if the output does not show that the run
+        can be continued (see PWOutput.restartable)
+    :type force: bool
+    :param run: submit the restart
+    :type run: bool
+    :returns: the restarted job
+    '''
+    # Imported here, dftmanlib.db imports this package (and dftmanlib.job)
+    from ..db import load_db
+    from ..job.job import walltime_to_seconds
+    output = _output(job)
+    if not (force or output.restartable):
+        raise ValueError('Job {} cannot be restarted: {}'
+                         .format(job.doc_id,
+                                 ', '.join(output.succeeded[1])))
+
+    calculation = job.calculation
+    input_ = PWInput.from_dict(calculation.input.as_dict())
+    control = input_.sections['control']
+    control['restart_mode'] = 'restart'
+    walltime = walltime_to_seconds(getattr(job, 'walltime', None))
+    if walltime:
+        control['max_seconds'] = int(walltime * max_seconds_fraction)
+    input_.invalidate_hash()
+    restart_calculation = PWCalculation(
+        input_, input_name=calculation.input_name,
+        directory=calculation.directory,
+        additional_inputs=calculation.additional_inputs)
+
+    metadata = dict(job.metadata or {})
+    metadata.pop('restarted_as', None)
+    attempt = metadata.get('attempt', 1)
+    metadata.update({'restart_of': job.doc_id, 'attempt': attempt + 1})
+
+    dict_ = job.as_dict()
+    for key in _RUN_STATE:
+        dict_.pop(key, None)
+    dict_.update({'calculation': restart_calculation,
+                  'directory': job.directory,
+                  'metadata': metadata})
+    restart = job.__class__.from_dict(dict_)
+
+    if not run:
+        return restart
+
+    # Keep the output of the previous attempt
+    if os.path.exists(job.output_path):
+        os.replace(job.output_path,
+                   '{}.{}'.format(job.output_path, attempt))
+
+    db = load_db()
+    with db.transaction(rollback=False):
+        restart.run()
+        job.metadata = dict(job.metadata or {}, restarted_as=restart.doc_id)
+        db.table(job.__class__.__name__).write_back(
+            [job], doc_ids=[job.doc_id])
+    return restart
+
+
+def restart_jobs(jobs, max_attempts=5,
+                 max_seconds_fraction=MAX_SECONDS_FRACTION):
+    '''
+    Restart all complete jobs whose runs stopped early and can be
+        continued, see restart_job
+    :param jobs: jobs to check
+    :type jobs: list
+    :param max_attempts: don't restart jobs which already ran this many
+        times
+    :type max_attempts: int
+    :param max_seconds_fraction: see restart_job
+    :type max_seconds_fraction: float
+    :returns: the restarted jobs
+    :rtype: list
+    '''
+    from ..db import load_db
+    restarts = []
+    with load_db().transaction(rollback=False):
+        for job in jobs:
+            metadata = job.metadata or {}
+            if (job.status.get('status') != 'Complete'
+                    or metadata.get('restarted_as')
+                    or metadata.get('attempt', 1) >= max_attempts):
+                continue
+            if _output(job).restartable:
+                restarts.append(restart_job(
+                    job, max_seconds_fraction=max_seconds_fraction))
+    return restarts
@@ -1,5 +1,7 @@
 import copy
 import sys
+import warnings
+import shutil
 import os.path
 
 import numpy as np
@@ -14,13 +16,38 @@ from monty.json import MontyDecoder
 from tinydb import Query
 
 from .. import pwcalculation_helper
+from ..parse import parse_outputs
 from ...job import SubmitJob, PBSJob, LocalJob
 from ... import base
 from ...db import load_db
 
 CONVWORKFLOWS_DIRECTORY = os.path.join(os.getcwd(), 'ConvergenceWorkflows')
 
-class ConvergenceWorkflow(Mapping, base.Workflow):
+class ConvergenceWorkflow(base.CachedHash, Mapping, base.Workflow):
+    '''
+    Workflow for converging a calculation parameter (k-point grid or
+        wavefunction cutoff) of PWscf calculations. Runs one calculation
+        per value in convergence_values.
+    In chained mode, the values are run one after another, in the order
+        given, and each calculation starts from the converged charge
+        density (startingpot='file') of the previous one, which is staged
+        into its outdir, to cut the number of SCF iterations of the sweep.
+        The wavefunctions are only reused with chain_wavefunctions, which
+        requires the same k-points, i.e. an 'ecutwfc' sweep.
+        The next calculation is submitted by advance(), which is called
+        by run() and check_status(). See chain_saving() for the number of
+        SCF iterations and the wall time saved.
+    :param chained: run the calculations as a chain
+    :type chained: bool
+    :param chain_wavefunctions: also start from the wavefunctions
+        (startingwfc='file') of the previous calculation
+    :type chain_wavefunctions: bool
+    '''
+    # Attributes the hash depends on, see dftmanlib.base.CachedHash
+    _hash_attributes = ('structure', 'pseudo', 'base_inputs',
+                        'convergence_parameter', 'convergence_values',
+                        'chained', 'chain_wavefunctions')
+
     def __init__(self, structure, pseudo, base_inputs,
                  convergence_parameter='kgrid',
                  convergence_values=[(4, 4, 4), (8, 8, 8),
@@ -30,7 +57,8 @@ class ConvergenceWorkflow(Mapping, base.Workflow):
                  metadata={},
                  stored=False, doc_id=None,
                  jobs_stored=False, job_ids=None,
-                 hash=None, directory=None):
+                 hash=None, directory=None,
+                 chained=False, chain_wavefunctions=False):
         
         if not isinstance(structure, Structure):
             structure = Structure.from_dict(structure)
@@ -40,6 +68,8 @@ class ConvergenceWorkflow(Mapping, base.Workflow):
         
         self.convergence_parameter = convergence_parameter
         self.convergence_values = convergence_values
+        self.chained = chained
+        self.chain_wavefunctions = chain_wavefunctions
         
         self.job_type = job_type
         self.job_class = getattr(sys.modules[__name__], job_type)
@@ -83,8 +113,7 @@ class ConvergenceWorkflow(Mapping, base.Workflow):
         #       .format(self.hash, self.doc_id))
         return self.doc_id
     
-    @property
-    def hash(self):
+    def _compute_hash(self):
         if isinstance(self.structure, Structure):
             structure = self.structure.as_dict()
         else:
@@ -96,21 +125,121 @@ class ConvergenceWorkflow(Mapping, base.Workflow):
             'convergence_parameter': self.convergence_parameter,
             'convergence_values': self.convergence_values
         }
+        # Only chained workflows hash the chain settings, which keeps the
+        # hashes of existing workflows
+        if self.chained:
+            key_dict['chained'] = self.chained
+            key_dict['chain_wavefunctions'] = self.chain_wavefunctions
         return base.hash_dict(key_dict)
     
-    def run(self):
-        job_ids = []
-        for job in self.jobs:
-            job_id = job.run(block_if_run=False)
-            job_ids.append(job_id)
-        self.job_ids = job_ids
-        self.jobs_stored = True
-        self.doc_id = self.insert()
-        self.stored = True
-        self.update()
+    def run(self, array=False):
+        '''
+        Run all jobs of the workflow
+        :param array: submit all jobs with a single qsub as one job array
+            (job_type 'PBSJob' only, see PBSJob.run_array)
+        :type array: bool
+        :returns: doc_id of the workflow
+        :rtype: int
+        '''
+        if array and not hasattr(self.job_class, 'run_array'):
+            raise ValueError('{} does not support job arrays'
+                             .format(self.job_type))
+        if array and self.chained:
+            raise ValueError('Chained workflows cannot run as a job array')
+        # Store all jobs and the workflow with a single database write
+        with load_db().transaction(rollback=False):
+            if self.chained:
+                # Store all jobs, but only run the first one(s)
+                job_ids = []
+                for job in self.jobs:
+                    if not job.doc_id:
+                        job.insert()
+                    job_ids.append(job.doc_id)
+                self.advance()
+            elif array:
+                job_ids = self.job_class.run_array(self.jobs,
+                                                   directory=self.directory)
+            elif hasattr(self.job_class, 'run_batch'):
+                # Submit concurrently, e.g. SubmitJobs on nanoHUB
+                job_ids = self.job_class.run_batch(self.jobs)
+            else:
+                job_ids = []
+                for job in self.jobs:
+                    job_id = job.run(block_if_run=False)
+                    job_ids.append(job_id)
+            self.job_ids = job_ids
+            self.jobs_stored = True
+            self.doc_id = self.insert()
+            self.stored = True
+            self.update()
         return self.doc_id
+
+    @staticmethod
+    def _started(job):
+        return bool(job.submitted or job.status.get('status'))
+
+    def _stage(self, previous, job):
+        '''
+        Copy the save directory of the previous calculation of the chain
+            into the outdir (directory) of the next one
+        :returns: True if there was a save directory to stage
+        :rtype: bool
+        '''
+        prefix = previous.calculation.input.sections['control'].get(
+            'prefix', 'pwscf')
+        source = os.path.join(previous.directory, '{}.save'.format(prefix))
+        if not os.path.isdir(source):
+            # e.g. restored from the result cache, pw.x then starts from
+            # the atomic charge density and wavefunctions
+            print('No {} to start job {} from'.format(source, job.hash))
+            return False
+        destination = os.path.join(job.directory, os.path.basename(source))
+        if os.path.exists(destination):
+            shutil.rmtree(destination)
+        ignore = None if self.chain_wavefunctions else \
+            shutil.ignore_patterns('wfc*')
+        shutil.copytree(source, destination, ignore=ignore)
+        if isinstance(job, SubmitJob):
+            # Send the save directory along with the input. A new list,
+            # the old one may be shared with other calculations or
+            # documents which were already stored.
+            additional_inputs = list(job.calculation.additional_inputs or [])
+            if destination not in additional_inputs:
+                job.calculation.additional_inputs = \
+                    additional_inputs + [destination]
+        return True
+
+    def advance(self):
+        '''
+        Run the next calculations of a chained workflow whose previous
+            calculation is complete, see ConvergenceWorkflow.
+            Calculations which complete while running (e.g. LocalJobs
+            with wait=True or results from the result cache) are followed
+            by the next one straight away.
+        :returns: the jobs which were run
+        :rtype: list
+        '''
+        if not self.chained:
+            return []
+        run = []
+        jobs = self.jobs
+        with load_db().transaction(rollback=False):
+            for previous, job in zip([None] + jobs[:-1], jobs):
+                if self._started(job):
+                    continue
+                if previous is not None:
+                    if previous.status.get('status') != 'Complete':
+                        previous.check_status(update_in_db=True)
+                    if previous.status.get('status') != 'Complete':
+                        break
+                    self._stage(previous, job)
+                job.run()
+                run.append(job)
+        return run
         
     def check_status(self, update_to_db=False):
+        if self.chained:
+            self.advance()
         statuses = []
         jobs = self.jobs
         for job in jobs:
@@ -124,8 +253,13 @@ class ConvergenceWorkflow(Mapping, base.Workflow):
     
     def _make_jobs(self):
         jobs = []
-        for value in self.convergence_values:
+        for i, value in enumerate(self.convergence_values):
             inputs = copy.deepcopy(self.base_inputs)
+            if self.chained and i:
+                electrons = inputs.setdefault('electrons', {})
+                electrons['startingpot'] = 'file'
+                if self.chain_wavefunctions:
+                    electrons['startingwfc'] = 'file'
             if self.convergence_parameter == 'kpoints_grid':
                 inputs['kpoints_grid'] = value
             elif self.convergence_parameter == 'kpra':
@@ -176,28 +310,84 @@ class ConvergenceWorkflow(Mapping, base.Workflow):
             'convergence_values': self.convergence_values
         }
     
-    def parse_output(self, update_to_db=False):
-        jobs = self.jobs
+    def parse_output(self, update_to_db=False, workers=1, force=False):
+        '''
+        Parse the outputs of the complete jobs
+        :param update_to_db: write the jobs to the database
+        :type update_to_db: bool
+        :param workers: number of processes parsing the outputs, see
+            dftmanlib.pwscf.parse_outputs
+        :type workers: int
+        :param force: parse the outputs even if they did not change since
+            they were last parsed
+        :type force: bool
+        '''
+        jobs = [job for job in self.jobs
+                if job.status['status'] == 'Complete']
+        # Only the properties used below are parsed
+        outputs = parse_outputs(jobs, workers=workers,
+                                properties=['final_energy',
+                                            'scf_iterations', 'wall_time'],
+                                update_to_db=update_to_db, report=False,
+                                force=force)
         
+        failed = [job for job, output in zip(jobs, outputs) if output is None]
+        if failed:
+            warnings.warn('Could not parse the outputs of {} of {} complete '
+                          'jobs ({}), they are left out'.format(
+                              len(failed), len(jobs),
+                              ', '.join(job.output_path for job in failed)))
         data = []
-        for job in jobs:
-            if job.status['status'] == 'Complete':
-                job.parse_output(update_to_db=False)
-                job_data = {
-                    'parameter': job.metadata['parameter'],
-                    'energy': job.output.final_energy,  # eV
-                    'volume': job.input.structure.volume  # A^3
-                }
-                data.append(job_data)
+        for job, output in zip(jobs, outputs):
+            if output is None:
+                continue
+            job_data = {
+                'parameter': job.metadata['parameter'],
+                'energy': output.final_energy,  # eV
+                'volume': job.input.structure.volume,  # A^3
+                'scf_iterations': output.scf_iterations,
+                'wall_time': output.wall_time  # s
+            }
+            data.append(job_data)
         data_df = pd.DataFrame(data)
         
-        if update_to_db:
-            db = load_db()
-            table = db.table(jobs[0].__class__.__name__)
-            table.write_back(jobs, doc_ids=[job.doc_id for job in jobs])
-        
         return data_df
         
+    def chain_saving(self, reference):
+        '''
+        Measure the saving of a chained workflow against a reference
+            workflow which ran the same values from scratch
+        :param reference: unchained workflow of the same values
+        :type reference: ConvergenceWorkflow
+        :returns: SCF iterations and wall times of both workflows per value
+        :rtype: pandas.DataFrame
+        '''
+        data = self.parse_output()
+        reference_data = reference.parse_output()
+        # Values may be lists after a round trip through the database
+        reference_rows = {str(row['parameter']): row
+                          for _, row in reference_data.iterrows()}
+        rows = []
+        for _, row in data.iterrows():
+            reference_row = reference_rows.get(str(row['parameter']))
+            if reference_row is None:
+                continue
+            rows.append({
+                'parameter': row['parameter'],
+                'scf_iterations': row['scf_iterations'],
+                'reference_scf_iterations': reference_row['scf_iterations'],
+                'wall_time': row['wall_time'],
+                'reference_wall_time': reference_row['wall_time']
+            })
+        saving_df = pd.DataFrame(rows)
+        if not saving_df.empty:
+            iterations = saving_df['scf_iterations'].sum()
+            reference_iterations = saving_df['reference_scf_iterations'].sum()
+            print('{} SCF iterations instead of {} ({:.1%} saved)'.format(
+                iterations, reference_iterations,
+                1 - iterations / reference_iterations))
+        return saving_df
+
     @property
     def output(self):
         return self.parse_output()
@@ -216,7 +406,10 @@ class ConvergenceWorkflow(Mapping, base.Workflow):
             'jobs_stored': self.jobs_stored,
             'job_ids': self.job_ids,
             'directory': self.directory,
-            'metadata': self.metadata
+            'metadata': self.metadata,
+            'hash': self.hash,
+            'chained': self.chained,
+            'chain_wavefunctions': self.chain_wavefunctions
         }
         return dict_
         
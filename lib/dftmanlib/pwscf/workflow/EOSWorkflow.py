@@ -1,5 +1,6 @@
 import copy
 import sys
+import warnings
 import os.path
 
 import numpy as np
@@ -15,13 +16,14 @@ from monty.json import MontyDecoder
 from tinydb import Query
 
 from .. import pwcalculation_helper
+from ..parse import parse_outputs
 from ...job import SubmitJob, PBSJob, LocalJob
 from ... import base
 from ...db import load_db
 
 EOSWORKFLOWS_DIRECTORY = os.path.join(os.getcwd(), 'EOSWorkflows')
 
-class EOSWorkflow(Mapping, base.Workflow):
+class EOSWorkflow(base.CachedHash, Mapping, base.Workflow):
     '''
     Workflow for calculating Equations of State of crystalline
         materials uding DFT implemented in PWscf. Runs a series
@@ -46,6 +48,10 @@ class EOSWorkflow(Mapping, base.Workflow):
     :type job_kwargs:
     :param metadata:
     '''
+    # Attributes the hash depends on, see dftmanlib.base.CachedHash
+    _hash_attributes = ('structure', 'pseudo', 'base_inputs',
+                        'min_strain', 'max_strain', 'n_strains')
+
     def __init__(self, structure, pseudo, base_inputs,
                  min_strain=-0.15, max_strain=0.15, n_strains=8,
                  job_type='SubmitJob', job_kwargs={},
@@ -108,8 +114,7 @@ class EOSWorkflow(Mapping, base.Workflow):
         #       .format(self.hash, self.doc_id))
         return self.doc_id
     
-    @property
-    def hash(self):
+    def _compute_hash(self):
         if isinstance(self.structure, Structure):
             structure = self.structure.as_dict()
         else:
@@ -124,16 +129,36 @@ class EOSWorkflow(Mapping, base.Workflow):
         }
         return base.hash_dict(key_dict)
     
-    def run(self):
-        job_ids = []
-        for job in self.jobs:
-            job_id = job.run(block_if_run=False)
-            job_ids.append(job_id)
-        self.job_ids = job_ids
-        self.jobs_stored = True
-        self.doc_id = self.insert()
-        self.stored = True
-        self.update()
+    def run(self, array=False):
+        '''
+        Run all jobs of the workflow
+        :param array: submit all jobs with a single qsub as one job array
+            (job_type 'PBSJob' only, see PBSJob.run_array)
+        :type array: bool
+        :returns: doc_id of the workflow
+        :rtype: int
+        '''
+        if array and not hasattr(self.job_class, 'run_array'):
+            raise ValueError('{} does not support job arrays'
+                             .format(self.job_type))
+        # Store all jobs and the workflow with a single database write
+        with load_db().transaction(rollback=False):
+            if array:
+                job_ids = self.job_class.run_array(self.jobs,
+                                                   directory=self.directory)
+            elif hasattr(self.job_class, 'run_batch'):
+                # Submit concurrently, e.g. SubmitJobs on nanoHUB
+                job_ids = self.job_class.run_batch(self.jobs)
+            else:
+                job_ids = []
+                for job in self.jobs:
+                    job_id = job.run(block_if_run=False)
+                    job_ids.append(job_id)
+            self.job_ids = job_ids
+            self.jobs_stored = True
+            self.doc_id = self.insert()
+            self.stored = True
+            self.update()
         return self.doc_id
         
     def check_status(self, update_to_db=False):
@@ -194,26 +219,44 @@ class EOSWorkflow(Mapping, base.Workflow):
             'n_strains': self.n_strains
         }
     
-    def parse_output(self, update_to_db=False):
-        jobs = self.jobs
+    def parse_output(self, update_to_db=False, workers=1, force=False):
+        '''
+        Parse the outputs of the complete jobs
+        :param update_to_db: write the jobs to the database
+        :type update_to_db: bool
+        :param workers: number of processes parsing the outputs, see
+            dftmanlib.pwscf.parse_outputs
+        :type workers: int
+        :param force: parse the outputs even if they did not change since
+            they were last parsed
+        :type force: bool
+        '''
+        jobs = [job for job in self.jobs
+                if job.status['status'] == 'Complete']
+        # Only the properties used below are parsed
+        outputs = parse_outputs(jobs, workers=workers,
+                                properties=['final_energy'],
+                                update_to_db=update_to_db, report=False,
+                                force=force)
         
+        failed = [job for job, output in zip(jobs, outputs) if output is None]
+        if failed:
+            warnings.warn('Could not parse the outputs of {} of {} complete '
+                          'jobs ({}), they are left out'.format(
+                              len(failed), len(jobs),
+                              ', '.join(job.output_path for job in failed)))
         data = []
-        for job in jobs:
-            if job.status['status'] == 'Complete':
-                job.parse_output(update_to_db=False)
-                job_data = {
-                    'strain': job.metadata['strain'],
-                    'energy': job.output.final_energy,  # eV
-                    'volume': job.input.structure.volume  # A^3
-                }
-                data.append(job_data)
+        for job, output in zip(jobs, outputs):
+            if output is None:
+                continue
+            job_data = {
+                'strain': job.metadata['strain'],
+                'energy': output.final_energy,  # eV
+                'volume': job.input.structure.volume  # A^3
+            }
+            data.append(job_data)
         data_df = pd.DataFrame(data)
         
-        if update_to_db:
-            db = load_db()
-            table = db.table(jobs[0].__class__.__name__)
-            table.write_back(jobs, doc_ids=[job.doc_id for job in jobs])
-        
         if not data_df.empty:
             equations = ['murnaghan', 'birch', 'vinet',
                          'birch_murnaghan', 'pourier_tarantola',
@@ -243,7 +286,8 @@ class EOSWorkflow(Mapping, base.Workflow):
             'jobs_stored': self.jobs_stored,
             'job_ids': self.job_ids,
             'directory': self.directory,
-            'metadata': self.metadata
+            'metadata': self.metadata,
+            'hash': self.hash
         }
         return dict_
         
@@ -0,0 +1,83 @@
+import sys
+import time
+import threading
+
+import pytest
+from pymatgen import Structure, Lattice
+
+from dftmanlib.db import load_db, close_all_dbs
+from dftmanlib.job import LocalScheduler, set_default_scheduler
+from dftmanlib.pwscf.workflow import EOSWorkflow
+
+TIMEOUT = 60.
+
+
+@pytest.fixture
+def workflow(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys.modules[EOSWorkflow.__module__],
+                        'EOSWORKFLOWS_DIRECTORY',
+                        str(tmp_path / 'EOSWorkflows'))
+    structure = Structure(Lattice.cubic(5.43), ['Si', 'Si'],
+                          [[0, 0, 0], [0.25, 0.25, 0.25]])
+    (tmp_path / 'Si.UPF').write_text('')
+    base_inputs = {'pseudo': {'Si': str(tmp_path / 'Si.UPF')},
+                   'system': {'ecutwfc': 20.}}
+    yield EOSWorkflow(structure, {'Si': str(tmp_path / 'Si.UPF')},
+                      base_inputs, n_strains=16, job_type='LocalJob',
+                      job_kwargs={'command': 'true'})
+    set_default_scheduler(None)
+    close_all_dbs()
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = LocalScheduler(ncores=2, poll_interval=0.001)
+    set_default_scheduler(scheduler)
+    scheduler.start()
+    yield scheduler
+    # A deadlocked background thread would never be joined
+    if scheduler._lock.acquire(timeout=TIMEOUT):
+        scheduler._lock.release()
+        scheduler.stop()
+
+
+def _run(target):
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive(), 'deadlock'
+
+
+def _statuses():
+    return [job.status.get('status')
+            for job in load_db(cached=False).table('LocalJob').all()]
+
+
+def test_workflow_with_started_scheduler(workflow, scheduler):
+    '''
+    Jobs finishing in the background while EOSWorkflow.run holds the lock
+        of the database and submits more jobs
+    '''
+    _run(workflow.run)
+    assert scheduler.wait(timeout=TIMEOUT)
+    assert _statuses() == ['Complete'] * len(workflow.jobs)
+
+
+def test_submit_in_transaction(workflow, scheduler):
+    '''
+    The background thread writes the status of a finished job while the
+        main thread holds the lock of the database and submits a job
+    '''
+    first, second = workflow.jobs[:2]
+
+    def target():
+        with load_db().transaction(rollback=False):
+            first.run()
+            # Let the background thread see the first job finish
+            time.sleep(0.5)
+            second.run()
+
+    _run(target)
+    assert scheduler.wait(timeout=TIMEOUT)
+    assert _statuses() == ['Complete', 'Complete']
@@ -0,0 +1,70 @@
+import pytest
+from tinydb import Query
+
+from dftmanlib.db import load_db, close_all_dbs, SQLiteStorage
+
+DOCUMENTS = [
+    {'hash': 'a', 'status': {'status': 'Running'}, 'metadata': {'a': 1}},
+    {'hash': 'b', 'status': {'status': 'Complete'}, 'metadata': {'a': 2}},
+    # New PBSJobs and SubmitJobs start without a status
+    {'hash': 'c', 'status': {'status': None}, 'metadata': {'a': None}},
+    {'hash': 'd', 'status': {}, 'metadata': {}},
+    {'hash': 'e', 'status': None, 'metadata': None},
+    {'hash': 'f', 'status': {'status': 'Complete'},
+     'metadata': {'a': 1, 'b': True}},
+]
+
+
+
+class Document(dict):
+    '''
+    Plain document, which can carry the doc_version set by MSONTable
+    '''
+
+
+query = Query()
+QUERIES = [
+    query.status.status == 'Complete',
+    query.status.status != 'Complete',
+    ~(query.status.status == 'Complete'),
+    ~(query.status.status != 'Complete'),
+    query.status.status.exists(),
+    ~query.status.status.exists(),
+    query.metadata.a == 1,
+    query.metadata.a != 1,
+    ~(query.metadata.a == 1),
+    query.metadata.a.exists(),
+    query.metadata.b == True,
+    query.metadata.b != True,
+    (query.status.status != 'Complete') & (query.metadata.a != 2),
+    (query.status.status == 'Running') | (query.metadata.a != 1),
+    ~((query.status.status == 'Running') | (query.metadata.a == 2)),
+    query.hash != 'a',
+]
+
+
+@pytest.fixture
+def table(tmp_path):
+    db = load_db(str(tmp_path / 'db.sqlite'), storage=SQLiteStorage)
+    table = db.table('Documents')
+    for document in DOCUMENTS:
+        table.insert(Document(document), block_if_stored=False)
+    yield table
+    close_all_dbs()
+
+
+@pytest.mark.parametrize('cond', QUERIES, ids=repr)
+def test_pushdown_matches_tinydb(table, cond):
+    '''
+    Queries answered by SQL give the results of TinyDB's own evaluation
+        of the query, also for null and missing fields
+    '''
+    expected = [document['hash'] for document in DOCUMENTS
+                if cond(document)]
+    found = [document['hash'] for document in table.search(cond)]
+    assert sorted(found) == sorted(expected)
+
+
+def test_null_fields_are_pushed_down(table):
+    selected = table._storage.select(Query().status.status != 'Complete')
+    assert selected is not None and selected[1]